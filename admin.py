@@ -22,7 +22,26 @@ class WordPairInline(admin.TabularInline):
 class WordListAdmin(admin.ModelAdmin):
     inlines = [WordPairInline]
 
+class EWLogEntryAdmin(admin.ModelAdmin):
+    # The list is ordered by the indexed datetime column, and the users are
+    # not joined or listed in a select box. (A date hierarchy or a list
+    # filter would read the whole table.)
+    list_display = ('datetime', 'username', 'action', 'text', 'ipaddress')
+    ordering = ('-datetime',)
+    raw_id_fields = ('user',)
+
+class EWLogDailyCountAdmin(admin.ModelAdmin):
+    list_display = ('day', 'username', 'action', 'count')
+    ordering = ('-day',)
+    raw_id_fields = ('user',)
+
+class ViewStatsAdmin(admin.ModelAdmin):
+    list_display = ('day', 'view_name', 'bucket', 'count', 'wall_time')
+    ordering = ('-day', 'view_name', 'bucket')
+
 admin.site.register(ew.models.WDict, WordListAdmin)
 admin.site.register(ew.models.EWUser)
-admin.site.register(ew.models.EWLogEntry)
+admin.site.register(ew.models.EWLogEntry, EWLogEntryAdmin)
+admin.site.register(ew.models.EWLogDailyCount, EWLogDailyCountAdmin)
+admin.site.register(ew.models.ViewStats, ViewStatsAdmin)
 admin.site.register(ew.models.Announcement)
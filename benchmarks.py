@@ -0,0 +1,335 @@
+# Copyright (C) 2011-2013 Csaba Hoch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Benchmarks of the performance-critical parts of ExponWords.
+
+The benchmarks can be run with the following command:
+
+    $ python manage.py ew_benchmark
+
+The sizes of the users created by the suite can be given with the --sizes
+option (e.g. --sizes=1000,10000), and the results can be written into a JSON
+file with the --json option, so that the results of different releases can
+be compared.
+
+The benchmarks that use the database (benchmark_import, benchmark_forecast,
+benchmark_suite) expect to be run in a test database, which is created by the
+command.
+
+Each benchmark returns a list of (name, seconds, query_count) tuples.
+"""
+
+import datetime
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.client import RequestFactory
+
+import ExponWords.ew.models as models
+import ExponWords.ew.views as views
+
+
+##### Helper functions #####
+
+
+def measure(fun, repeat=3):
+    """Calls `fun` `repeat` times.
+
+    The database queries are counted during the first call.
+
+    Returns: (seconds, query_count) -- the best running time and the number
+    of queries
+    """
+
+    best = None
+    query_count = None
+    for i in range(repeat):
+        if query_count is None:
+            old_use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            old_query_count = len(connection.queries)
+        start = time.time()
+        try:
+            fun()
+        finally:
+            elapsed = time.time() - start
+            if query_count is None:
+                query_count = len(connection.queries) - old_query_count
+                connection.use_debug_cursor = old_use_debug_cursor
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, query_count
+
+
+##### Sanitizer #####
+
+
+def get_sanitizer_notes():
+    """Returns notes that are typical or hard for simple_html_to_html.
+
+    Returns: [(name, note)]
+    """
+
+    return [('large note',
+             ('Some <b>bold</b> text &amp; <a href="http://example.com/">'
+              'a link</a>\n    with an indented line\n') * 2000),
+            ('unclosed tags',
+             'a<' * 20000),
+            ('unclosed quotes',
+             '<a title="' * 5000),
+            ('unclosed attributes',
+             '<a href="x" title=\'y\' ' * 3000)]
+
+
+def benchmark_sanitizer(repeat=3):
+    """Measures the conversion of the notes of get_sanitizer_notes in each
+    text format.
+
+    Returns: [(name, seconds, query_count)]
+    """
+
+    results = []
+    for note_name, note in get_sanitizer_notes():
+        for text_format, fun in \
+                (('text',
+                  lambda: models.text_to_html(note, 4)),
+                 ('html',
+                  lambda: models.simple_html_to_html(note, False, 0)),
+                 ('html_ws',
+                  lambda: models.simple_html_to_html(note, True, 4))):
+            name = 'sanitizer: %s (%s, %s characters)' % \
+                   (note_name, text_format, len(note))
+            results.append((name,) + measure(fun, repeat))
+    return results
+
+
+##### Importing #####
+
+
+def get_import_text(line_count):
+    """Returns a text file with `line_count` lines that can be imported with
+    import_textfile. Every fifth word pair has a two-line explanation."""
+
+    lines = []
+    i = 0
+    while len(lines) < line_count:
+        lines.append(u'word %s -- sz\xf3 %s <%s 2013-01-%02d><0 2013-02-01>'
+                     % (i, i, i % 10, i % 28 + 1))
+        if i % 5 == 0:
+            lines.append('    explanation of word %s' % i)
+            lines.append('    with a second line')
+        i += 1
+    return u'\n'.join(lines[:line_count])
+
+
+def get_import_tsv(line_count):
+    """Returns a TSV text with `line_count` lines that can be imported with
+    import_tsv."""
+
+    return u'\n'.join(u'word %s\tsz\xf3 %s\tnote %s' % (i, i, i)
+                      for i in range(line_count))
+
+
+def benchmark_import(line_count=50000, repeat=1):
+    """Measures importing `line_count` lines into a new dictionary.
+
+    Returns: [(name, seconds, query_count)]
+    """
+
+    user = User.objects.create_user('ew_benchmark', 'ew@example.com', 'pw')
+    results = []
+    for name, import_fun, text in \
+            (('text', models.import_textfile, get_import_text(line_count)),
+             ('tsv', models.import_tsv, get_import_tsv(line_count))):
+
+        def import_text():
+            wdict = models.WDict.objects.create(user=user, name='benchmark',
+                                                lang1='en', lang2='hu')
+            import_fun(text, wdict, 'imported')
+
+        results.append(('import: %s (%s lines)' % (name, line_count),) +
+                       measure(import_text, repeat))
+    return results
+
+
+##### Forecast #####
+
+
+LABELS = ['noun', 'verb', 'adjective', 'idiom', 'hard', 'lesson1',
+          'lesson2', 'lesson3']
+
+NOTES = ['A <b>common</b> word.',
+         'See also: <i>word 42</i>.\n    Example:\n        a sentence',
+         'Plural: words\nPast tense: worded',
+         'From <a href="http://example.com/">the textbook</a>, p. 12.']
+
+
+def create_random_word_pairs(user, wdict_count, word_pair_count, seed=0):
+    """Creates dictionaries for the user with word pairs of random strengths,
+    due dates, labels and notes.
+
+    Returns: [WDict]
+    """
+
+    rnd = random.Random(seed)
+    today = models.get_today(user)
+    wdicts = []
+    for i in range(wdict_count):
+        wdict = models.WDict.objects.create(user=user, name='dict %s' % i,
+                                            lang1='en', lang2='hu')
+        if i % 2 == 1:
+            wdict.strengthener_method = 'double_due'
+            wdict.text_format = 'html_ws'
+            wdict.save()
+        word_pairs = []
+        for j in range(word_pair_count // wdict_count):
+            wp = models.WordPair(word_in_lang1='word %s' % j,
+                                 word_in_lang2=u'sz\xf3 %s' % j,
+                                 date_added=today,
+                                 labels=' '.join(rnd.sample(LABELS,
+                                                 rnd.randint(0, 2))))
+            if rnd.random() < 0.3:
+                wp.explanation = rnd.choice(NOTES)
+            for direction in (1, 2):
+                strength = rnd.choice([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
+                                       rnd.uniform(1, 10)])
+                due_date = today + datetime.timedelta(
+                                       days=rnd.randint(-30, 2 ** 7))
+                wp.set_strength(direction, strength)
+                wp.set_date(direction, due_date)
+            word_pairs.append(wp)
+        models.create_add_word_pairs(wdict, word_pairs)
+        wdicts.append(wdict)
+    return wdicts
+
+
+def benchmark_forecast(days_count=365, wdict_count=10, word_pair_count=20000,
+                       repeat=3):
+    """Measures calc_future on random dictionaries.
+
+    Returns: [(name, seconds, query_count)]
+    """
+
+    user = User.objects.create_user('ew_forecast', 'ew@example.com', 'pw')
+    wdicts = create_random_word_pairs(user, wdict_count, word_pair_count)
+    wdict_ids = [wdict.id for wdict in wdicts]
+    today = models.get_today(user)
+
+    def calc_future_uncached():
+        models.invalidate_forecasts(wdict_ids)
+        models.calc_future(user, days_count, today)
+
+    def calc_future_cached():
+        models.calc_future(user, days_count, today)
+
+    name = ('forecast: %s days, %s dictionaries, %s word pairs' %
+            (days_count, wdict_count, word_pair_count))
+    return [(name,) + measure(calc_future_uncached, repeat),
+            (name + ', cached',) + measure(calc_future_cached, repeat)]
+
+
+##### Suite #####
+
+
+SUITE_SIZES = (1000, 10000, 100000)
+
+
+def benchmark_user(user, wdicts, word_pair_count, repeat=3):
+    """Measures the practice, search, forecast, import and export functions
+    on the dictionaries of a user.
+
+    The words to practice are converted to JSON and imported and exported
+    using the first dictionary.
+
+    Returns: [(name, seconds, query_count)]
+    """
+
+    today = models.get_today(user)
+    wdict_ids = [wdict.id for wdict in wdicts]
+    context = models.UserContext(user)
+    words_of_wdicts = [wdict.get_words_to_practice_today(context=context)
+                       for wdict in wdicts]
+    text = models.export_textfile(wdicts[0])
+
+    def get_words_to_practice_today():
+        context = models.UserContext(user)
+        for wdict in wdicts:
+            wdict.get_words_to_practice_today(context=context)
+
+    def sort_words():
+        context = models.UserContext(user)
+        for wdict, words in zip(wdicts, words_of_wdicts):
+            wdict.sort_words(list(words), context=context)
+
+    def words_to_practice_to_json():
+        request = RequestFactory().get('/')
+        request.user = user
+        views.words_to_practice_to_json(request, words_of_wdicts[0],
+                                        views.PRACTICE_BATCH_SIZE)
+
+    def search_text():
+        word_pairs = views.search_in_db(user, 'all', None, u'word 1')
+        word_pairs.count()
+        list(word_pairs[:20])
+
+    def search_label():
+        word_pairs = views.search_in_db(user, 'all', 'hard', u'')
+        word_pairs.count()
+        list(word_pairs[:20])
+
+    def calc_future():
+        models.invalidate_forecasts(wdict_ids)
+        models.calc_future(user, 365, today)
+
+    def import_textfile():
+        wdict = models.WDict.objects.create(user=user, name='imported',
+                                            lang1='en', lang2='hu')
+        models.import_textfile(text, wdict)
+
+    def export_textfile():
+        models.export_textfile(wdicts[0])
+
+    results = []
+    for name, fun in (('get_words_to_practice_today',
+                       get_words_to_practice_today),
+                      ('sort_words', sort_words),
+                      ('words_to_practice_to_json',
+                       words_to_practice_to_json),
+                      ('search_in_db (text)', search_text),
+                      ('search_in_db (label)', search_label),
+                      ('calc_future', calc_future),
+                      ('import_textfile', import_textfile),
+                      ('export_textfile', export_textfile)):
+        results.append(('suite: %s (%s word pairs)' %
+                        (name, word_pair_count),) + measure(fun, repeat))
+    return results
+
+
+def benchmark_suite(sizes=SUITE_SIZES, wdict_count=5, repeat=3):
+    """Runs benchmark_user for users with `sizes` word pairs distributed in
+    `wdict_count` dictionaries.
+
+    Returns: [(name, seconds, query_count)]
+    """
+
+    results = []
+    for size in sizes:
+        user = User.objects.create_user('ew_suite_%s' % size,
+                                        'ew@example.com', 'pw')
+        wdicts = create_random_word_pairs(user, wdict_count, size)
+        results += benchmark_user(user, wdicts, size, repeat)
+    return results
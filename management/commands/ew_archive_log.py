@@ -0,0 +1,47 @@
+# Copyright (C) 2011-2013 Csaba Hoch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+import ExponWords.ew.models as models
+
+
+class Command(BaseCommand):
+
+    args = '<archive_dir>'
+    help = ('Moves the old log entries into compressed daily archive files '
+            'in <archive_dir> and counts them per day, action and user.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+                    type='int',
+                    dest='days',
+                    default=90,
+                    help='Keep the log entries of the last DAYS days '
+                         '(default: 90).'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: ew_archive_log %s' % self.args)
+        archive_dir = args[0]
+        before = (datetime.date.today() -
+                  datetime.timedelta(days=options['days']))
+        archived_count = models.archive_log_entries(before, archive_dir)
+        self.stdout.write('%s log entries archived.\n' % archived_count)
@@ -0,0 +1,77 @@
+# Copyright (C) 2011-2013 Csaba Hoch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+
+import ExponWords.ew.benchmarks as benchmarks
+import ExponWords.ew.models as models
+
+
+class Command(NoArgsCommand):
+
+    help = 'Runs the ExponWords benchmarks and prints the running times.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes',
+                    dest='sizes',
+                    default=','.join(str(size)
+                                     for size in benchmarks.SUITE_SIZES),
+                    help='The comma-separated numbers of word pairs used '
+                         'by the suite (default: %default).'),
+        make_option('--json',
+                    dest='json',
+                    default=None,
+                    help='Write the results into the JSON file JSON too.'),
+        )
+
+    def handle_noargs(self, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')
+                     if size.strip()]
+        except ValueError:
+            raise CommandError('Invalid --sizes: %s' % options['sizes'])
+
+        results = benchmarks.benchmark_sanitizer()
+
+        # The benchmarks that modify the database are run in a test database
+        old_database_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            results += benchmarks.benchmark_import()
+            results += benchmarks.benchmark_forecast()
+            results += benchmarks.benchmark_suite(sizes)
+        finally:
+            connection.creation.destroy_test_db(old_database_name,
+                                                verbosity=0)
+
+        for name, seconds, query_count in results:
+            self.stdout.write('%s: %.1f ms, %s queries\n' %
+                              (name, seconds * 1000, query_count))
+
+        if options['json'] is not None:
+            with open(options['json'], 'w') as f:
+                json.dump({'version': models.version,
+                           'date': datetime.datetime.now().isoformat(),
+                           'results': [{'name': name,
+                                        'seconds': seconds,
+                                        'queries': query_count}
+                                       for name, seconds, query_count
+                                       in results]},
+                          f, indent=4)
+                f.write('\n')
@@ -0,0 +1,32 @@
+# Copyright (C) 2011-2013 Csaba Hoch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+
+from django.core.management.base import NoArgsCommand
+
+import ExponWords.ew.models as models
+
+
+class Command(NoArgsCommand):
+
+    help = ('Adds the word pairs saved before the search and label indexes '
+            'were introduced to the indexes.')
+
+    def handle_noargs(self, **options):
+        for wdict in models.WDict.objects.all().order_by('id'):
+            models.index_word_pairs(wdict.wordpair_set.all())
+        self.stdout.write('%s word pairs are in the search index.\n' %
+                          models.SearchText.objects.count())
@@ -0,0 +1,35 @@
+# Copyright (C) 2011-2013 Csaba Hoch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+from django.core.management.base import NoArgsCommand
+
+import ExponWords.ew.models as models
+
+
+class Command(NoArgsCommand):
+
+    help = 'Sends the unsent emails of the unfinished release announcements.'
+
+    def handle_noargs(self, **options):
+        for job in models.AnnouncementJob.objects.filter(finished=None):
+            errors = models.run_announcement_job(job)
+            sent_count, recipient_count = job.get_progress()
+            self.stdout.write('Announcement %s: %s of %s emails sent, '
+                              '%s failed.\n' %
+                              (job.id, sent_count, recipient_count,
+                               job.get_failed_count()))
+            for error in errors:
+                self.stderr.write('Error: %s\n' % error)
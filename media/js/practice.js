@@ -32,6 +32,22 @@ var MAX_TIMEOUT = 20 * 1000; // 20 seconds
 // The minimum time for the "Please wait" text to be displayed.
 var MIN_PLEASE_WAIT_DISPLAY = 300; // 1 second.
 
+// Answers and label additions are queued and sent to the server in batches.
+// The queue is flushed when it contains FLUSH_SIZE updates, every
+// FLUSH_INTERVAL ms, when there are no more words to ask and when the page is
+// unloaded.
+var FLUSH_SIZE = 10;
+var FLUSH_INTERVAL = 15 * 1000; // 15 seconds
+
+// The maximum number of updates sent in one request.
+var MAX_BATCH_SIZE = 100;
+
+// The words to practice are downloaded in batches. The next batch is
+// requested when only PREFETCH_THRESHOLD words are left to be asked, and a
+// failed request is retried after FETCH_RETRY_INTERVAL ms.
+var PREFETCH_THRESHOLD = 10;
+var FETCH_RETRY_INTERVAL = 3 * 1000; // 3 seconds
+
 // The maximum number of characters used to represent the question word when
 // printing information about how adding a label to the word progresses
 var QUESTION_WORD_PREFIX = 40;
@@ -41,6 +57,19 @@ var QUESTION_WORD_PREFIX = 40;
 
 var todays_word_list;
 var all_words_to_practice;
+
+// The position of the next batch in the practice queue on the server (null
+// if there are no more batches), whether the next batch is being downloaded,
+// and the functions to call when it arrives.
+var practice_cursor = null;
+var word_list_type;
+var fetch_in_progress = false;
+var fetch_callbacks = [];
+
+// The words answered in this session: {'<word index>-<direction>': true}.
+// They are skipped if they arrive in a later batch before the server has
+// received the answer.
+var answered_words = {};
 var transferred = 0;
 var first_transfer_in_progress = 0;
 var retry_transfer_in_progress = 0;
@@ -49,6 +78,14 @@ var answered_incorrectly = 0;
 var operations_are_visible = false;
 var fullscreen_on = false;
 
+// Updates waiting to be sent to the server, and the updates whose transfer is
+// in progress. Only one batch is transferred at a time. Each update is an
+// object whose 'data' attribute is sent to the server and whose 'success',
+// 'error' and 'give_up' callbacks are called when the transfer of the batch
+// succeeds, fails or is given up.
+var update_queue = [];
+var update_batch = [];
+
 // The state of the UI. Possible states:
 // - init
 // - intermediate: the UI is doing some work
@@ -112,15 +149,13 @@ function ask_first_word(todays_word_list_param) {
     // Set the given word list as the word list for today and ask the first
     // word.
     todays_word_list = todays_word_list_param['word_list'];
-    words_to_practice_now = todays_word_list.length;
     all_words_to_practice = todays_word_list_param['all_words_to_practice'];
-
-    $('#all-now').text(words_to_practice_now);
-    if (words_to_practice_now < all_words_to_practice) {
-        $('#all-today').text('[' + translations['all_words_to_practice'] +
-                             ': ' + all_words_to_practice + ']');
+    if (todays_word_list_param['cursor'] != undefined) {
+        practice_cursor = todays_word_list_param['cursor'];
     }
 
+    $('#all-now').text(all_words_to_practice);
+
     $('#transferred').text('0');
     $('#transfer-in-progress').text('0');
     $('#answered').text('0');
@@ -128,26 +163,61 @@ function ask_first_word(todays_word_list_param) {
     ask_word();
 }
 
-function get_todays_word_list(success_fun, word_list_type) {
-    // Get the list of today's word from the server and ask the first one.
-    // word_list_type = "normal" | "early"
+function get_todays_word_list(success_fun, cursor) {
+    // Get a batch of today's words from the server.
     $.ajax({
         url: GET_WORDS_TO_PRACTICE_TODAY_URL + '?' + Math.random(),
         dataType: 'json',
-        data: {'word_list_type': word_list_type},
+        data: {'word_list_type': word_list_type,
+               'cursor': cursor},
         type: 'get',
-        success: success_fun
+        success: success_fun,
+        error: function() {
+            setTimeout(function() {
+                get_todays_word_list(success_fun, cursor);
+            }, FETCH_RETRY_INTERVAL);
+        }
     });
 }
 
+function fetch_next_batch(callback) {
+    // Download the next batch of words and append them to the word list.
+    // `callback` (if given) is called when the batch has arrived.
+    if (callback) {
+        fetch_callbacks.push(callback);
+    }
+    if (fetch_in_progress) {
+        return;
+    }
+    fetch_in_progress = true;
+    get_todays_word_list(function(result) {
+        for (var i = 0; i < result['word_list'].length; i++) {
+            var new_word = result['word_list'][i];
+            if (!answered_words[new_word[3] + '-' + new_word[2]]) {
+                todays_word_list.push(new_word);
+            }
+        }
+        practice_cursor = result['cursor'];
+        fetch_in_progress = false;
+        var callbacks = fetch_callbacks;
+        fetch_callbacks = [];
+        for (var i = 0; i < callbacks.length; i++) {
+            callbacks[i]();
+        }
+    }, practice_cursor);
+}
+
 function start_practice() {
-    // Start the practice. If WORDS_TO_PRACTICE_TODAY is undefined, get the
-    // words from the server.
-    if (WORDS_TO_PRACTICE_TODAY == 'normal') {
-        get_todays_word_list(ask_first_word, 'normal');
-    } else if (WORDS_TO_PRACTICE_TODAY == 'early') {
-        get_todays_word_list(ask_first_word, 'early');
+    // Start the practice. If WORDS_TO_PRACTICE_TODAY is "normal" or "early",
+    // get the words from the server. Otherwise it is the first batch of the
+    // words selected on the search page.
+    // word_list_type = "normal" | "early" | "selected"
+    if (WORDS_TO_PRACTICE_TODAY == 'normal' ||
+        WORDS_TO_PRACTICE_TODAY == 'early') {
+        word_list_type = WORDS_TO_PRACTICE_TODAY;
+        get_todays_word_list(ask_first_word, 0);
     } else {
+        word_list_type = 'selected';
         ask_first_word(WORDS_TO_PRACTICE_TODAY);
     }
 }
@@ -175,7 +245,13 @@ function update_edit_words(button, curr_word_index) {
 
 function ask_word() {
 
-    if (todays_word_list.length == 0) {
+    if (todays_word_list.length == 0 && practice_cursor != null) {
+
+        // The next batch has not arrived yet
+        state = 'intermediate';
+        fetch_next_batch(ask_word);
+
+    } else if (todays_word_list.length == 0) {
 
         state = 'please_wait_hard';
         prev_word_index = word_index;
@@ -188,6 +264,7 @@ function ask_word() {
 
         update_transfer_in_progress();
         update_edit_words();
+        flush_updates();
 
         // We display "Please wait" for at least MIN_PLEASE_WAIT_DISPLAY
         // ms so that the user has the time to read it. Then we move to
@@ -226,6 +303,11 @@ function ask_word() {
 
         todays_word_list.shift();
         state = 'answer';
+
+        if (todays_word_list.length <= PREFETCH_THRESHOLD &&
+            practice_cursor != null) {
+            fetch_next_batch();
+        }
     }
 }
 
@@ -277,10 +359,8 @@ function update_transfer_in_progress() {
     if (state == 'please_wait_hard' || state == 'please_wait_soft')
         $('#final_sentence').text(translations['please_wait']);
     else if (state == 'finished') {
-        // The page should be reloaded if there are still words today or there
-        // were incorrect answers
-        if (words_to_practice_now < all_words_to_practice ||
-            answered_incorrectly > 0) {
+        // The page should be reloaded if there were incorrect answers
+        if (answered_incorrectly > 0) {
             location.reload();
         } else {
             $('#final_sentence').text(translations['finished']);
@@ -309,9 +389,10 @@ function ew_ajax_send(url, data, retries, timeout, success_fun, error_fun,
             type: 'post',
             timeout: timeout,
             success: function(result) {
-                if (result == 'ok') {
+                if (result == 'ok' ||
+                    (result != null && result['status'] == 'ok')) {
                     // The update was successful
-                    success_fun(retries);
+                    success_fun(retries, result);
                 } else {
                     // We got an error from the server
                     ew_ajax_error(url, data, result, retries, timeout,
@@ -356,17 +437,101 @@ function ajax_update_word_give_up() {
     update_transfer_in_progress();
 }
 
-function ajax_update_word(update_data) {
-    // Sends an "update word" request to the server.
+function get_update_data(updates) {
+    var data = [];
+    for (var i = 0; i < updates.length; i++) {
+        data.push(updates[i]['data']);
+    }
+    return {'updates': JSON.stringify(data),
+            'csrfmiddlewaretoken': csrf_token};
+}
+
+function flush_updates() {
+    // Sends the queued updates to the server unless a batch is already being
+    // transferred.
+
+    if (update_batch.length > 0 || update_queue.length == 0) {
+        return;
+    }
+
+    var batch = update_queue.splice(0, MAX_BATCH_SIZE);
+    update_batch = batch;
+
+    var batch_finished = function() {
+        update_batch = [];
+        // Updates may have been queued during the transfer
+        if (update_queue.length >= FLUSH_SIZE ||
+            state == 'please_wait_hard' || state == 'please_wait_soft') {
+            flush_updates();
+        }
+    }
+
+    ew_ajax_send(UPDATE_WORDS_URL, get_update_data(batch), RETRIES_COUNT,
+                 INITIAL_TIMEOUT,
+                 function(retries, result) {
+                     for (var i = 0; i < batch.length; i++) {
+                         batch[i]['success'](retries, result['results'][i]);
+                     }
+                     batch_finished();
+                 },
+                 function(retries) {
+                     for (var i = 0; i < batch.length; i++) {
+                         batch[i]['error'](retries);
+                     }
+                 },
+                 function() {
+                     for (var i = 0; i < batch.length; i++) {
+                         batch[i]['give_up']();
+                     }
+                     batch_finished();
+                 });
+}
+
+function flush_updates_on_unload() {
+    // Sends all updates that may not have reached the server. The batch
+    // being transferred is sent again because the browser may abort its
+    // transfer; the server ignores answers that have already been applied.
+
+    var updates = update_batch.concat(update_queue);
+    if (updates.length == 0) {
+        return;
+    }
+
+    var data = get_update_data(updates);
+    if (navigator.sendBeacon && window.FormData) {
+        var form_data = new FormData();
+        for (var key in data) {
+            form_data.append(key, data[key]);
+        }
+        navigator.sendBeacon(UPDATE_WORDS_URL, form_data);
+    } else {
+        $.ajax({
+            url: UPDATE_WORDS_URL,
+            data: data,
+            type: 'post',
+            async: false
+        });
+    }
+}
+
+function queue_update(update) {
+    update_queue.push(update);
+    if (update_queue.length >= FLUSH_SIZE) {
+        flush_updates();
+    }
+}
+
+function queue_update_word(update_data) {
+    // Queues an answer to be sent to the server.
 
     // first_transfer_in_progress should be incremented by the caller of this
     // function.
 
-    update_data['csrfmiddlewaretoken'] = csrf_token;
-    ew_ajax_send(UPDATE_WORD_URL, update_data, RETRIES_COUNT, INITIAL_TIMEOUT,
-                 ajax_update_word_success,
-                 ajax_update_word_error,
-                 ajax_update_word_give_up);
+    update_data['type'] = 'answer';
+    queue_update({'data': update_data,
+                  'success': ajax_update_word_success,
+                  'error': ajax_update_word_error,
+                  'give_up': ajax_update_word_give_up});
 }
 
 function find_li_with_label(word_index, direction, label) {
@@ -407,9 +572,9 @@ function ajax_add_label_to_current_word(label) {
         }
     }
 
-    var data = {'word_index': JSON.stringify(word_index),
-                'label': JSON.stringify(label),
-                'csrfmiddlewaretoken': csrf_token};
+    var data = {'type': 'label',
+                'word_index': word_index,
+                'label': label};
 
     // Show the user that the operation has started
     $('#operations-list').append('<li></li>');
@@ -418,19 +583,28 @@ function ajax_add_label_to_current_word(label) {
                                         '-' + label).
                              text(tr_dict['start']);
 
-    ew_ajax_send(ADD_LABEL_URL, data, RETRIES_COUNT, INITIAL_TIMEOUT,
-                 change_text_gen(tr_dict['success']),
-                 change_text_gen(tr_dict['error']),
-                 change_text_gen(tr_dict['give_up']));
+    var show_success = change_text_gen(tr_dict['success']);
+    var show_gave_up = change_text_gen(tr_dict['gave_up']);
+    queue_update({'data': data,
+                  'success': function(retries, status) {
+                      if (status == 'ok') {
+                          show_success();
+                      } else {
+                          show_gave_up();
+                      }
+                  },
+                  'error': change_text_gen(tr_dict['trying']),
+                  'give_up': show_gave_up});
 }
 
 function yesno_button(answer) {
     state = 'intermediate';
-    var update_data = {'answer': JSON.stringify(answer),
-                       'word_index': JSON.stringify(word_index),
-                       'direction': JSON.stringify(direction),
-                       'old_date': JSON.stringify(word_current_date),
-                       'old_strength': JSON.stringify(word_current_strength)};
+    var update_data = {'answer': answer,
+                       'word_index': word_index,
+                       'direction': direction,
+                       'old_date': word_current_date,
+                       'old_strength': word_current_strength};
+    answered_words[word_index + '-' + direction] = true;
     first_transfer_in_progress++;
     ask_word();
     answered++;
@@ -439,7 +613,7 @@ function yesno_button(answer) {
         $('#answered-incorrectly').text(answered_incorrectly);
     }
     $('#answered').text(answered);
-    ajax_update_word(update_data);
+    queue_update_word(update_data);
 }
 
 function ew_practice_button_pressed(button) {
@@ -500,14 +674,12 @@ function fullscreen(action) {
             $('#breadcrumb').hide();
             $('#fullscreen-on-button').hide();
             $('#fullscreen-off-button').show();
-            $('#all-today').hide();
             $('body #main #buttons').hide();
             fullscreen_on = true;
     } else {
             $('#breadcrumb').show();
             $('#fullscreen-on-button').show();
             $('#fullscreen-off-button').hide();
-            $('#all-today').show();
             $('body #main #buttons').show();
             fullscreen_on = false;
     }
@@ -556,6 +728,10 @@ $(document).ready(function() {
 
     maybe_activate_ew_pageupdown();
 
+    // Sending the queued updates
+    setInterval(flush_updates, FLUSH_INTERVAL);
+    $(window).bind('beforeunload', flush_updates_on_unload);
+
     //Initializing the translation dictionary
     init_translations();
 
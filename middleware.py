@@ -0,0 +1,80 @@
+# Copyright (C) 2011-2013 Csaba Hoch
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Middleware of ExponWords."""
+
+import time
+
+import ExponWords.ew.models as models
+
+
+# urls.py imports the views as ew.views, but they can be imported as
+# ExponWords.ew.views too
+EW_VIEWS_MODULES = ('ew.views', 'ExponWords.ew.views')
+
+
+def get_view_name(view_func):
+    """Returns the name of the view function under which its statistics are
+    collected.
+
+    The views of ExponWords are identified by their function name, the other
+    views (e.g. the admin views) by their full name.
+    """
+
+    name = getattr(view_func, '__name__', view_func.__class__.__name__)
+    module = getattr(view_func, '__module__', None)
+    if module is not None and module not in EW_VIEWS_MODULES:
+        name = module + '.' + name
+    return name
+
+
+def get_response_size(response):
+    """Returns the size of the content of a response, or 0 if the content is
+    generated by an iterator (reading it would consume the iterator)."""
+
+    if response._is_string:
+        return sum(len(chunk) for chunk in response._container)
+    else:
+        return 0
+
+
+class ViewStatsMiddleware(object):
+    """Measures the wall time, the database time, the number of queries and
+    the response size of the requests and collects them per view in
+    models.view_stats_collector.
+
+    The measurement starts when the view middleware of this class is called,
+    and ends when its response middleware is called, so the middleware should
+    be the last one in MIDDLEWARE_CLASSES. The work done while a streamed
+    response is sent is not measured.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timer = models.get_query_timer()
+        timer.start()
+        request.ew_view_stats = (get_view_name(view_func), time.time(), timer)
+        return None
+
+    def process_response(self, request, response):
+        view_stats = getattr(request, 'ew_view_stats', None)
+        if view_stats is not None:
+            del request.ew_view_stats
+            view_name, start, timer = view_stats
+            wall_time = time.time() - start
+            timer.stop()
+            models.view_stats_collector.add(view_name, wall_time,
+                                            timer.db_time, timer.query_count,
+                                            get_response_size(response))
+        return response
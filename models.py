@@ -12,12 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import bisect
+import csv
 import datetime
+import gzip
+import hashlib
+import json
 import math
+import os
+import Queue
 import random
 import re
+import struct
 import sys
-from django.db import models
+import threading
+import time
+import traceback
+import unicodedata
+from multiprocessing.pool import ThreadPool
+import django.db
+from django.conf import settings
+from django.core import mail
+from django.db import connection, models, transaction
+from django.db.backends.util import typecast_date
+from django.db.models import Count, F, Q, Sum
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext as _
 
@@ -67,6 +86,11 @@ def remove_trailing_newline(text):
         text = text[:-1]
     return text
 
+def normalize_string(s):
+    # Code copied from: http://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-in-a-python-unicode-string/518232#518232
+    return ''.join((c for c in unicodedata.normalize('NFD', s.lower())
+                    if unicodedata.category(c) != 'Mn'))
+
 def escape_html(text):
     text = re.sub('&', '&amp;', text)
     text = re.sub('<', '&lt;', text)
@@ -99,24 +123,30 @@ def newline_to_br(text, keepend):
     else:
         return '<br/>'.join(text.splitlines())
 
-class NotFound():
-    pass
 
-class TagNotAccepted():
-    pass
+# Matches the beginning of a line with its leading spaces, or a character to
+# be escaped
+TEXT_TO_HTML_REGEXP = re.compile(r'^( *)([&<>]?)|[&<>]', re.MULTILINE)
+HTML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '': ''}
 
 
-def try_match(regexp, s, i):
-    r = re.compile(regexp)
-    m = r.match(s, i)
-    if m:
-        try:
-            g = m.group(1)
-        except IndexError:
-            g = ''
-        return m.end(0), g
-    else:
-        raise NotFound()
+def text_to_html(text, add_space_count):
+    """Converts plain text to HTML.
+
+    It gives the same result as calling escape_html, indent_html and
+    newline_to_br(keepend=False) after each other, but it passes through the
+    text only once.
+    """
+
+    def replace(matchobject):
+        spaces = matchobject.group(1)
+        if spaces is None:
+            return HTML_ESCAPES[matchobject.group(0)]
+        else:
+            return ('&nbsp;' * (len(spaces) + add_space_count) +
+                    HTML_ESCAPES[matchobject.group(2)])
+
+    return '<br/>'.join(TEXT_TO_HTML_REGEXP.sub(replace, text).splitlines())
 
 
 # List of tags from http://www.w3schools.com/tags/ref_byfunc.asp
@@ -208,24 +238,115 @@ ALLOWED_ATTRIBUTES = [
 ALLOWED_ATTRIBUTES_SET = set(ALLOWED_ATTRIBUTES)
 
 
+# Regular expressions used by simple_html_to_html
+SPECIAL_CHAR_REGEXP = re.compile(r'[<&]')
+TAG_START_REGEXP = re.compile(r'<\s*/?')                   # < or </
+TAG_NAME_REGEXP = re.compile(r'\s*([^<>"\'= \t]+)\b')      # img
+ATTR_NAME_REGEXP = re.compile(r'\s*([^<>"\'= \t]+)\s*=\s*') # src=
+ATTR_VALUE_REGEXP = re.compile(r'[^<>"\'= \t]+\b')         # pic
+TAG_END_REGEXP = re.compile(r'\s*/?>')                     # > or />
+
+
+class HtmlScanner(object):
+    """Finds the allowed tags of a text for simple_html_to_html.
+
+    Quoted attribute values are found using the list of the positions of the
+    quote characters, and the result of reading the attributes from a given
+    position is remembered. So a text with many unclosed tags or quotes is
+    not read again and again from each '<' character.
+    """
+
+    def __init__(self, s):
+        self.s = s
+        self.quote_positions = {}
+        self.attrs_end = {}
+
+    def match_tag(self, i):
+        """Returns the end of the allowed tag that starts at `i`, or None if
+        there is no allowed tag there."""
+        m = TAG_START_REGEXP.match(self.s, i)
+        m = TAG_NAME_REGEXP.match(self.s, m.end())
+        if m is None or m.group(1) not in ALLOWED_TAGS_SET:
+            return None
+        return self.match_attrs_and_tag_end(m.end())
+
+    def match_attrs_and_tag_end(self, i):
+        """Reads the attributes and the closing '>' or '/>' of a tag from
+        position `i`. Returns the end of the tag or None."""
+        positions = []
+        while True:
+            if i in self.attrs_end:
+                end = self.attrs_end[i]
+                break
+            positions.append(i)
+            m = ATTR_NAME_REGEXP.match(self.s, i)
+            value_end = (self.match_attr_value(m.end())
+                         if m is not None else None)
+            if value_end is not None:
+                if m.group(1) not in ALLOWED_ATTRIBUTES_SET:
+                    end = None
+                    break
+                i = value_end
+            else:
+                # We didn't find any more attributes
+                m = TAG_END_REGEXP.match(self.s, i)
+                end = (m.end() if m is not None else None)
+                break
+        for position in positions:
+            self.attrs_end[position] = end
+        return end
+
+    def match_attr_value(self, i):
+        m = ATTR_VALUE_REGEXP.match(self.s, i)
+        if m is not None:
+            return m.end()
+        elif i < len(self.s) and self.s[i] in '"\'':
+            # Finding the closing quote
+            quote = self.s[i]
+            if quote not in self.quote_positions:
+                self.quote_positions[quote] = \
+                    [m.start() for m in re.finditer(quote, self.s)]
+            positions = self.quote_positions[quote]
+            index = bisect.bisect_right(positions, i)
+            if index < len(positions):
+                return positions[index] + 1
+        return None
+
+
+def indent_text_lines(text, add_space_count, skip_first_line):
+    """Same as newline_to_br(indent_html(...), keepend=True)."""
+    lines = text.split('\n')
+    for index, line in enumerate(lines):
+        if index > 0 or not skip_first_line:
+            stripped_line = line.lstrip(' ')
+            space_count = len(line) - len(stripped_line) + add_space_count
+            lines[index] = '&nbsp;' * space_count + stripped_line
+    return '<br/>'.join(lines)
+
+
 def simple_html_to_html(s, add_br, add_space_count):
-    i = 0
     html_result = []
     s = remove_trailing_newline(s)
 
     if s == '':
         return ''
 
+    scanner = HtmlScanner(s)
+    i = 0
     first = True
     while True:
 
-        i, substr = try_match('([^<&]*)', s, i)
-        text = escape_html(substr)
+        # Read the text until the next '<' or '&'. Only '>' needs to be
+        # escaped in it.
+        m = SPECIAL_CHAR_REGEXP.search(s, i)
+        text_end = (m.start() if m is not None else len(s))
+        text = s[i:text_end].replace('>', '&gt;')
         if add_br:
-            text = indent_html(text, add_space_count, skip_first_line=not first)
-            text = newline_to_br(text, keepend=True)
+            text = indent_text_lines(text, add_space_count,
+                                     skip_first_line=not first)
         html_result.append(text)
         first = False
+        i = text_end
 
         if i == len(s):
             break
@@ -236,93 +357,19 @@ def simple_html_to_html(s, add_br, add_space_count):
             continue
 
         # s[i] == '<'
-        tag_start = i
-        try:
-
-            # Read the opening '<' or '</'
-            i, _ = try_match(r'<\s*/?', s, i)
-
-            # Read the tag name
-            i, html_tag = try_match(r'\s*([^<>"\'= \t]+)\b', s, i)
-            if html_tag not in ALLOWED_TAGS_SET:
-                raise TagNotAccepted()
-
-            try:
-                while True:
-                    i, html_attr = \
-                        try_match(r'\s*([^<>"\'= \t]+)'     # src
-                                  r'\s*=\s*'                # =
-                                  r'(?:[^<>"\'= \t]+\b|'    # pic
-                                  r'"[^"]*"|'               # 'pic.jpg'
-                                  r'\'[^\']*\')',           # "pic.jpg"
-                                  s, i)
-                    if html_attr not in ALLOWED_ATTRIBUTES_SET:
-                        raise TagNotAccepted()
-            except NotFound:
-                # We didn't find any more attributes
-                pass
-
-            # Read the closing '>' or '/>'
-            i, _ = try_match(r'\s*/?>', s, i)
-
-        except NotFound:
-            # We didn't find a proper tag
+        tag_end = scanner.match_tag(i)
+        if tag_end is None:
+            # We didn't find a proper tag, or the tag we found has a name or
+            # attribute that is not allowed
             html_result.append('&lt;')
-            i = tag_start + 1
-        except TagNotAccepted:
-            # We tag we found has a name or attribute that is not allowed
-            html_result.append('&lt;')
-            i = tag_start + 1
+            i += 1
         else:
-            html_result.append(s[tag_start:i])
+            html_result.append(s[i:tag_end])
+            i = tag_end
 
     return ''.join(html_result)
 
 
-def test_simple_html_to_html():
-
-    def test(input, expected_output):
-        actual_output = simple_html_to_html(input,
-                                            add_br=False,
-                                            add_space_count=0)
-        if actual_output != expected_output:
-            print 'Expected and actual output do not match:'
-            print 'Input:          ', input
-            print 'Expected output:', expected_output
-            print 'Actual output:  ', actual_output
-            print
-
-    # Edge cases
-    test('', '')
-    test('<', '&lt;')
-    test('>', '&gt;')
-    test('a<a', 'a&lt;a')
-    test('<br>', '<br>')
-    test('< br >', '< br >')
-    test('<br/>', '<br/>')
-    test('<unknown>', '&lt;unknown&gt;')
-
-    # Ampersand
-    test('&amp;',
-         '&amp;')
-
-    # Different attribute value formats
-    test('ab<a href=xy>b</a>',
-         'ab<a href=xy>b</a>')
-    test('ab<a href="xy \' z">b</a>',
-         'ab<a href="xy \' z">b</a>')
-    test('ab<a href=\'xy " z\'>b</a>',
-         'ab<a href=\'xy " z\'>b</a>')
-
-    # More complex examples
-    test('<img src=xy title="hello world">',
-         '<img src=xy title="hello world">')
-    test('ab<img src=xy title="hello world">b',
-         'ab<img src=xy title="hello world">b')
-    test('<img src=xy title="hello world"><img src=xy title="hello world">',
-         '<img src=xy title="hello world"><img src=xy title="hello world">')
-
-
 ##### Date handling #####
 
 
@@ -575,13 +622,28 @@ class EWUser(models.Model):
         return unicode(self.quick_labels).split()
 
     @staticmethod
-    def get_email_receiver_users():
-        return [user
-                for user in
-                   (User.objects.filter(ewuser__release_emails=True).
-                                 exclude(email='') |
-                    User.objects.filter(ewuser=None).
-                                 exclude(email=''))]
+    def iter_email_receivers():
+        """Yields the users who should receive notifications about new
+        releases, ordered by language.
+
+        The users and their settings are read with one query. Users without
+        an EWUser row receive the notifications in English.
+
+        Yields: (lang, user_id, username, email)
+        """
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT COALESCE(e.lang, %s) AS lang, u.id, u.username, u.email '
+            'FROM ' + User._meta.db_table + ' u '
+            'LEFT OUTER JOIN ' + EWUser._meta.db_table + ' e '
+            'ON e.user_id = u.id '
+            "WHERE u.email != '' AND "
+            '(e.release_emails = %s OR e.user_id IS NULL) '
+            'ORDER BY lang, u.id',
+            ['en', True])
+        for row in cursor:
+            yield row
 
 
 def get_ewuser(user):
@@ -593,6 +655,49 @@ def get_ewuser(user):
         return EWUser.objects.get(pk=user)
 
 
+class UserContext(object):
+    """The settings of a user and the values calculated from them.
+
+    The EWUser object is read and the user time is calculated only once,
+    when they are first needed, so one context can be shared by all
+    functions that serve the same request.
+    """
+
+    def __init__(self, user, ewuser=None):
+        self.user = user
+        self._ewuser = ewuser
+        self._user_time = None
+
+    @property
+    def ewuser(self):
+        if self._ewuser is None:
+            self._ewuser = get_ewuser(self.user)
+        return self._ewuser
+
+    @property
+    def user_time(self):
+        if self._user_time is None:
+            self._user_time = \
+                get_user_time(timezone=self.ewuser.timezone,
+                              turning_point=self.ewuser.turning_point)
+        return self._user_time
+
+    @property
+    def today(self):
+        user_time = self.user_time
+        return datetime.date(user_time.year, user_time.month, user_time.day)
+
+    def has_extra(self, feature):
+        return feature in self.ewuser.extras
+
+
+def get_user_context(user, context=None):
+    """Returns `context`, or a new context of `user` if `context` is None."""
+    if context is None:
+        context = UserContext(user)
+    return context
+
+
 class WDict(models.Model):
 
     # WDict = word dictionary (as opposed to the dictionary data type which is
@@ -611,12 +716,64 @@ class WDict(models.Model):
     def __unicode__(self):
         return self.name
 
-    def get_words_to_practice_today(self, word_list_type='normal'):
+    def get_words_to_practice_today(self, word_list_type='normal',
+                                    context=None):
+        """Returns the (word pair, direction) pairs that should be practiced
+        today.
+
+        A word is due if its date is not later than "today" of the user, so
+        the due words are selected by the database (using the
+        (wdict, deleted, date1) and (wdict, deleted, date2) indexes). Only
+        the dimness of the candidates of the "early" word list is calculated
+        in Python.
+        """
+
+        assert(word_list_type in ('normal', 'early'))
+        today = get_user_context(self.user, context).today
+        query = Q(date1__lte=today) | Q(date2__lte=today)
+        if word_list_type == 'early':
+            query |= Q(strength1__gt=0) | Q(strength2__gt=0)
+        word_pairs = \
+            self.wordpair_set.filter(query, deleted=False).order_by('id')
+
+        result = []
+        for wp in word_pairs:
+            for direction in (1, 2):
+                if self.is_word_to_practice(wp, direction, word_list_type,
+                                            today):
+                    result.append((wp, direction))
+        return result
+
+    def is_word_to_practice(self, wp, direction, word_list_type, today):
+        """Returns whether a direction of a word pair of the dictionary
+        should be practiced today."""
+
+        is_due = (wp.get_date(direction) <= today)
+        if word_list_type == 'normal':
+            return is_due
+        else:
+            return (is_due or
+                    self.is_word_to_practice_early(wp, direction, today))
+
+    def is_word_to_practice_early(self, wp, direction, today):
+        """Returns whether a direction of a word pair of the dictionary is not
+        due today, but it is in the "early" word list."""
+
+        return (wp.get_date(direction) > today and
+                wp.get_strength(direction) > 0 and
+                wp.get_dimness(direction, today) >=
+                MIN_DIMNESS_FOR_EARLY_PRACTICE)
+
+    def scan_words_to_practice_today(self, word_list_type='normal'):
+        """Same as get_words_to_practice_today, but it checks every word pair
+        of the dictionary in Python. It is kept as a reference
+        implementation for the tests."""
+
         assert(word_list_type in ('normal', 'early'))
         user_time = get_user_time(user=self.user)
         today = get_today(self.user)
         result = []
-        for wp in self.wordpair_set.filter(deleted=False):
+        for wp in self.wordpair_set.filter(deleted=False).order_by('id'):
             for direction in (1, 2):
                 is_due = is_word_due(wp.get_date(direction), user_time)
                 if word_list_type == 'normal':
@@ -630,16 +787,19 @@ class WDict(models.Model):
                     result.append((wp, direction))
         return result
 
-    def sort_words(self, words, order=None, word_list_type='normal'):
+    def sort_words(self, words, order=None, word_list_type='normal',
+                   context=None):
         # order = 'random' | 'zero_first' |
         #         ('dimness', dimness_day, dimness_direction)
         # dimness_day = 'today' | 'tomorrow'
         # dimness_direction = 'dimmer_first' | 'dimmer_last'
 
+        context = get_user_context(self.user, context)
+
         # Converting `order` to the format given above
         if order is None:
             if word_list_type == 'normal':
-                order = self.get_practice_word_order()
+                order = self.get_practice_word_order(context.ewuser)
                 if order in ('dimmer_first', 'dimmer_last'):
                     order = ('dimness', 'tomorrow', order)
             elif word_list_type == 'early':
@@ -681,10 +841,9 @@ class WDict(models.Model):
 
                 # Then sort by dimness
                 if dimness_day == 'today':
-                    dimness_day = get_today(self.user)
+                    dimness_day = context.today
                 elif dimness_day == 'tomorrow':
-                    dimness_day = get_today(self.user) + \
-                                      datetime.timedelta(days=1)
+                    dimness_day = context.today + datetime.timedelta(days=1)
                 else:
                     unexpected_value('dimness_day', dimness_day)
 
@@ -697,15 +856,19 @@ class WDict(models.Model):
         else:
             unexpected_value('order', order)
 
-    def get_practice_word_order(self):
+    def get_practice_word_order(self, ewuser=None):
         if self.practice_word_order == 'default':
-            return get_ewuser(self.user).practice_word_order
+            if ewuser is None:
+                ewuser = get_ewuser(self.user)
+            return ewuser.practice_word_order
         else:
             return self.practice_word_order
 
-    def get_strengthener_method(self):
+    def get_strengthener_method(self, ewuser=None):
         if self.strengthener_method == 'default':
-            return get_ewuser(self.user).strengthener_method
+            if ewuser is None:
+                ewuser = get_ewuser(self.user)
+            return ewuser.strengthener_method
         else:
             return self.strengthener_method
 
@@ -770,9 +933,63 @@ class WordPair(models.Model):
     # whether the word pair is deleted or not
     deleted = models.BooleanField(default=False)
 
-    def save(self):
+    def __init__(self, *args, **kwargs):
+        models.Model.__init__(self, *args, **kwargs)
+        # The indexed fields as they are in the search index, and the
+        # scheduling fields as they are in the database
+        self.indexed_fields = self.get_indexed_fields()
+        self.scheduling_fields = self.get_scheduling_fields()
+
+    def save(self, update_due_count=True):
+        """Saves the word pair.
+
+        If `update_due_count` is true and the word pair is created or one of
+        its scheduling fields has changed, the cached due counts and
+        forecasts of its dictionaries are invalidated and the practice queues
+        are updated. Callers that apply answers adjust the due count and the
+        forecast themselves and set it to false. The search index is updated
+        if an indexed field has changed.
+        """
         self.normalize()
-        return models.Model.save(self)
+        created = (self.id is None)
+        old_labels = self.indexed_fields[-1]
+        old_scheduling_fields = self.scheduling_fields
+        result = models.Model.save(self)
+        self.scheduling_fields = self.get_scheduling_fields()
+        if update_due_count and (created or
+                                 self.scheduling_fields !=
+                                 old_scheduling_fields):
+            wdict_ids = [self.wdict_id]
+            old_wdict_id = old_scheduling_fields[0]
+            if old_wdict_id not in (None, self.wdict_id):
+                wdict_ids.append(old_wdict_id)
+            invalidate_due_counts(wdict_ids)
+            invalidate_forecasts(wdict_ids)
+            update_practice_queues(self,
+                                   None if created else old_scheduling_fields)
+        if created or self.get_indexed_fields() != self.indexed_fields:
+            update_search_text(self, created)
+        if created or self.labels != old_labels:
+            update_word_pair_labels(self, created)
+        return result
+
+    def get_forecast_buckets(self):
+        """Returns the (strength, due_date) pairs of the two directions, which
+        are counted by the forecast."""
+        if self.deleted:
+            return []
+        return [(self.strength1, self.date1), (self.strength2, self.date2)]
+
+    def get_scheduling_fields(self):
+        """Returns the fields that determine when the word pair is asked,
+        i.e. the fields used by the due counts, forecasts and practice
+        queues."""
+        return (self.wdict_id, self.deleted, self.date1, self.date2,
+                self.strength1, self.strength2)
+
+    def get_indexed_fields(self):
+        return (self.word_in_lang1, self.word_in_lang2, self.explanation,
+                self.labels)
 
     def normalize(self):
         self.word_in_lang1 = self.word_in_lang1.strip()
@@ -785,12 +1002,7 @@ class WordPair(models.Model):
         add_space_count = (4 if field == 'explanation' else 0)
 
         if self.wdict.text_format == 'text':
-            text = getattr(self, field)
-            #text = remove_trailing_newline(text)
-            text = escape_html(text)
-            text = indent_html(text, add_space_count=add_space_count)
-            text = newline_to_br(text, keepend=False)
-            return text
+            return text_to_html(getattr(self, field), add_space_count)
 
         elif self.wdict.text_format == 'html':
             return simple_html_to_html(getattr(self, field),
@@ -830,10 +1042,11 @@ class WordPair(models.Model):
         else:
             self.date2 = value
 
-    def strengthen(self, direction, dry_run=False, day=None):
+    def strengthen(self, direction, dry_run=False, day=None, method=None):
         if day is None:
             day = get_today(self.wdict.user)
-        method = self.wdict.get_strengthener_method()
+        if method is None:
+            method = self.wdict.get_strengthener_method()
         date = self.get_date(direction)
         strength = self.get_strength(direction)
 
@@ -978,34 +1191,855 @@ class WordPair(models.Model):
                 self.prefix(self.word_in_lang2, WORD_PREFIX))
 
 
+def attach_wdicts(user, word_pairs):
+    """Sets the dictionary of the given word pairs of `user` using one query.
+
+    Afterwards wp.wdict and wp.wdict.user can be accessed without further
+    queries.
+
+    Returns: {wdict_id: WDict}
+    """
+
+    wdicts = WDict.objects.in_bulk(list(set(wp.wdict_id for wp in word_pairs)))
+    for wdict in wdicts.values():
+        wdict.user = user
+    for wp in word_pairs:
+        wp.wdict = wdicts[wp.wdict_id]
+    return wdicts
+
+
+##### Rendered HTML #####
+
+
+class RenderedHtml(models.Model):
+    """The HTML of a field of a word pair, as returned by WordPair.get_html.
+
+    The text format of the dictionary and the hash of the field are stored
+    with the HTML, so the HTML is used only if neither of them has changed
+    since it was rendered. (Saving a word pair with a modified field or
+    changing the text format of the dictionary therefore invalidates it.)
+    """
+
+    word_pair = models.ForeignKey(WordPair)
+    field = models.CharField(max_length=20)
+    text_format = models.CharField(max_length=20)
+    content_hash = models.CharField(max_length=40)
+    html = models.TextField()
+
+    class Meta:
+        unique_together = ('word_pair', 'field')
+
+    def __unicode__(self):
+        return '%s | %s | %s' % (self.word_pair_id, self.field,
+                                 self.text_format)
+
+    @staticmethod
+    def calc_hash(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class RenderedHtmlCache(object):
+    """Returns the HTML of the fields of a batch of word pairs.
+
+    The stored HTML of the word pairs is read when the object is created.
+    The HTML that had to be rendered is stored by `save`.
+    """
+
+    def __init__(self, word_pairs):
+        self.rows = {} # {(word_pair_id, field): RenderedHtml}
+        self.new_rows = {}
+        self.changed_rows = {}
+        word_pair_ids = list(set(wp.id for wp in word_pairs
+                                 if wp.id is not None))
+        for ids in split_to_chunks(word_pair_ids):
+            for row in RenderedHtml.objects.filter(word_pair__in=ids):
+                self.rows[(row.word_pair_id, row.field)] = row
+
+    def get_html(self, wp, field):
+        text_format = wp.wdict.text_format
+        content_hash = RenderedHtml.calc_hash(getattr(wp, field))
+        key = (wp.id, field)
+        row = self.rows.get(key)
+        if (row is not None and
+            row.text_format == text_format and
+            row.content_hash == content_hash):
+            return row.html
+
+        html = wp.get_html(field)
+        if wp.id is not None:
+            if row is None:
+                row = RenderedHtml(word_pair_id=wp.id, field=field)
+                self.new_rows[key] = row
+            elif row.id is not None:
+                self.changed_rows[key] = row
+            row.text_format = text_format
+            row.content_hash = content_hash
+            row.html = html
+            self.rows[key] = row
+        return html
+
+    def save(self):
+        """Stores the rendered HTML with at most two queries."""
+
+        if not self.new_rows and not self.changed_rows:
+            return
+
+        table = RenderedHtml._meta.db_table
+        try:
+            with transaction.commit_on_success():
+                cursor = connection.cursor()
+                if self.new_rows:
+                    cursor.executemany(
+                        'INSERT INTO ' + table + ' (word_pair_id, field, '
+                        'text_format, content_hash, html) '
+                        'VALUES (%s, %s, %s, %s, %s)',
+                        [(row.word_pair_id, row.field, row.text_format,
+                          row.content_hash, row.html)
+                         for row in self.new_rows.values()])
+                if self.changed_rows:
+                    cursor.executemany(
+                        'UPDATE ' + table + ' SET text_format = %s, '
+                        'content_hash = %s, html = %s WHERE id = %s',
+                        [(row.text_format, row.content_hash, row.html,
+                          row.id)
+                         for row in self.changed_rows.values()])
+                transaction.set_dirty()
+        except django.db.IntegrityError:
+            # Another request has stored the HTML of some of these word
+            # pairs in the meantime; their HTML will be stored next time.
+            pass
+        self.new_rows = {}
+        self.changed_rows = {}
+
+
+##### Due counts #####
+
+
+class DueCount(models.Model):
+    """The number of questions due in a dictionary on a given day, i.e. the
+    length of WDict.get_words_to_practice_today() on that day.
+
+    The functions that modify word pairs either adjust the count or delete
+    the row. A row that belongs to another day is recalculated when it is
+    read, so the counts are reset when the turning point of the user passes.
+    """
+
+    wdict = models.OneToOneField(WDict, primary_key=True)
+    day = models.DateField()
+    count = models.IntegerField()
+
+    def __unicode__(self):
+        return '%s | %s | %s' % (self.wdict_id, self.day, self.count)
+
+
+def calc_due_counts(wdict_ids, today):
+    """Calculates the due counts of the given dictionaries in the database.
+
+    Returns: {wdict_id: due_count}
+    """
+
+    due_counts = dict((wdict_id, 0) for wdict_id in wdict_ids)
+    for date_field in ('date1', 'date2'):
+        filter_args = {'wdict__in': wdict_ids,
+                       'deleted': False,
+                       date_field + '__lte': today}
+        rows = (WordPair.objects.filter(**filter_args).
+                                 values('wdict').
+                                 annotate(count=Count('id')))
+        for row in rows:
+            due_counts[row['wdict']] += row['count']
+    return due_counts
+
+
+def get_due_counts(user, wdicts, today=None):
+    """Returns the number of questions due today in the given dictionaries.
+
+    The number of queries does not depend on the size of the dictionaries:
+    the stored counts are read with one query, and the missing or outdated
+    ones are recalculated together.
+
+    Returns: {wdict_id: due_count}
+    """
+
+    if today is None:
+        today = get_today(user)
+    wdict_ids = [wdict.id for wdict in wdicts]
+
+    due_counts = {}
+    for due_count in DueCount.objects.filter(wdict__in=wdict_ids, day=today):
+        due_counts[due_count.wdict_id] = due_count.count
+
+    missing_wdict_ids = [wdict_id for wdict_id in wdict_ids
+                         if wdict_id not in due_counts]
+    if missing_wdict_ids:
+        calculated_due_counts = calc_due_counts(missing_wdict_ids, today)
+        for wdict_id, count in calculated_due_counts.items():
+            DueCount(wdict_id=wdict_id, day=today, count=count).save()
+        due_counts.update(calculated_due_counts)
+
+    return due_counts
+
+
+def adjust_due_count(wdict_id, today, delta):
+    """Adds `delta` to the due count of a dictionary if it is stored for
+    `today`."""
+    if delta != 0:
+        DueCount.objects.filter(wdict=wdict_id, day=today).\
+                         update(count=F('count') + delta)
+
+
+def invalidate_due_counts(wdict_ids):
+    DueCount.objects.filter(wdict__in=wdict_ids).delete()
+
+
+##### Practice queues #####
+
+
+class PracticeQueue(models.Model):
+    """The words of a dictionary to be practiced on a day, in the order in
+    which they are asked.
+
+    The queue is built when the practice page of the dictionary is opened the
+    first time on the day, and it is sent to the page in batches (see
+    get_practice_batch). The words that do not need to be practiced any more
+    (e.g. because they have been answered) are skipped when a batch is
+    collected; the items before `first` are known to be such words. Saving
+    a word pair appends its directions that need to be practiced (see
+    update_practice_queues); the bulk operations delete the queues of their
+    dictionaries.
+
+    `items` is a JSON list of [word_pair_id, direction] items.
+
+    `early_count` is the number of words in an "early" queue that are not
+    due today and still need to be practiced. It is adjusted on answers
+    (see adjust_early_count), like the due count of the dictionary.
+    """
+
+    wdict = models.ForeignKey(WDict)
+    word_list_type = models.CharField(max_length=10)
+    day = models.DateField()
+    items = models.TextField()
+    first = models.IntegerField(default=0)
+    early_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('wdict', 'word_list_type')
+
+    def __unicode__(self):
+        return '%s | %s | %s' % (self.wdict_id, self.word_list_type,
+                                 self.day)
+
+    def get_items(self):
+        return json.loads(self.items)
+
+    def set_items(self, items):
+        self.items = json.dumps(items)
+
+    def get_remaining_count(self, context=None):
+        """Returns the number of words of the queue that still need to be
+        practiced today.
+
+        The due words are counted by the due count of the dictionary, so the
+        items of the queue are not read.
+        """
+
+        wdict = self.wdict
+        today = get_user_context(wdict.user, context).today
+        count = get_due_counts(wdict.user, [wdict], today)[wdict.id]
+        if self.word_list_type == 'early':
+            count += self.early_count
+        return count
+
+
+def get_practice_queue(wdict, word_list_type, context=None):
+    """Returns the practice queue of the dictionary for today, building it if
+    it does not exist yet."""
+
+    today = get_user_context(wdict.user, context).today
+    try:
+        queue = PracticeQueue.objects.get(wdict=wdict,
+                                          word_list_type=word_list_type,
+                                          day=today)
+        queue.wdict = wdict
+        return queue
+    except PracticeQueue.DoesNotExist:
+        pass
+
+    words = wdict.get_words_to_practice_today(word_list_type=word_list_type,
+                                              context=context)
+    wdict.sort_words(words, word_list_type=word_list_type, context=context)
+    queue = PracticeQueue(wdict=wdict, word_list_type=word_list_type,
+                          day=today)
+    queue.set_items([(wp.id, direction) for wp, direction in words])
+    if word_list_type == 'early':
+        queue.early_count = len([1 for wp, direction in words
+                                 if wp.get_date(direction) > today])
+    try:
+        with transaction.commit_on_success():
+            PracticeQueue.objects.filter(
+                wdict=wdict, word_list_type=word_list_type).delete()
+            queue.save()
+    except django.db.IntegrityError:
+        # Another request has built the queue in the meantime
+        queue = PracticeQueue.objects.get(wdict=wdict,
+                                          word_list_type=word_list_type)
+        queue.wdict = wdict
+    return queue
+
+
+def get_practice_batch(queue, cursor, batch_size, context=None):
+    """Returns the next words of the practice queue from the `cursor`
+    position that still need to be practiced.
+
+    Returns: [(word pair, direction)], next_cursor
+    `next_cursor` is None if there are no more words in the queue.
+    """
+
+    wdict = queue.wdict
+    today = get_user_context(wdict.user, context).today
+    items = queue.get_items()
+    position = max(cursor, queue.first)
+    first = queue.first
+    words = []
+    while position < len(items) and len(words) < batch_size:
+        chunk = items[position:position + batch_size - len(words)]
+        word_pairs = (wdict.wordpair_set.filter(deleted=False).
+                      in_bulk([item[0] for item in chunk]))
+        for word_pair_id, direction in chunk:
+            wp = word_pairs.get(word_pair_id)
+            if (wp is not None and
+                wdict.is_word_to_practice(wp, direction, queue.word_list_type,
+                                          today)):
+                words.append((wp, direction))
+            elif position == first:
+                first += 1
+            position += 1
+
+    if first != queue.first:
+        PracticeQueue.objects.filter(id=queue.id).update(first=first)
+        queue.first = first
+
+    if position == len(items):
+        position = None
+    return words, position
+
+
+def adjust_early_count(wdict_id, today, delta):
+    """Adds `delta` to the early count of the "early" queue of a dictionary if
+    it is built for `today`."""
+    if delta != 0:
+        PracticeQueue.objects.filter(wdict=wdict_id, word_list_type='early',
+                                     day=today).\
+                              update(early_count=F('early_count') + delta)
+
+
+def update_practice_queues(wp, old_scheduling_fields):
+    """Updates the practice queues of the dictionaries of a word pair after
+    it is created or its scheduling fields are modified.
+
+    The queues are not rebuilt, because the practice pages read them by
+    position (see get_practice_batch). The directions that did not need to be
+    practiced before the modification and need to be practiced after it are
+    appended to the queues. The items that do not need to be practiced any
+    more are skipped when they are read.
+
+    `old_scheduling_fields` is the result of wp.get_scheduling_fields before
+    the modification, or None if the word pair is new.
+    """
+
+    if old_scheduling_fields is None:
+        old_wp = None
+        wdict_ids = [wp.wdict_id]
+    else:
+        wdict_id, deleted, date1, date2, strength1, strength2 = \
+            old_scheduling_fields
+        old_wp = WordPair(id=wp.id, wdict_id=wdict_id, deleted=deleted,
+                          date1=date1, date2=date2, strength1=strength1,
+                          strength2=strength2)
+        wdict_ids = list(set([wdict_id, wp.wdict_id]))
+
+    def get_state(wp, queue, direction):
+        # Returns whether the direction is in the queue and whether it is
+        # counted by the early count
+        if wp is None or wp.deleted or wp.wdict_id != queue.wdict_id:
+            return False, False
+        wdict = queue.wdict
+        is_needed = wdict.is_word_to_practice(wp, direction,
+                                              queue.word_list_type, queue.day)
+        return (is_needed,
+                is_needed and queue.word_list_type == 'early' and
+                wdict.is_word_to_practice_early(wp, direction, queue.day))
+
+    for queue in PracticeQueue.objects.filter(wdict__in=wdict_ids):
+        new_items = []
+        early_delta = 0
+        for direction in (1, 2):
+            old_needed, old_early = get_state(old_wp, queue, direction)
+            new_needed, new_early = get_state(wp, queue, direction)
+            if new_needed and not old_needed:
+                new_items.append([wp.id, direction])
+            early_delta += int(new_early) - int(old_early)
+        if new_items or early_delta:
+            PracticeQueue.objects.filter(id=queue.id).update(
+                items=json.dumps(queue.get_items() + new_items),
+                early_count=F('early_count') + early_delta)
+
+
+def invalidate_practice_queues(wdict_ids):
+    PracticeQueue.objects.filter(wdict__in=wdict_ids).delete()
+
+
+# Each packed item is a little-endian unsigned 64-bit integer, so the packed
+# strings are the same on every platform
+PACKED_ITEM_FORMAT = '<%dQ'
+PACKED_ITEM_SIZE = struct.calcsize(PACKED_ITEM_FORMAT % 1)
+
+
+def pack_words_to_practice(items):
+    """Encodes (word_pair_id, direction) items into a compact string that can
+    be stored in the session.
+
+    Each item is stored as one unsigned integer: 2 * word_pair_id + direction
+    - 1.
+    """
+
+    codes = [2 * word_pair_id + direction - 1
+             for word_pair_id, direction in items]
+    return struct.pack(PACKED_ITEM_FORMAT % len(codes), *codes)
+
+
+def unpack_words_to_practice(packed, start=0, stop=None):
+    """Decodes the items from `start` to `stop` of a string created by
+    pack_words_to_practice.
+
+    Only the requested items are decoded.
+
+    Returns: [(word_pair_id, direction)]
+    """
+
+    start, stop, step = \
+        slice(start, stop).indices(get_packed_word_count(packed))
+    codes = struct.unpack_from(PACKED_ITEM_FORMAT % max(stop - start, 0),
+                               packed, start * PACKED_ITEM_SIZE)
+    return [(code // 2, code % 2 + 1) for code in codes]
+
+
+def get_packed_word_count(packed):
+    return len(packed) // PACKED_ITEM_SIZE
+
+
+##### Search index #####
+
+
+class SearchText(models.Model):
+    """The accent-folded text of a word pair that is searched by the search
+    page.
+
+    The date and strength fields are searched in the word pair table, and the
+    labels have their own table (WordPairLabel), so only editing the text
+    fields or the labels of a word pair modifies the index.
+    """
+
+    word_pair = models.OneToOneField(WordPair, primary_key=True)
+
+    # the normalized text fields and labels, separated by newlines
+    text = models.TextField()
+
+    def __unicode__(self):
+        return unicode(self.word_pair_id)
+
+    @staticmethod
+    def calc_text(wp):
+        return '\n'.join(normalize_string(unicode(field))
+                         for field in wp.get_indexed_fields())
+
+
+def update_search_text(wp, created=False):
+    text = SearchText.calc_text(wp)
+    if (created or
+        SearchText.objects.filter(word_pair=wp.id).update(text=text) == 0):
+        SearchText(word_pair_id=wp.id, text=text).save(force_insert=True)
+    wp.indexed_fields = wp.get_indexed_fields()
+
+
+def insert_rows(table, columns, rows):
+    """Inserts rows into a table in one transaction.
+
+    Returns False if the rows could not be inserted because some of them
+    violate a uniqueness constraint.
+    """
+
+    sql = ('INSERT INTO ' + table + ' (' + ', '.join(columns) + ') '
+           'VALUES (' + ', '.join(['%s'] * len(columns)) + ')')
+    try:
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            for chunk in split_to_chunks(rows):
+                cursor.executemany(sql, chunk)
+            transaction.set_dirty()
+    except django.db.IntegrityError:
+        return False
+    return True
+
+
+def index_word_pairs(word_pairs):
+    """Adds the word pairs of the given queryset that are missing from the
+    search index and the label index to these indexes.
+
+    The word pairs are indexed when they are saved or imported, so this
+    function is only needed for the word pairs that were saved before the
+    indexes were introduced (see the ew_index_word_pairs command).
+    """
+
+    # If an insert fails, another request has indexed some of these word
+    # pairs in the meantime.
+
+    unindexed_word_pairs = word_pairs.filter(searchtext__isnull=True)
+    if unindexed_word_pairs.exists():
+        insert_rows(SearchText._meta.db_table, ('word_pair_id', 'text'),
+                    [(wp.id, SearchText.calc_text(wp))
+                     for wp in unindexed_word_pairs])
+
+    unindexed_word_pairs = (word_pairs.exclude(labels='').
+                                       filter(wordpairlabel__isnull=True))
+    if unindexed_word_pairs.exists():
+        insert_rows(WordPairLabel._meta.db_table,
+                    ('word_pair_id', 'label', 'normalized_label'),
+                    [(wp.id, label, normalize_string(label))
+                     for wp in unindexed_word_pairs
+                     for label in wp.get_label_set()])
+
+
+def search_word_pairs(word_pairs, query_label, query_text):
+    """Returns the word pairs of the given queryset that match the query of
+    the search page.
+
+    `query_label` is a label that the word pairs must have. `query_text`
+    contains words that must all be found in the word pairs; "label:x" is
+    found if "x" is part of a label.
+    """
+
+    # The conditions are passed to one "filter" call so that the index table
+    # is joined only once. The labels are looked up in subqueries, because a
+    # word pair may have several labels.
+    conditions = []
+    if query_label is not None:
+        conditions.append(
+            Q(id__in=WordPairLabel.objects.filter(label=query_label).
+                                           values('word_pair')))
+
+    for query_word in query_text.split():
+        query_word = normalize_string(query_word)
+        if query_word == 'label:':
+            # Every word pair matches an empty label expression
+            continue
+        elif query_word.startswith('label:'):
+            conditions.append(
+                Q(id__in=WordPairLabel.objects.
+                             filter(normalized_label__contains=query_word[6:]).
+                             values('word_pair')))
+        else:
+            q = Q(searchtext__text__contains=query_word)
+            for field in ('date_added', 'date1', 'date2',
+                          'strength1', 'strength2'):
+                q |= Q(**{field + '__contains': query_word})
+            conditions.append(q)
+
+    return word_pairs.filter(*conditions).order_by('id')
+
+
+##### Labels #####
+
+
+class WordPairLabel(models.Model):
+    """A label of a word pair.
+
+    The rows are derived from WordPair.labels when a word pair is saved, and
+    they are used for listing and filtering the labels of a user.
+    """
+
+    word_pair = models.ForeignKey(WordPair)
+    label = models.CharField(max_length=255, db_index=True)
+
+    # the accent-folded label, used by the "label:" search expressions
+    normalized_label = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('word_pair', 'label')
+
+    def __unicode__(self):
+        return '%s | %s' % (self.word_pair_id, self.label)
+
+
+def update_word_pair_labels(wp, created=False):
+    """Stores the labels of the word pair in the label index."""
+    table = WordPairLabel._meta.db_table
+    cursor = connection.cursor()
+    if not created:
+        cursor.execute('DELETE FROM ' + table + ' WHERE word_pair_id = %s',
+                       [wp.id])
+    labels = sorted(wp.get_label_set())
+    if labels:
+        cursor.executemany(
+            'INSERT INTO ' + table + ' (word_pair_id, label, '
+            'normalized_label) VALUES (%s, %s, %s)',
+            [(wp.id, label, normalize_string(label)) for label in labels])
+    transaction.commit_unless_managed()
+
+
+def get_label_counts(user, prefix=''):
+    """Returns the labels of the user's word pairs that start with `prefix`.
+
+    Returns: [(label, word_pair_count)], sorted by label
+    """
+
+    rows = WordPairLabel.objects.filter(word_pair__wdict__user=user,
+                                        word_pair__wdict__deleted=False,
+                                        word_pair__deleted=False)
+    if prefix:
+        rows = rows.filter(label__startswith=prefix)
+    rows = rows.values('label').annotate(count=Count('id')).order_by('label')
+    return [(row['label'], row['count']) for row in rows]
+
+
+##### Operations on word pairs #####
+
+
+def iter_word_pairs_by_ids(word_pair_ids):
+    """Yields the word pairs with the given ids in the order of the ids.
+
+    The word pairs are read in chunks.
+    """
+
+    for chunk in split_to_chunks(word_pair_ids):
+        word_pairs = WordPair.objects.in_bulk(chunk)
+        for word_pair_id in chunk:
+            if word_pair_id in word_pairs:
+                yield word_pairs[word_pair_id]
+
+
+def get_wdict_ids_of_word_pairs(word_pair_ids):
+    wdict_ids = set()
+    for chunk in split_to_chunks(word_pair_ids):
+        wdict_ids.update(WordPair.objects.filter(id__in=chunk).
+                                          values_list('wdict', flat=True).
+                                          distinct())
+    return wdict_ids
+
+
+def update_word_pairs(word_pair_ids, values, condition=None):
+    """Sets the fields of the given word pairs in one transaction.
+
+    The fields are set by an UPDATE statement for each chunk of the word
+    pairs. `values` is a dictionary like the keyword arguments of
+    QuerySet.update, and `condition` is an optional Q object that further
+    restricts the updated word pairs. `values` and `condition` may also be
+    lists, in which case an UPDATE statement is executed for each pair of
+    them. The fields must not be indexed by the search or label index.
+
+    The due counts, forecasts and practice queues of the dictionaries of the
+    word pairs (and of the new dictionary, if the word pairs are moved) are
+    invalidated.
+    """
+
+    if isinstance(values, dict):
+        values = [values]
+        condition = [condition]
+
+    wdict_ids = get_wdict_ids_of_word_pairs(word_pair_ids)
+    for values_item in values:
+        if 'wdict' in values_item:
+            wdict_ids.add(values_item['wdict'].id)
+
+    with transaction.commit_on_success():
+        for chunk in split_to_chunks(word_pair_ids):
+            for values_item, condition_item in zip(values, condition):
+                if not values_item:
+                    continue
+                word_pairs = WordPair.objects.filter(id__in=chunk)
+                if condition_item is not None:
+                    word_pairs = word_pairs.filter(condition_item)
+                word_pairs.update(**values_item)
+
+    invalidate_due_counts(wdict_ids)
+    invalidate_forecasts(wdict_ids)
+    invalidate_practice_queues(wdict_ids)
+
+
+def shift_word_pair_dates(word_pair_ids, days):
+    """Shifts the dates of both directions of the given word pairs by `days`
+    (a timedelta).
+
+    A date is not shifted if it would get past datetime.date.max.
+    """
+
+    values = []
+    conditions = []
+    for date_field in ('date1', 'date2'):
+        try:
+            last_date = datetime.date.max - days
+        except OverflowError:
+            if days > datetime.timedelta(0):
+                # No date can be shifted this much
+                continue
+            condition = None
+        else:
+            condition = Q(**{date_field + '__lt': last_date})
+        values.append({date_field: F(date_field) + days})
+        conditions.append(condition)
+    update_word_pairs(word_pair_ids, values, conditions)
+
+
+def update_word_pair_labels_in_bulk(word_pair_ids, method, labels):
+    """Modifies the labels of the given word pairs.
+
+    `method` is the name of the WordPair method that modifies the labels
+    ('add_labels', 'remove_labels' or 'set_labels'), and it is called with
+    `labels`. The modified labels, the search index and the label index are
+    written in one transaction with a few statements for each chunk of the
+    word pairs.
+    """
+
+    wp_table = connection.ops.quote_name(WordPair._meta.db_table)
+    st_table = connection.ops.quote_name(SearchText._meta.db_table)
+    wpl_table = connection.ops.quote_name(WordPairLabel._meta.db_table)
+
+    with transaction.commit_on_success():
+        cursor = connection.cursor()
+        for chunk in split_to_chunks(word_pair_ids):
+            changed_word_pairs = []
+            for wp in WordPair.objects.filter(id__in=chunk):
+                old_labels = wp.labels
+                getattr(wp, method)(labels)
+                if wp.labels != old_labels:
+                    changed_word_pairs.append(wp)
+            if not changed_word_pairs:
+                continue
+
+            cursor.executemany(
+                'UPDATE ' + wp_table + ' SET labels = %s WHERE id = %s',
+                [(wp.labels, wp.id) for wp in changed_word_pairs])
+
+            cursor.executemany(
+                'UPDATE ' + st_table + ' SET text = %s '
+                'WHERE word_pair_id = %s',
+                [(SearchText.calc_text(wp), wp.id)
+                 for wp in changed_word_pairs])
+
+            cursor.execute(
+                'DELETE FROM ' + wpl_table + ' WHERE word_pair_id IN (' +
+                ', '.join(['%s'] * len(changed_word_pairs)) + ')',
+                [wp.id for wp in changed_word_pairs])
+            rows = [(wp.id, label, normalize_string(label))
+                    for wp in changed_word_pairs
+                    for label in sorted(wp.get_label_set())]
+            if rows:
+                cursor.executemany(
+                    'INSERT INTO ' + wpl_table + ' (word_pair_id, label, '
+                    'normalized_label) VALUES (%s, %s, %s)',
+                    rows)
+        transaction.set_dirty()
+
+
 ##### Importing and exporting word pairs #####
 
 
 def create_add_word_pairs(wdict, word_pairs):
-    for wp in word_pairs:
-        wdict.wordpair_set.add(wp)
-        wp.save()
-        wdict.save()
+    """Adds new word pairs to a dictionary.
 
+    The word pairs are inserted in chunks in one transaction, together with
+    their rows in the search and label indexes. The ids of the word pairs are
+    set.
 
-def import_textfile(s, wdict):
-    """Adds words from a text file to a dictionary.
+    Returns the number of word pairs added.
+    """
+
+    wp_table = connection.ops.quote_name(WordPair._meta.db_table)
+    st_table = connection.ops.quote_name(SearchText._meta.db_table)
+    wpl_table = connection.ops.quote_name(WordPairLabel._meta.db_table)
+    fields = [field for field in WordPair._meta.local_fields
+              if not field.primary_key]
+    sql = ('INSERT INTO ' + wp_table + ' (' +
+           ', '.join(connection.ops.quote_name(field.column)
+                     for field in fields) + ') '
+           'VALUES (' + ', '.join(['%s'] * len(fields)) + ')')
+
+    with transaction.commit_on_success():
+        cursor = connection.cursor()
+        for chunk in split_to_chunks(word_pairs):
+            search_rows = []
+            label_rows = []
+            for wp in chunk:
+                wp.wdict = wdict
+                wp.normalize()
+                # The word pairs are inserted one by one to get their ids
+                cursor.execute(
+                    sql,
+                    [field.get_db_prep_save(field.pre_save(wp, True),
+                                            connection=connection)
+                     for field in fields])
+                wp.id = connection.ops.last_insert_id(
+                            cursor, WordPair._meta.db_table,
+                            WordPair._meta.pk.column)
+                wp.indexed_fields = wp.get_indexed_fields()
+                wp.scheduling_fields = wp.get_scheduling_fields()
+                search_rows.append((wp.id, SearchText.calc_text(wp)))
+                label_rows.extend((wp.id, label, normalize_string(label))
+                                  for label in sorted(wp.get_label_set()))
+            cursor.executemany(
+                'INSERT INTO ' + st_table + ' (word_pair_id, text) '
+                'VALUES (%s, %s)',
+                search_rows)
+            if label_rows:
+                cursor.executemany(
+                    'INSERT INTO ' + wpl_table + ' (word_pair_id, label, '
+                    'normalized_label) VALUES (%s, %s, %s)',
+                    label_rows)
+        transaction.set_dirty()
+
+    invalidate_due_counts([wdict.id])
+    invalidate_forecasts([wdict.id])
+    invalidate_practice_queues([wdict.id])
+    return len(word_pairs)
+
+
+TEXTFILE_STRENGTH_DATE_REGEXP = r'<(-?\d+) +(\d\d\d\d)-(\d\d)-(\d\d)>'
+TEXTFILE_LINE_REGEXP = re.compile(r'^(\{(\d+)\})? *(.*?) -- (.*?)' +
+                                  '( ' + TEXTFILE_STRENGTH_DATE_REGEXP * 2 +
+                                  ')?' + '$')
+
+# Number of word pairs inserted in one transaction by import_lines
+IMPORT_BATCH_SIZE = 1000
+
+
+def new_imported_word_pair(today, labels):
+    wp = WordPair()
+    wp.date_added = today
+    wp.date1 = today
+    wp.date2 = today
+    wp.labels = labels
+    return wp
+
+
+def parse_textfile(lines, today, labels=''):
+    """Parses the lines of a text file of word pairs.
 
     Arguments:
-    - s (str)
-    - wdict (WDict)
+    - lines (iterable of unicode)
+    - today (datetime.date)
+    - labels (str) -- labels to be added to the word pairs
+
+    Yields: WordPair -- the word pairs (not saved)
     """
 
-    user = wdict.user
-    i = 1
-    word_pairs = []
-    for line in s.splitlines():
+    wp = None
+    for i, line in enumerate(lines, 1):
         line = line.rstrip()
         if (line == '') or (line[0] == ' '):
             # This line is part of an explanation.
-            if len(word_pairs) != 0:
+            if wp is not None:
                 line = re.sub('^ {1,4}', '', line) # removing prefix spaces
-                word_pairs[-1].explanation += line + '\n'
+                wp.explanation += line + '\n'
             elif line == '':
                 pass
             else:
@@ -1015,24 +2049,19 @@ def import_textfile(s, wdict):
                 raise EWException(msg)
         else:
             # This line contains a word pair.
-            strength_date_regexp = '<(-?\d+) +(\d\d\d\d)-(\d\d)-(\d\d)>'
-            regexp = (r'^(\{(\d+)\})? *(.*?) -- (.*?)' +
-                      '( ' + strength_date_regexp * 2 + ')?' +
-                      '$')
-            r = re.search(regexp, line)
+            r = TEXTFILE_LINE_REGEXP.search(line)
             if r is None:
                 msg = (_('Line %(linenumber)s is incorrect: %(line)s') %
                        {'linenumber': i, 'line': line})
                 raise EWException(msg)
 
-            wp = WordPair()
-            word_pairs.append(wp)
-
+            if wp is not None:
+                yield wp
+            wp = new_imported_word_pair(today, labels)
             wp.word_in_lang1 = r.group(3)
             wp.word_in_lang2 = r.group(4)
             wp.explanation = ''
             if r.group(5) is not None:
-                wp.date_added = get_today(user)
                 wp.date1 = datetime.date(int(r.group(7)),
                                          int(r.group(8)),
                                          int(r.group(9)))
@@ -1041,57 +2070,186 @@ def import_textfile(s, wdict):
                                          int(r.group(13)))
                 wp.strength1 = int(r.group(6))
                 wp.strength2 = int(r.group(10))
-            else:
-                wp.date_added = get_today(user)
-                wp.date1 = get_today(user)
-                wp.date2 = get_today(user)
-                wp.strength1 = 0
-                wp.strength2 = 0
 
-        i += 1
+    if wp is not None:
+        yield wp
 
-    create_add_word_pairs(wdict, word_pairs)
-    return word_pairs
 
+def create_word_pair_from_fields(fields, i, line, today, labels):
+    """Creates a word pair from the fields of a TSV or CSV line."""
+    if len(fields) < 2:
+        msg = (_('Not enough fields in line %(linenumber)s: %(line)s') %
+               {'linenumber': i, 'line': line})
+        raise EWException(msg)
+    elif len(fields) > 3:
+        msg = (_('Too many fields in line %(linenumber)s: %(line)s') %
+               {'linenumber': i, 'line': line})
+        raise EWException(msg)
+    wp = new_imported_word_pair(today, labels)
+    wp.word_in_lang1 = fields[0]
+    wp.word_in_lang2 = fields[1]
+    if len(fields) == 3:
+        wp.explanation = fields[2]
+    return wp
 
-def import_tsv(s, wdict):
-    """Adds words from a text of tab-separeted values to a dictionary.
 
-    Arguments:
-    - s (str)
-    - wdict (WDict)
+def parse_tsv(lines, today, labels=''):
+    """Parses the lines of a text of tab-separated values.
+
+    The arguments and the yielded values are the same as in parse_textfile.
     """
 
-    user = wdict.user
-    i = 1
-    word_pairs = []
-    for line in s.splitlines():
+    for i, line in enumerate(lines, 1):
         line = line.strip()
         if (line == ''):
             continue
+        yield create_word_pair_from_fields(line.split('\t'), i, line, today,
+                                           labels)
 
-        fields = line.split('\t')
-        if len(fields) < 2:
-            msg = (_('Not enough fields in line %(linenumber)s: %(line)s') %
-                   {'linenumber': i, 'line': line})
+
+def parse_csv(lines, today, labels=''):
+    """Parses the lines of a CSV file.
+
+    Each record should contain two or three fields, like the lines of the
+    TSV format. The arguments and the yielded values are the same as in
+    parse_textfile.
+    """
+
+    reader = csv.reader(line.encode('utf-8') for line in lines)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            break
+        except csv.Error, e:
+            msg = (_('Line %(linenumber)s is incorrect: %(line)s') %
+                   {'linenumber': reader.line_num, 'line': unicode(e)})
             raise EWException(msg)
-        elif 2 <= len(fields) <= 3:
-            wp = WordPair()
-            wp.word_in_lang1 = fields[0]
-            wp.word_in_lang2 = fields[1]
-            if len(fields) == 3:
-                wp.explanation = fields[2]
-            wp.date1 = get_today(user)
-            wp.date2 = get_today(user)
-            wp.date_added = get_today(user)
-            word_pairs.append(wp)
-        else:
-            msg = (_('Too many fields in line %(linenumber)s: %(line)s') %
+        fields = [field.decode('utf-8') for field in row]
+        if fields == [] or fields == ['']:
+            continue
+        yield create_word_pair_from_fields(fields, reader.line_num,
+                                           ','.join(fields), today, labels)
+
+
+def parse_json_lines(lines, today, labels=''):
+    """Parses a file with one JSON object per line.
+
+    Example line:
+
+        {"word_in_lang1": "die Katze", "word_in_lang2": "cat",
+         "explanation": "Plural: die Katzen.", "labels": "noun"}
+
+    The "explanation" and "labels" attributes are optional. The labels of a
+    line are added to `labels`. The arguments and the yielded values are the
+    same as in parse_textfile.
+    """
+
+    for i, line in enumerate(lines, 1):
+        line = line.strip()
+        if (line == ''):
+            continue
+        try:
+            obj = json.loads(line)
+            fields = (obj['word_in_lang1'], obj['word_in_lang2'],
+                      obj.get('explanation', ''), obj.get('labels', ''))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            fields = None
+        if (fields is None or
+            not all(isinstance(field, basestring) for field in fields)):
+            msg = (_('Line %(linenumber)s is incorrect: %(line)s') %
                    {'linenumber': i, 'line': line})
             raise EWException(msg)
+        wp = new_imported_word_pair(today, labels)
+        wp.word_in_lang1, wp.word_in_lang2, wp.explanation, line_labels = \
+            fields
+        wp.add_labels(line_labels)
+        yield wp
+
+
+def decode_lines(f):
+    """Yields the lines of a UTF-8 encoded file as unicode strings."""
+    for i, line in enumerate(f, 1):
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            msg = (_('Line %(linenumber)s is not valid UTF-8 text.') %
+                   {'linenumber': i})
+            raise EWException(msg)
+        if i == 1:
+            line = line.lstrip(u'\ufeff') # byte order mark
+        yield line
+
+
+def import_lines(lines, wdict, parse_fun, labels=''):
+    """Adds the word pairs parsed from `lines` to a dictionary.
+
+    The lines are parsed while they are read and the word pairs are inserted
+    in batches of IMPORT_BATCH_SIZE, each in its own transaction. If a line
+    is incorrect, the word pairs of the previous batches stay in the
+    dictionary, and the message of the raised exception tells how many of
+    them were added.
+
+    Arguments:
+    - lines (iterable of unicode)
+    - wdict (WDict)
+    - parse_fun (fun(lines, today, labels)) -- e.g. parse_textfile
+    - labels (str) -- labels to be added to the word pairs
+
+    Returns: int -- the number of word pairs added
+    """
+
+    today = get_today(wdict.user)
+    count = 0
+    batch = []
+    try:
+        for wp in parse_fun(lines, today, labels):
+            batch.append(wp)
+            if len(batch) == IMPORT_BATCH_SIZE:
+                count += create_add_word_pairs(wdict, batch)
+                batch = []
+    except EWException, e:
+        if count == 0:
+            raise
+        msg = (_('%(error)s (%(count)s word pairs were added before this '
+                 'line.)') %
+               {'error': unicode(e), 'count': count})
+        raise EWException(msg)
+    if batch:
+        count += create_add_word_pairs(wdict, batch)
+    return count
+
+
+def import_textfile(s, wdict, labels=''):
+    """Adds words from a text file to a dictionary.
+
+    Arguments:
+    - s (str)
+    - wdict (WDict)
+    - labels (str) -- labels to be added to the word pairs
+
+    Returns: [WordPair] -- the word pairs added
+    """
+
+    word_pairs = list(parse_textfile(s.splitlines(), get_today(wdict.user),
+                                     labels))
+    create_add_word_pairs(wdict, word_pairs)
+    return word_pairs
+
+
+def import_tsv(s, wdict, labels=''):
+    """Adds words from a text of tab-separeted values to a dictionary.
 
-        i += 1
+    Arguments:
+    - s (str)
+    - wdict (WDict)
+    - labels (str) -- labels to be added to the word pairs
+
+    Returns: [WordPair] -- the word pairs added
+    """
 
+    word_pairs = list(parse_tsv(s.splitlines(), get_today(wdict.user),
+                                labels))
     create_add_word_pairs(wdict, word_pairs)
     return word_pairs
 
@@ -1111,8 +2269,19 @@ def export_textfile(wdict=None, word_pairs=None):
     elif wdict is not None:
         word_pairs = wdict.wordpair_set.filter(deleted=False)
 
+    return ''.join(iter_export_textfile(word_pairs))
+
+
+def iter_export_textfile(word_pairs, chunk_size=100):
+    """Prints word pairs in the old text format.
+
+    The text is yielded in chunks that contain `chunk_size` word pairs, so
+    the word pairs can be read from an iterator and the text can be sent to
+    the client while it is generated.
+    """
+
     result = []
-    for wp in word_pairs:
+    for i, wp in enumerate(word_pairs):
         result.append(
             '%s -- %s <%s %s><%s %s>\n' %
             (wp.word_in_lang1.replace('\n', ' ').replace('\r', ' '),
@@ -1126,7 +2295,11 @@ def export_textfile(wdict=None, word_pairs=None):
                 result.append('    ')
                 result.append(expl_line)
             result.append('\n')
-    return ''.join(result)
+        if (i + 1) % chunk_size == 0:
+            yield ''.join(result)
+            result = []
+    if result:
+        yield ''.join(result)
 
 
 ##### Logging #####
@@ -1134,8 +2307,8 @@ def export_textfile(wdict=None, word_pairs=None):
 
 class EWLogEntry(models.Model):
 
-    datetime = models.DateTimeField()
-    action = models.TextField()
+    datetime = models.DateTimeField(db_index=True)
+    action = models.TextField(db_index=True)
     user = models.ForeignKey(User, blank=True, null=True)
     username = models.TextField(blank=True)
     text = models.TextField(blank=True)
@@ -1147,6 +2320,224 @@ class EWLogEntry(models.Model):
                  self.action, self.text))
 
 
+class EWLogDailyCount(models.Model):
+    """The number of log entries of a user with an action on a day.
+
+    These rows are created by archive_log_entries from the log entries that
+    it deletes. There may be several rows for the same day, action and user;
+    their counts should be added.
+    """
+
+    day = models.DateField(db_index=True)
+    action = models.TextField()
+    user = models.ForeignKey(User, blank=True, null=True)
+    username = models.TextField(blank=True)
+    count = models.IntegerField()
+
+    def __unicode__(self):
+        return ('%s <%s> %s | %s' %
+                (self.day.isoformat(), self.username, self.action,
+                 self.count))
+
+
+def get_log_archive_path(archive_dir, day):
+    return os.path.join(archive_dir, 'ewlog-%s.json.gz' % day.isoformat())
+
+
+def archive_log_day(day, archive_dir):
+    """Archives, rolls up and deletes the log entries of a day.
+
+    Returns the number of log entries archived.
+    """
+
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+    rows = list(EWLogEntry.objects.filter(datetime__gte=start,
+                                          datetime__lt=end).
+                                   order_by('id').
+                                   values('id', 'datetime', 'action',
+                                          'user', 'username', 'text',
+                                          'ipaddress'))
+    if not rows:
+        return 0
+    lines = [json.dumps(dict(row, datetime=row['datetime'].isoformat()))
+             for row in rows]
+
+    # If the archive of the day exists (e.g. because a previous run was
+    # interrupted before deleting the entries), its entries are kept, except
+    # the ones that are archived again now
+    path = get_log_archive_path(archive_dir, day)
+    if os.path.exists(path):
+        ids = set(row['id'] for row in rows)
+        f = gzip.open(path, 'rb')
+        try:
+            old_lines = [line.rstrip('\n') for line in f
+                         if json.loads(line)['id'] not in ids]
+        finally:
+            f.close()
+        lines = old_lines + lines
+
+    # The archive is written into a temporary file which replaces the old
+    # one, so that an interrupted run does not leave a partial file
+    temp_path = path + '.tmp'
+    f = gzip.open(temp_path, 'wb')
+    try:
+        for line in lines:
+            f.write(line + '\n')
+    finally:
+        f.close()
+    os.rename(temp_path, path)
+
+    counts = {}
+    for row in rows:
+        key = (row['action'], row['user'], row['username'])
+        counts[key] = counts.get(key, 0) + 1
+
+    # The entries are deleted by their ids, so that entries written since
+    # they were read are not deleted without being archived
+    with transaction.commit_on_success():
+        for (action, user_id, username), count in counts.iteritems():
+            EWLogDailyCount(day=day, action=action, user_id=user_id,
+                            username=username, count=count).save()
+        cursor = connection.cursor()
+        for chunk in split_to_chunks([row['id'] for row in rows]):
+            cursor.execute(
+                'DELETE FROM ' +
+                connection.ops.quote_name(EWLogEntry._meta.db_table) + ' '
+                'WHERE id IN (' + ', '.join(['%s'] * len(chunk)) + ')',
+                chunk)
+        transaction.set_dirty()
+
+    return len(rows)
+
+
+def archive_log_entries(before, archive_dir):
+    """Archives the log entries that were written before a given day.
+
+    The log entries of each day are written into a gzip-compressed JSON
+    lines file of the day in `archive_dir` (e.g. ewlog-2013-01-31.json.gz),
+    counted in EWLogDailyCount rows and deleted from the database. The days
+    are processed in separate transactions, so the database is not locked
+    for a long time. If a run is interrupted, running it again does not
+    archive the entries twice.
+
+    Returns the number of log entries archived.
+    """
+
+    start = datetime.datetime.combine(before, datetime.time())
+    days = list(EWLogEntry.objects.filter(datetime__lt=start).
+                                   dates('datetime', 'day'))
+    archived_count = 0
+    for day in days:
+        archived_count += archive_log_day(day.date(), archive_dir)
+    return archived_count
+
+
+# The buffered log writer writes the entries in one transaction when this
+# many entries have been collected or this many seconds have elapsed since
+# the first entry of the batch was logged
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 5.0
+
+
+def write_log_entries(logentries):
+    """Inserts log entries into the database in one transaction."""
+
+    fields = [field for field in EWLogEntry._meta.local_fields
+              if not field.primary_key]
+    rows = [[field.get_db_prep_save(field.pre_save(logentry, True),
+                                    connection=connection)
+             for field in fields]
+            for logentry in logentries]
+    insert_rows(connection.ops.quote_name(EWLogEntry._meta.db_table),
+                [connection.ops.quote_name(field.column) for field in fields],
+                rows)
+
+
+class LogWriter(object):
+    """Writes log entries to the database in a background thread.
+
+    The entries are put into a queue by `log`, and the thread writes them in
+    batches, so that the requests do not wait for the database lock because
+    of logging. The remaining entries are written when the process exits.
+    """
+
+    def __init__(self, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL):
+        object.__init__(self)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+
+    def add(self, logentry):
+        with self.lock:
+            # The thread is started in the process that uses it: the FastCGI
+            # server may fork after the module has been imported
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = Queue.Queue()
+                self.thread = threading.Thread(target=self.run,
+                                               name='LogWriter')
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(logentry)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            logentries = []
+            logentry = self.queue.get()
+            deadline = time.time() + self.flush_interval
+            while logentry is not None:
+                logentries.append(logentry)
+                timeout = deadline - time.time()
+                if len(logentries) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    logentry = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+            else:
+                stopped = True
+
+            try:
+                if logentries:
+                    self.write(logentries)
+            except Exception, e:
+                traceback.print_exc()
+        connection.close()
+
+    def write(self, logentries):
+        write_log_entries(logentries)
+
+    def stop(self, timeout=10):
+        """Writes the queued entries and stops the thread."""
+        with self.lock:
+            if self.pid == os.getpid() and self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join(timeout)
+            self.pid = None
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.stop)
+
+
+def is_log_buffered():
+    """Returns whether the log entries are written by `log_writer`.
+
+    The entries are written synchronously unless the EW_BUFFERED_LOG setting
+    is true. They are also written synchronously to in-memory databases
+    (used by the tests), because those are not shared between threads.
+    """
+
+    return (getattr(settings, 'EW_BUFFERED_LOG', False) and
+            connection.settings_dict['NAME'] != ':memory:')
+
+
 def log(request, action, text=''):
 
     logentry = EWLogEntry()
@@ -1162,7 +2553,256 @@ def log(request, action, text=''):
         logentry.text = text
     except Exception, e:
         logentry.action = 'Logging failed'
-    logentry.save()
+    if is_log_buffered():
+        log_writer.add(logentry)
+    else:
+        logentry.save()
+
+
+##### View statistics #####
+
+
+# The upper limits of the wall time buckets of the view statistics in
+# seconds. The last bucket contains the requests that took longer.
+VIEW_STATS_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# The statistics collected by a process are written into the database at the
+# end of the first request after this many seconds
+VIEW_STATS_FLUSH_INTERVAL = 60.0
+
+
+class ViewStats(models.Model):
+    """The sums of the measurements of the requests served by a view on a day
+    whose wall time fell into the same bucket of VIEW_STATS_BUCKETS.
+
+    The rows are written by ViewStatsCollector.
+    """
+
+    day = models.DateField()
+    view_name = models.CharField(max_length=200)
+    bucket = models.IntegerField()
+    count = models.IntegerField(default=0)
+    wall_time = models.FloatField(default=0)
+    db_time = models.FloatField(default=0)
+    query_count = models.IntegerField(default=0)
+    response_size = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'view_name', 'bucket')
+
+    def __unicode__(self):
+        return '%s | %s | %s | %s' % (self.day, self.view_name, self.bucket,
+                                      self.count)
+
+
+def get_view_stats_bucket(wall_time):
+    return bisect.bisect_left(VIEW_STATS_BUCKETS, wall_time)
+
+
+def write_view_stats(stats):
+    """Adds the collected statistics to the ViewStats rows in one
+    transaction.
+
+    Arguments:
+    - stats: {(day, view_name, bucket):
+              [count, wall_time, db_time, query_count, response_size]}
+    """
+
+    with transaction.commit_on_success():
+        for (day, view_name, bucket), values in stats.items():
+            count, wall_time, db_time, query_count, response_size = values
+            updated = (ViewStats.objects.
+                       filter(day=day, view_name=view_name, bucket=bucket).
+                       update(count=F('count') + count,
+                              wall_time=F('wall_time') + wall_time,
+                              db_time=F('db_time') + db_time,
+                              query_count=F('query_count') + query_count,
+                              response_size=(F('response_size') +
+                                             response_size)))
+            if not updated:
+                ViewStats.objects.create(day=day, view_name=view_name,
+                                         bucket=bucket, count=count,
+                                         wall_time=wall_time,
+                                         db_time=db_time,
+                                         query_count=query_count,
+                                         response_size=response_size)
+
+
+class ViewStatsCollector(object):
+    """Collects the statistics of the requests in the process and writes them
+    into the database periodically.
+
+    The FastCGI server serves the requests from several processes, so the
+    statistics of the processes are summed in the database. If writing them
+    fails (e.g. because another process has created the same row in the
+    meantime), they are kept and written next time.
+    """
+
+    def __init__(self, flush_interval=VIEW_STATS_FLUSH_INTERVAL):
+        object.__init__(self)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.last_flush = time.time()
+
+    def add(self, view_name, wall_time, db_time, query_count, response_size):
+        key = (datetime.date.today(), view_name,
+               get_view_stats_bucket(wall_time))
+        with self.lock:
+            values = self.stats.setdefault(key, [0, 0.0, 0.0, 0, 0])
+            values[0] += 1
+            values[1] += wall_time
+            values[2] += db_time
+            values[3] += query_count
+            values[4] += response_size
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+            self.last_flush = time.time()
+        if not stats:
+            return
+        try:
+            write_view_stats(stats)
+        except Exception, e:
+            traceback.print_exc()
+            with self.lock:
+                for key, values in stats.items():
+                    new_values = self.stats.setdefault(key,
+                                                       [0, 0.0, 0.0, 0, 0])
+                    for i, value in enumerate(values):
+                        new_values[i] += value
+
+
+view_stats_collector = ViewStatsCollector()
+atexit.register(view_stats_collector.flush)
+
+
+class QueryTimer(object):
+    """Counts the queries executed by the cursors of the database connection
+    of the thread and measures their time while it is started."""
+
+    def __init__(self):
+        object.__init__(self)
+        self.running = False
+        self.query_count = 0
+        self.db_time = 0.0
+
+    def start(self):
+        self.running = True
+        self.query_count = 0
+        self.db_time = 0.0
+
+    def stop(self):
+        self.running = False
+
+    def add(self, db_time):
+        if self.running:
+            self.query_count += 1
+            self.db_time += db_time
+
+
+class TimedCursor(object):
+    """Cursor wrapper that reports the executed queries to a QueryTimer."""
+
+    def __init__(self, cursor, timer):
+        object.__init__(self)
+        self.cursor = cursor
+        self.timer = timer
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.timer.add(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.timer.add(time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def get_query_timer():
+    """Returns the QueryTimer of the database connection of the thread.
+
+    The database connection object is thread-local, so the cursor method of
+    the connection is wrapped once in every thread.
+    """
+
+    timer = getattr(connection, 'ew_query_timer', None)
+    if timer is None:
+        timer = QueryTimer()
+        cursor_method = connection.cursor
+        connection.cursor = lambda: TimedCursor(cursor_method(), timer)
+        connection.ew_query_timer = timer
+    return timer
+
+
+def get_view_stats(first_day, last_day):
+    """Returns the statistics of the views between the two days (inclusive),
+    the views with the largest total wall time first.
+
+    Returns: [{'view_name': str,
+               'count': int,
+               'wall_time': float, -- total, in seconds
+               'db_time': float, -- total, in seconds
+               'query_count': int, -- total
+               'response_size': int, -- total, in bytes
+               'histogram': [int] -- request count per wall time bucket
+             }]
+    """
+
+    views = {}
+    rows = (ViewStats.objects.filter(day__gte=first_day, day__lte=last_day).
+                              values('view_name', 'bucket').
+                              annotate(count_sum=Sum('count'),
+                                       wall_time_sum=Sum('wall_time'),
+                                       db_time_sum=Sum('db_time'),
+                                       query_count_sum=Sum('query_count'),
+                                       response_size_sum=Sum('response_size')))
+    for row in rows:
+        view = views.get(row['view_name'])
+        if view is None:
+            view = {'view_name': row['view_name'],
+                    'count': 0,
+                    'wall_time': 0.0,
+                    'db_time': 0.0,
+                    'query_count': 0,
+                    'response_size': 0,
+                    'histogram': [0] * (len(VIEW_STATS_BUCKETS) + 1)}
+            views[row['view_name']] = view
+        view['count'] += row['count_sum']
+        view['wall_time'] += row['wall_time_sum']
+        view['db_time'] += row['db_time_sum']
+        view['query_count'] += row['query_count_sum']
+        view['response_size'] += row['response_size_sum']
+        view['histogram'][row['bucket']] += row['count_sum']
+    return sorted(views.values(), key=lambda view: -view['wall_time'])
+
+
+def get_histogram_percentile(histogram, percent):
+    """Returns the index of the bucket of a histogram that contains the given
+    percentile."""
+
+    limit = sum(histogram) * percent / 100.0
+    total = 0
+    for bucket, count in enumerate(histogram):
+        total += count
+        if total >= limit:
+            return bucket
+    return len(histogram) - 1
 
 
 ##### Announcing releases #####
@@ -1175,64 +2815,539 @@ class Announcement(models.Model):
     def __unicode__(self):
         return self.lang + ' | ' + self.text.splitlines()[0]
 
+    def get_subject_and_body(self):
+        """The first line of the text is the subject; the rest is the
+        body."""
+        lines = self.text.splitlines()
+        return lines[0], '\n'.join(lines[1:])
 
-##### Show the future #####
 
+# The announcement emails are sent in batches of this size over one SMTP
+# connection, by this many threads in parallel
+ANNOUNCEMENT_BATCH_SIZE = 50
+ANNOUNCEMENT_WORKER_COUNT = 4
+
+# A recipient is skipped after this many failed attempts to send the email
+ANNOUNCEMENT_MAX_ATTEMPTS = 3
+
+
+class AnnouncementJob(models.Model):
+    """The sending of the announcement emails to the recipients who were
+    subscribed when the announcement was started.
+
+    The recipients are stored in AnnouncementRecipient rows, which record
+    whether the email has been sent, so an interrupted job can be
+    continued. The job is finished when every email has been sent or failed
+    ANNOUNCEMENT_MAX_ATTEMPTS times.
+    """
+
+    user = models.ForeignKey(User) # the staff member who started the job
+    created = models.DateTimeField()
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return '%s | %s' % (self.id, self.created)
+
+    def get_progress(self):
+        """Returns: (sent_count, recipient_count)"""
+        recipients = self.announcementrecipient_set
+        return (recipients.filter(sent__isnull=False).count(),
+                recipients.count())
+
+    def get_pending_recipients(self):
+        return self.announcementrecipient_set.filter(
+                   sent__isnull=True,
+                   attempts__lt=ANNOUNCEMENT_MAX_ATTEMPTS)
+
+    def get_failed_count(self):
+        """Returns the number of recipients who are skipped because sending
+        their email failed too many times."""
+        return self.announcementrecipient_set.filter(
+                   sent__isnull=True,
+                   attempts__gte=ANNOUNCEMENT_MAX_ATTEMPTS).count()
+
+
+class AnnouncementRecipient(models.Model):
+
+    job = models.ForeignKey(AnnouncementJob)
+    user = models.ForeignKey(User)
+    lang = models.CharField(max_length=10)
+    email = models.CharField(max_length=255)
+    sent = models.DateTimeField(blank=True, null=True)
+    attempts = models.IntegerField(default=0) # the number of failures
+    error = models.TextField(blank=True) # the error of the last failure
+
+    def __unicode__(self):
+        return '%s | %s | %s' % (self.job_id, self.email, self.sent)
+
+
+def create_announcement_job(staff_user, lang_users):
+    """Creates an announcement job.
+
+    `lang_users` is a dictionary {lang: [(user_id, username, email)]}.
 
-def incr_wcd(wcd, wdict, strength, due_date, ask_date, count):
-    strength_to_word_count = wcd.setdefault((wdict, ask_date), {})
-    key = (strength, due_date)
+    Returns: AnnouncementJob
+    """
+
+    job = AnnouncementJob(user=staff_user, created=datetime.datetime.now())
+    job.save()
+    insert_rows(connection.ops.quote_name(
+                    AnnouncementRecipient._meta.db_table),
+                ('job_id', 'user_id', 'lang', 'email', 'attempts', 'error'),
+                [(job.id, user_id, lang, email, 0, '')
+                 for lang, users in sorted(lang_users.items())
+                 for user_id, username, email in users])
+    return job
+
+
+def send_announcement_emails(messages, deadline=None):
+    """Sends the given (recipient_id, EmailMessage) pairs over one
+    connection.
+
+    If a message cannot be sent (e.g. because the address is rejected), the
+    failure is recorded, the connection is reopened and the other messages
+    are sent. The sending stops if the connection cannot be opened or
+    `deadline` (a time.time() value) has passed.
+
+    Returns: [sent_recipient_id], [(failed_recipient_id, error)], error
+    `error` is the exception that stopped the sending or None.
+    """
+
+    sent_ids = []
+    failures = []
     try:
-        strength_to_word_count[key] += count
-    except KeyError:
-        strength_to_word_count[key] = count
+        mail_connection = mail.get_connection(fail_silently=False)
+        mail_connection.open()
+    except Exception, e:
+        return sent_ids, failures, e
+    try:
+        for recipient_id, message in messages:
+            if deadline is not None and time.time() > deadline:
+                break
+            try:
+                mail_connection.send_messages([message])
+            except Exception, e:
+                failures.append((recipient_id, e))
+                # The connection may be unusable after the error
+                try:
+                    mail_connection.close()
+                    mail_connection.open()
+                except Exception, e:
+                    return sent_ids, failures, e
+            else:
+                sent_ids.append(recipient_id)
+    finally:
+        try:
+            mail_connection.close()
+        except Exception, e:
+            pass
+    return sent_ids, failures, None
+
 
-def get_initial_word_counts_dict(user, start_date):
+def run_announcement_job(job, time_limit=None):
+    """Sends the announcement emails of a job that have not been sent yet.
+
+    The emails are sent in batches by a pool of threads; each batch uses its
+    own connection. The database is only accessed by the calling thread: the
+    recipients whose email has been sent or failed are marked and logged
+    after each round of batches. Each email is tried at most once per call.
+    If `time_limit` (in seconds) is given, no more emails are sent after it
+    has elapsed.
+
+    Returns: [error] (the errors of the failed emails and of the batches
+    that could not be sent fully)
     """
-    Returns: wdicts, {(wdict, date): {(strength, due_date): word_count}}
+
+    deadline = None if time_limit is None else time.time() + time_limit
+    announcements = dict((ann.lang, ann.get_subject_and_body())
+                         for ann in Announcement.objects.all())
+    recipients = list(job.get_pending_recipients().order_by('id'))
+
+    messages = []
+    for recipient in recipients:
+        subject, body = announcements[recipient.lang]
+        message = mail.EmailMessage(subject, body,
+                                    settings.DEFAULT_FROM_EMAIL,
+                                    [recipient.email])
+        messages.append((recipient.id, message))
+    batches = split_to_chunks(messages, ANNOUNCEMENT_BATCH_SIZE)
+    recipients = dict((recipient.id, recipient) for recipient in recipients)
+
+    errors = []
+    pool = ThreadPool(ANNOUNCEMENT_WORKER_COUNT)
+    try:
+        while batches:
+            if deadline is not None and time.time() > deadline:
+                break
+            round_batches = batches[:ANNOUNCEMENT_WORKER_COUNT]
+            batches = batches[ANNOUNCEMENT_WORKER_COUNT:]
+            results = pool.map(
+                          lambda batch:
+                              send_announcement_emails(batch, deadline),
+                          round_batches)
+
+            now = datetime.datetime.now()
+            sent_ids = []
+            failures = []
+            for batch_sent_ids, batch_failures, error in results:
+                sent_ids.extend(batch_sent_ids)
+                failures.extend(batch_failures)
+                errors.extend(failure[1] for failure in batch_failures)
+                if error is not None:
+                    errors.append(error)
+            with transaction.commit_on_success():
+                for chunk in split_to_chunks(sent_ids):
+                    (AnnouncementRecipient.objects.filter(id__in=chunk).
+                                                   update(sent=now))
+                for recipient_id, error in failures:
+                    (AnnouncementRecipient.objects.filter(id=recipient_id).
+                         update(attempts=F('attempts') + 1,
+                                error=repr(error)))
+            write_log_entries(
+                [EWLogEntry(datetime=now,
+                            action='announcement_sent',
+                            user=job.user,
+                            username=job.user.username,
+                            text=('to %s in language %s' %
+                                  (recipients[recipient_id].email,
+                                   recipients[recipient_id].lang)))
+                 for recipient_id in sent_ids] +
+                [EWLogEntry(datetime=now,
+                            action='announcement_failed',
+                            user=job.user,
+                            username=job.user.username,
+                            text=('to %s: %r' %
+                                  (recipients[recipient_id].email, error)))
+                 for recipient_id, error in failures])
+    finally:
+        pool.close()
+        pool.join()
+
+    if not job.get_pending_recipients().exists():
+        job.finished = datetime.datetime.now()
+        job.save()
+    return errors
+
+
+##### Show the future #####
+
+
+# The number of days stored in a Forecast row
+FORECAST_DAYS = 365
+
+
+class Forecast(models.Model):
+    """The number of questions of a dictionary on each of the FORECAST_DAYS
+    days starting with `day`, as calculated by calc_future.
+
+    The rows are stored for a day like DueCount: a row that belongs to
+    another day, or that was calculated with another strengthener method, is
+    recalculated when it is read. The answers of the user patch the stored
+    row (see adjust_forecast); other modifications delete the row.
+
+    `question_counts` is a JSON list of FORECAST_DAYS numbers. `version` is
+    incremented by each patch, so that a patch can detect that another
+    process has modified the row since it was read.
+    """
+
+    wdict = models.OneToOneField(WDict, primary_key=True)
+    day = models.DateField()
+    strengthener_method = models.CharField(max_length=20)
+    question_counts = models.TextField()
+    version = models.IntegerField()
+
+    def __unicode__(self):
+        return '%s | %s | %s' % (self.wdict_id, self.day, self.version)
+
+    def get_question_counts(self):
+        return json.loads(self.question_counts)
+
+    def set_question_counts(self, question_counts):
+        self.question_counts = json.dumps(question_counts)
+
+
+def calc_forecast_buckets(wdict_ids):
+    """Counts the questions of the given dictionaries for each strength and
+    due date in the database.
+
+    Returns: {wdict_id: {(strength, due_date): word_count}}
     """
 
-    def add_wp(wcd, wdict, strength, due_date):
-        if (start_date is not None) and (due_date < start_date):
-            ask_date = start_date
+    wdict_buckets = dict((wdict_id, {}) for wdict_id in wdict_ids)
+    if not wdict_ids:
+        return wdict_buckets
+
+    # The rows are read with a cursor because there may be many of them.
+    # The SQLite backend would convert each date string in Python, so the
+    # dates are read as strings there and each distinct one is converted
+    # once.
+    dates = {}
+    cursor = connection.cursor()
+    for strength_field, date_field in (('strength1', 'date1'),
+                                       ('strength2', 'date2')):
+        if connection.vendor == 'sqlite':
+            date_column = 'CAST(' + date_field + ' AS TEXT)'
         else:
-            ask_date = due_date
-        incr_wcd(wcd, wdict, strength, due_date, ask_date, 1)
+            date_column = date_field
+        cursor.execute(
+            'SELECT wdict_id, ' + strength_field + ', ' + date_column + ', '
+            'COUNT(*) FROM ' + WordPair._meta.db_table + ' '
+            'WHERE deleted = %s AND wdict_id IN (' +
+            ', '.join(['%s'] * len(wdict_ids)) + ') '
+            'GROUP BY wdict_id, ' + strength_field + ', ' + date_field,
+            [False] + list(wdict_ids))
+        for wdict_id, strength, due_date, count in cursor.fetchall():
+            if isinstance(due_date, basestring):
+                try:
+                    due_date = dates[due_date]
+                except KeyError:
+                    dates[due_date] = typecast_date(due_date)
+                    due_date = dates[due_date]
+            buckets = wdict_buckets[wdict_id]
+            key = (strength, due_date)
+            buckets[key] = buckets.get(key, 0) + count
+    return wdict_buckets
+
+
+def calc_question_offsets(strength, due_date, ask_date, days_count,
+                          strengthener_method, cache):
+    """Calculates when a question that is first asked on `ask_date` will be
+    asked, assuming that it is always answered correctly.
+
+    The result depends only on the strength and on the delay of the first
+    answer, so it is stored in `cache` under
+    (strengthener_method, days_count, strength, delay). The later answers
+    have no delay, so the questions of many strengths share them.
+
+    Returns: [the number of days since ask_date], which are less than
+    days_count
+    """
+
+    key = (strengthener_method, days_count, strength,
+           (ask_date - due_date).days)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+
+    offsets = [0]
+    strength2, date2 = calc_strengthen(strength, due_date, ask_date,
+                                       strengthener_method)
+    interval = (date2 - ask_date).days
+    # If the interval is not positive, calc_future does not ask the question
+    # again
+    if 0 < interval < days_count:
+        next_offsets = calc_question_offsets(strength2, date2, date2,
+                                             days_count, strengthener_method,
+                                             cache)
+        for offset in next_offsets:
+            offset += interval
+            if offset >= days_count:
+                break
+            offsets.append(offset)
+    cache[key] = offsets
+    return offsets
+
+
+def add_forecast_questions(question_counts, start_date, strength, due_date,
+                           word_count, strengthener_method, cache):
+    """Adds the questions of `word_count` word pairs with the given strength
+    and due date to `question_counts`, whose first item belongs to
+    `start_date`.
+
+    The word pairs are asked first on their due date, or on `start_date` if
+    that has already passed. `cache` is passed to calc_question_offsets.
+    """
+
+    days_count = len(question_counts)
+    ask_date = max(due_date, start_date)
+    first_index = (ask_date - start_date).days
+    if first_index >= days_count:
+        return
+    offsets = calc_question_offsets(strength, due_date, ask_date, days_count,
+                                    strengthener_method, cache)
+    for offset in offsets:
+        index = first_index + offset
+        if index >= days_count:
+            break
+        question_counts[index] += word_count
+
+
+def calc_forecasts(wdicts, start_date, days_count, ewuser):
+    """Calculates the number of questions of the given dictionaries on each
+    day from `start_date`.
 
-    wcd = {}
-    wdicts = WDict.objects.filter(user=user, deleted=False)
+    The word pairs are not simulated one by one: the questions of each day
+    are counted per (strength, delay) class, and each class is moved to the
+    day on which it is asked next. The result of answering a class is
+    calculated once with calc_strengthen. Only the questions of the first
+    day can have a delay, since the later answers are given on time.
+
+    Returns: {wdict_id: [question_count]}
+    """
+
+    wdict_buckets = calc_forecast_buckets([wdict.id for wdict in wdicts])
+    start_ordinal = start_date.toordinal()
+    # {strengthener_method: {(strength, delay): (strength2, interval)}}
+    method_transitions = {}
+    wdict_question_counts = {}
     for wdict in wdicts:
-        word_pairs = WordPair.objects.filter(wdict=wdict,
-                                             deleted=False)
-        for wp in word_pairs:
-            add_wp(wcd, wdict, wp.strength1, wp.date1)
-            add_wp(wcd, wdict, wp.strength2, wp.date2)
-    return wdicts, wcd
+        strengthener_method = wdict.get_strengthener_method(ewuser)
+        transitions = method_transitions.setdefault(strengthener_method, {})
+
+        # [{(strength, delay): word_count}], one item for each day
+        day_classes = [{} for i in xrange(days_count)]
+        buckets = wdict_buckets[wdict.id]
+        for (strength, due_date), word_count in buckets.iteritems():
+            index = due_date.toordinal() - start_ordinal
+            if index < 0:
+                key = (strength, -index)
+                index = 0
+            elif index < days_count:
+                key = (strength, 0)
+            else:
+                continue
+            classes = day_classes[index]
+            classes[key] = classes.get(key, 0) + word_count
+
+        question_counts = [0] * days_count
+        for index, classes in enumerate(day_classes):
+            for key, word_count in classes.iteritems():
+                question_counts[index] += word_count
+                try:
+                    strength2, interval = transitions[key]
+                except KeyError:
+                    strength, delay = key
+                    due_date = start_date - datetime.timedelta(delay)
+                    strength2, date2 = calc_strengthen(strength, due_date,
+                                                       start_date,
+                                                       strengthener_method)
+                    interval = (date2 - start_date).days
+                    transitions[key] = (strength2, interval)
+                # If the interval is not positive, calc_future does not ask
+                # the question again
+                if 0 < interval < days_count - index:
+                    next_classes = day_classes[index + interval]
+                    key = (strength2, 0)
+                    next_classes[key] = next_classes.get(key, 0) + word_count
+        wdict_question_counts[wdict.id] = question_counts
+
+    return wdict_question_counts
+
+
+def get_forecasts(wdicts, today, ewuser):
+    """Returns the number of questions of the given dictionaries on each of
+    the FORECAST_DAYS days from `today`.
+
+    The stored rows are read with one query, and the missing or outdated ones
+    are recalculated together.
+
+    Returns: {wdict_id: [question_count]}
+    """
 
+    strengthener_methods = \
+        dict((wdict.id, wdict.get_strengthener_method(ewuser))
+             for wdict in wdicts)
+    wdict_question_counts = {}
+    forecasts = Forecast.objects.filter(wdict__in=strengthener_methods.keys(),
+                                        day=today)
+    for forecast in forecasts:
+        if (forecast.strengthener_method ==
+            strengthener_methods[forecast.wdict_id]):
+            wdict_question_counts[forecast.wdict_id] = \
+                forecast.get_question_counts()
+
+    missing_wdicts = [wdict for wdict in wdicts
+                      if wdict.id not in wdict_question_counts]
+    if missing_wdicts:
+        calculated = calc_forecasts(missing_wdicts, today, FORECAST_DAYS,
+                                    ewuser)
+        for wdict_id, question_counts in calculated.items():
+            # The version starts from a random number so that a patch that
+            # has read a deleted row does not match the new row
+            forecast = Forecast(
+                           wdict_id=wdict_id, day=today,
+                           strengthener_method=strengthener_methods[wdict_id],
+                           version=random.randint(0, 2 ** 30))
+            forecast.set_question_counts(question_counts)
+            forecast.save()
+        wdict_question_counts.update(calculated)
+
+    return wdict_question_counts
+
+
+def adjust_forecast(wdict_id, today, old_buckets, new_buckets):
+    """Updates the forecast of a dictionary if it is stored for `today`.
+
+    `old_buckets` and `new_buckets` are lists of (strength, due_date) pairs,
+    as returned by WordPair.get_forecast_buckets before and after a
+    modification. The questions of the old buckets are subtracted from the
+    stored counts and the questions of the new ones are added, which gives
+    the same result as recalculating the forecast.
+    """
 
-def calc_future(user, days_count, start_date):
+    if sorted(old_buckets) == sorted(new_buckets):
+        return
+    try:
+        forecast = Forecast.objects.get(wdict=wdict_id, day=today)
+    except Forecast.DoesNotExist:
+        return
+
+    question_counts = forecast.get_question_counts()
+    cache = {}
+    for buckets, delta in ((old_buckets, -1), (new_buckets, 1)):
+        for strength, due_date in buckets:
+            add_forecast_questions(question_counts, today, strength, due_date,
+                                   delta, forecast.strengthener_method, cache)
+    forecast.set_question_counts(question_counts)
+
+    # If another process has modified the row since it was read, the row is
+    # deleted instead of overwriting the other modification
+    updated = (Forecast.objects.filter(wdict=wdict_id, day=today,
+                                       version=forecast.version).
+                                update(question_counts=
+                                           forecast.question_counts,
+                                       version=F('version') + 1))
+    if updated == 0:
+        invalidate_forecasts([wdict_id])
+
+
+def invalidate_forecasts(wdict_ids):
+    Forecast.objects.filter(wdict__in=wdict_ids).delete()
+
+
+def get_forecast_summary(user, wdicts, today, context=None):
+    """Returns the number of questions of the given dictionaries tomorrow
+    and in the next 7 days (from tomorrow), using the stored forecasts."""
+    ewuser = get_user_context(user, context).ewuser
+    tomorrow_count = week_count = 0
+    for question_counts in get_forecasts(wdicts, today, ewuser).itervalues():
+        tomorrow_count += question_counts[1]
+        week_count += sum(question_counts[1:8])
+    return tomorrow_count, week_count
+
+
+def calc_future(user, days_count, start_date, context=None):
     """
     Returns: [date], [WDict], {(WDict, date): question_count}
     """
 
+    context = get_user_context(user, context)
     dates = [start_date + datetime.timedelta(i)
              for i in range(days_count)]
+    wdicts = list(WDict.objects.filter(user=user, deleted=False))
 
-    wdicts, wcd = get_initial_word_counts_dict(user, start_date)
+    if start_date == context.today and days_count <= FORECAST_DAYS:
+        wdict_question_counts = get_forecasts(wdicts, start_date,
+                                              context.ewuser)
+    else:
+        wdict_question_counts = calc_forecasts(wdicts, start_date,
+                                               days_count, context.ewuser)
 
     date_to_question_count = {} # {(wdict, date): question_count}
-    for date in dates:
-        for wdict in wdicts:
-            strength_to_word_count = wcd.pop((wdict, date), {})
-            strengthener_method = wdict.get_strengthener_method()
-            question_count = 0
-            for key, word_count in strength_to_word_count.items():
-                (strength, due_date) = key
-                question_count += word_count
-                strength2, date2 = \
-                    calc_strengthen(strength, due_date, date,
-                                    strengthener_method)
-                incr_wcd(wcd, wdict, strength2, date2, date2, word_count)
+    for wdict in wdicts:
+        question_counts = wdict_question_counts[wdict.id]
+        for date, question_count in zip(dates, question_counts):
             date_to_question_count[(wdict, date)] = question_count
 
     return dates, wdicts, date_to_question_count
@@ -1272,14 +3387,18 @@ class EWException(Exception):
         return self.__unicode__()
 
 
+def split_to_chunks(items, chunk_size=500):
+    """Splits a list into lists of at most `chunk_size` items.
+
+    It is used for keeping "IN" queries below the limit of SQLite on the
+    number of query parameters.
+    """
+
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
 def get_labels(user):
-    all_word_pairs = WordPair.objects.filter(wdict__user=user,
-                                             wdict__deleted=False,
-                                             deleted=False)
-    labels = set()
-    for wp in all_word_pairs:
-        labels.update(unicode(wp.labels).split())
-    return labels
+    return set(label for label, count in get_label_counts(user))
 
 
 def parse_date(s):
@@ -82,6 +82,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'ExponWords.ew.middleware.ViewStatsMiddleware',
 )
 
 ROOT_URLCONF = 'ExponWords.urls'
@@ -101,3 +102,6 @@ INSTALLED_APPS = (
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 DEFAULT_FROM_EMAIL = 'myexponwordssite.com admin <admin@myexponwordssite.com>'
+
+# Write the log entries of ExponWords in batches from a background thread
+EW_BUFFERED_LOG = True
@@ -0,0 +1,7 @@
+-- Indexes used when selecting the words to be practiced today
+CREATE INDEX ew_wordpair_wdict_deleted_date1 ON ew_wordpair (wdict_id, deleted, date1);
+CREATE INDEX ew_wordpair_wdict_deleted_date2 ON ew_wordpair (wdict_id, deleted, date2);
+
+-- Indexes used when counting the questions for the forecast
+CREATE INDEX ew_wordpair_wdict_deleted_strength1_date1 ON ew_wordpair (wdict_id, deleted, strength1, date1);
+CREATE INDEX ew_wordpair_wdict_deleted_strength2_date2 ON ew_wordpair (wdict_id, deleted, strength2, date2);
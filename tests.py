@@ -6,10 +6,28 @@ Replace these with more appropriate tests for your application.
 """
 
 import datetime
+import gzip
+import json
+import os
+import shutil
+import smtplib
+import StringIO
+import tempfile
+import time
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
 
+import ExponWords.ew.benchmarks as benchmarks
 import ExponWords.ew.models as models
+import ExponWords.ew.views as views
 
 class DateHandlingTest(TestCase):
 
@@ -34,3 +52,1269 @@ class DateHandlingTest(TestCase):
                 models.get_user_time(timezone=2,
                                      turning_point=3 * 60,
                                      now=dt(2011, 1, 10, 1, 1))))
+
+
+class HtmlTest(TestCase):
+
+    def test_simple_html_to_html(self):
+
+        def test(input, expected_output):
+            self.assertEqual(models.simple_html_to_html(input,
+                                                        add_br=False,
+                                                        add_space_count=0),
+                             expected_output)
+
+        # Edge cases
+        test('', '')
+        test('<', '&lt;')
+        test('>', '&gt;')
+        test('a<a', 'a&lt;a')
+        test('<br>', '<br>')
+        test('< br >', '< br >')
+        test('<br/>', '<br/>')
+        test('<unknown>', '&lt;unknown&gt;')
+        test('<a onclick="x">', '&lt;a onclick="x"&gt;')
+        test('<a title="x>', '&lt;a title="x&gt;')
+
+        # Ampersand
+        test('&amp;',
+             '&amp;')
+
+        # Different attribute value formats
+        test('ab<a href=xy>b</a>',
+             'ab<a href=xy>b</a>')
+        test('ab<a href="xy \' z">b</a>',
+             'ab<a href="xy \' z">b</a>')
+        test('ab<a href=\'xy " z\'>b</a>',
+             'ab<a href=\'xy " z\'>b</a>')
+
+        # More complex examples
+        test('<img src=xy title="hello world">',
+             '<img src=xy title="hello world">')
+        test('ab<img src=xy title="hello world">b',
+             'ab<img src=xy title="hello world">b')
+        test('<img src=xy title="hello world">' * 2,
+             '<img src=xy title="hello world">' * 2)
+
+    def test_simple_html_to_html_with_br(self):
+        nbsp = '&nbsp;'
+        self.assertEqual(
+            models.simple_html_to_html('  a <b>b</b>\n  c > d\n',
+                                       add_br=True, add_space_count=4),
+            nbsp * 6 + 'a <b>b</b><br/>' + nbsp * 6 + 'c &gt; d')
+        self.assertEqual(
+            models.simple_html_to_html('<i>x</i>\n y',
+                                       add_br=True, add_space_count=4),
+            nbsp * 4 + '<i>x</i><br/>' + nbsp * 5 + 'y')
+        self.assertEqual(
+            models.simple_html_to_html('a\n\n  b<br>',
+                                       add_br=True, add_space_count=4),
+            nbsp * 4 + 'a<br/>' + nbsp * 4 + '<br/>' + nbsp * 6 + 'b<br>')
+
+    def test_text_to_html(self):
+        nbsp = '&nbsp;'
+        self.assertEqual(
+            models.text_to_html('  a & <b>\n  c\n', add_space_count=4),
+            nbsp * 6 + 'a &amp; &lt;b&gt;<br/>' + nbsp * 6 + 'c<br/>' +
+            nbsp * 4)
+        self.assertEqual(models.text_to_html('x\r\ny', add_space_count=0),
+                         'x<br/>y')
+
+
+class WordPairsTestCase(TestCase):
+    """Creates a dictionary with word pairs of different dates and strengths.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.com', 'pw')
+        ewuser = models.get_ewuser(self.user)
+        ewuser.timezone = 2
+        ewuser.turning_point = 3 * 60
+        ewuser.save()
+        self.wdict = models.WDict.objects.create(user=self.user, name='dict',
+                                                 lang1='en', lang2='hu')
+        today = models.get_today(self.user)
+        i = 0
+        for days in range(-5, 6):
+            for strength in (-1, 0, 1, 2.5, 4, 7):
+                date1 = today + datetime.timedelta(days=days)
+                date2 = today - datetime.timedelta(days=i % 3)
+                wp = models.WordPair(word_in_lang1='a%s' % i,
+                                     word_in_lang2='b%s' % i,
+                                     date_added=today,
+                                     date1=date1,
+                                     date2=date2,
+                                     strength1=strength,
+                                     strength2=strength + 1,
+                                     deleted=(i % 7 == 0))
+                self.wdict.wordpair_set.add(wp)
+                wp.save()
+                i += 1
+
+
+class WordsToPracticeTest(WordPairsTestCase):
+
+    def test_query_matches_scan(self):
+        for word_list_type in ('normal', 'early'):
+            self.assertEqual(
+                self.wdict.get_words_to_practice_today(word_list_type),
+                self.wdict.scan_words_to_practice_today(word_list_type))
+
+
+class DueCountTest(WordPairsTestCase):
+
+    def assertDueCountCorrect(self):
+        due_counts = models.get_due_counts(self.user, [self.wdict])
+        self.assertEqual(due_counts[self.wdict.id],
+                         len(self.wdict.get_words_to_practice_today()))
+
+    def test_due_count(self):
+        self.assertDueCountCorrect()
+        today = models.get_today(self.user)
+
+        # The stored count is read with one query
+        self.assertNumQueries(1, models.get_due_counts,
+                              self.user, [self.wdict], today)
+
+        # Saving a word pair invalidates the count
+        wp = self.wdict.wordpair_set.filter(deleted=False)[0]
+        wp.date1 = today + datetime.timedelta(days=10)
+        wp.date2 = today + datetime.timedelta(days=10)
+        wp.save()
+        self.assertDueCountCorrect()
+
+        # Editing the text or the labels keeps the stored count
+        wp.word_in_lang1 += ' (edited)'
+        wp.labels = 'edited'
+        wp.save()
+        self.assertEqual(models.DueCount.objects.count(), 1)
+
+        # Moving a word pair to another dictionary invalidates the counts of
+        # both dictionaries
+        wdict2 = models.WDict.objects.create(user=self.user, name='dict2',
+                                             lang1='en', lang2='de')
+        models.get_due_counts(self.user, [self.wdict, wdict2], today)
+        wp.wdict = wdict2
+        wp.save()
+        self.assertEqual(models.DueCount.objects.count(), 0)
+        wp.wdict = self.wdict
+        wp.save()
+        self.assertDueCountCorrect()
+
+        # Adjusting the count
+        wp.weaken(1, day=today)
+        wp.save(update_due_count=False)
+        models.adjust_due_count(self.wdict.id, today, 1)
+        self.assertDueCountCorrect()
+
+        # A count stored for another day is recalculated
+        models.DueCount.objects.filter(wdict=self.wdict).update(
+            day=today - datetime.timedelta(days=1), count=-1)
+        self.assertDueCountCorrect()
+
+
+class WordsToPracticeToJsonTest(WordPairsTestCase):
+
+    def test_query_count(self):
+        # The dimness (shown by the 'p' feature) is not defined for negative
+        # strengths
+        words = [(wp, direction)
+                 for wp, direction
+                 in self.wdict.get_words_to_practice_today('early')
+                 if wp.get_strength(direction) >= 0]
+
+        # Storing the rendered HTML
+        request = RequestFactory().get('/')
+        request.user = self.user
+        views.words_to_practice_to_json(request, words, False)
+
+        for extras in ('', 'p'):
+            ewuser = models.get_ewuser(self.user)
+            ewuser.extras = extras
+            ewuser.save()
+            for word_count in (1, 10, len(words)):
+                request = RequestFactory().get('/')
+                request.user = self.user
+                # One query for the user settings, one for the dictionaries
+                # and one for the rendered HTML
+                self.assertNumQueries(3, views.words_to_practice_to_json,
+                                      request, words[:word_count], False)
+
+
+class PracticeQueueTest(WordPairsTestCase):
+
+    def get_batch(self, cursor, word_list_type='normal'):
+        request = RequestFactory().get('/', {'word_list_type': word_list_type,
+                                             'cursor': cursor})
+        request.user = self.user
+        response = views.get_words_to_practice_today(request,
+                                                     wdict_id=self.wdict.id)
+        return json.loads(response.content)
+
+    def get_all_words(self, word_list_type='normal'):
+        words = []
+        cursor = 0
+        while cursor is not None:
+            batch = self.get_batch(cursor, word_list_type)
+            words.extend((word[3], word[2]) for word in batch['word_list'])
+            cursor = batch['cursor']
+        return words
+
+    def answer(self, words):
+        updates = []
+        for word_pair_id, direction in words:
+            wp = models.WordPair.objects.get(id=word_pair_id)
+            updates.append({'type': 'answer',
+                            'word_index': word_pair_id,
+                            'direction': direction,
+                            'answer': True,
+                            'old_date': wp.get_date(direction).isoformat(),
+                            'old_strength': wp.get_strength(direction)})
+        request = RequestFactory().post('/', {'updates': json.dumps(updates)})
+        request.user = self.user
+        views.update_words(request)
+
+    def test_queue(self):
+        expected_words = set(
+            (wp.id, direction) for wp, direction
+            in self.wdict.get_words_to_practice_today('normal'))
+
+        old_batch_size = views.PRACTICE_BATCH_SIZE
+        views.PRACTICE_BATCH_SIZE = 7
+        try:
+            words = self.get_all_words()
+            self.assertEqual(set(words), expected_words)
+            self.assertEqual(len(words), len(expected_words))
+
+            # The queue is read with one query
+            context = models.UserContext(self.user)
+            context.today
+            self.assertNumQueries(1, models.get_practice_queue,
+                                  self.wdict, 'normal', context)
+
+            # The answered words are skipped, and the skipped words at the
+            # beginning of the queue are not read again
+            answered = words[:3] + words[5:6]
+            self.answer(answered)
+            self.assertEqual(self.get_all_words(),
+                             [word for word in words if word not in answered])
+            self.assertEqual(
+                models.PracticeQueue.objects.get(wdict=self.wdict).first, 3)
+            self.assertEqual(self.get_batch(0)['all_words_to_practice'],
+                             len(words) - 4)
+        finally:
+            views.PRACTICE_BATCH_SIZE = old_batch_size
+
+        # The bulk operations delete the queue
+        models.update_word_pairs(
+            [answered[0][0]], {'date1': models.get_today(self.user)})
+        self.assertEqual(models.PracticeQueue.objects.count(), 0)
+
+    def test_edit_between_batches(self):
+        today = models.get_today(self.user)
+        old_batch_size = views.PRACTICE_BATCH_SIZE
+        views.PRACTICE_BATCH_SIZE = 7
+        try:
+            batch = self.get_batch(0)
+            words = [(word[3], word[2]) for word in batch['word_list']]
+            self.answer(words)
+
+            # Editing a word pair does not change the positions of the
+            # queue: a word pair that is not due any more is skipped, and
+            # the words that become due are appended
+            queue = models.PracticeQueue.objects.get(wdict=self.wdict)
+            not_due_id, direction = queue.get_items()[len(words) + 1]
+            wp = models.WordPair.objects.get(id=not_due_id)
+            wp.set_date(direction, today + datetime.timedelta(days=5))
+            wp.explanation = 'edited'
+            wp.save()
+            wp = (self.wdict.wordpair_set.filter(deleted=False,
+                                                 date1__gt=today).
+                                          exclude(id=not_due_id)[0])
+            wp.date1 = today
+            wp.save()
+            new_word = (wp.id, 1)
+
+            expected_words = set(
+                (wp.id, direction) for wp, direction
+                in self.wdict.get_words_to_practice_today('normal'))
+            cursor = batch['cursor']
+            while cursor is not None:
+                batch = self.get_batch(cursor)
+                words.extend((word[3], word[2])
+                             for word in batch['word_list'])
+                cursor = batch['cursor']
+            self.assertEqual(set(words[7:]), expected_words)
+            self.assertTrue(new_word in words)
+            self.assertTrue((not_due_id, direction) not in words)
+            self.assertEqual(self.get_batch(0)['all_words_to_practice'],
+                             len(expected_words))
+        finally:
+            views.PRACTICE_BATCH_SIZE = old_batch_size
+
+    def test_invalid_cursor(self):
+        for cursor in ('x', '-1'):
+            self.assertRaises(Http404, self.get_batch, cursor)
+            request = RequestFactory().get('/', {'cursor': cursor})
+            request.user = self.user
+            self.assertRaises(Http404, views.get_selected_words_to_practice,
+                              request)
+
+    def test_early_queue(self):
+        words = self.get_all_words('early')
+        self.assertEqual(
+            set(words),
+            set((wp.id, direction) for wp, direction
+                in self.wdict.get_words_to_practice_today('early')))
+        self.assertEqual(self.get_batch(0, 'early')['all_words_to_practice'],
+                         len(words))
+
+        # Both due and not due words are counted when they are answered
+        today = models.get_today(self.user)
+        wps = models.WordPair.objects.in_bulk([item[0] for item in words])
+        due = [item for item in words
+               if wps[item[0]].get_date(item[1]) <= today]
+        not_due = [item for item in words
+                   if wps[item[0]].get_date(item[1]) > today]
+        self.assertTrue(due and not_due)
+        self.answer(due[:1] + not_due[:2])
+        self.assertEqual(self.get_batch(0, 'early')['all_words_to_practice'],
+                         len(words) - 3)
+
+
+class UpdateWordsTest(WordPairsTestCase):
+
+    def update_words(self, updates):
+        request = RequestFactory().post(
+            '/', {'updates': json.dumps(updates)})
+        request.user = self.user
+        response = views.update_words(request)
+        return json.loads(response.content)
+
+    def test_update_words(self):
+        models.get_due_counts(self.user, [self.wdict])
+        wps = list(self.wdict.wordpair_set.filter(deleted=False,
+                                                  strength1__gt=0)[:2])
+        answers = [{'type': 'answer',
+                    'word_index': wp.id,
+                    'direction': 1,
+                    'answer': answer,
+                    'old_date': wp.date1.isoformat(),
+                    'old_strength': wp.strength1}
+                   for wp, answer in zip(wps, (True, False))]
+        other_user = User.objects.create_user('other', 'other@example.com',
+                                              'pw')
+        other_wdict = models.WDict.objects.create(user=other_user, name='d',
+                                                  lang1='en', lang2='hu')
+        today = models.get_today(self.user)
+        other_wp = models.WordPair(wdict=other_wdict, word_in_lang1='x',
+                                   word_in_lang2='y', date_added=today,
+                                   date1=today, date2=today)
+        other_wp.save()
+        updates = answers + [
+            {'type': 'label', 'word_index': wps[0].id, 'label': 'hard'},
+            {'type': 'label', 'word_index': other_wp.id, 'label': 'hard'},
+            {'type': 'answer', 'word_index': wps[0].id, 'direction': 3,
+             'answer': True},
+            {'type': 'unknown', 'word_index': wps[0].id}]
+
+        result = self.update_words(updates)
+        self.assertEqual(result, {'status': 'ok',
+                                  'results': ['ok', 'ok', 'ok', 'not_found',
+                                              'invalid', 'invalid']})
+
+        # The answers are applied the same way as by update_word
+        wp0 = models.WordPair.objects.get(id=wps[0].id)
+        wp1 = models.WordPair.objects.get(id=wps[1].id)
+        wps[0].strengthen(1, day=today)
+        wps[1].weaken(1, day=today)
+        self.assertEqual((wp0.strength1, wp0.date1),
+                         (wps[0].strength1, wps[0].date1))
+        self.assertEqual((wp1.strength1, wp1.date1),
+                         (wps[1].strength1, wps[1].date1))
+        self.assertEqual(wp0.get_label_set(), set(['hard']))
+        self.assertEqual(
+            models.WordPair.objects.get(id=other_wp.id).get_label_set(),
+            set())
+
+        # The stored due count was adjusted
+        self.assertEqual(models.DueCount.objects.get(wdict=self.wdict).count,
+                         len(self.wdict.get_words_to_practice_today()))
+
+        # Sending the same answers again does not modify the word pairs
+        result = self.update_words(answers)
+        self.assertEqual(result['results'], ['conflict', 'conflict'])
+        self.assertEqual(models.WordPair.objects.get(id=wps[0].id).date1,
+                         wp0.date1)
+
+
+class SearchTest(WordPairsTestCase):
+
+    def scan(self, query_label, query_text):
+        """Searches the word pairs the way the search page used to."""
+        query_words = [models.normalize_string(query_word)
+                       for query_word in query_text.split()]
+        result = []
+        for wp in self.wdict.wordpair_set.filter(deleted=False).order_by('id'):
+            if (query_label is not None and
+                query_label not in wp.get_label_set()):
+                continue
+            for query_word in query_words:
+                if query_word.startswith('label:'):
+                    texts = [wp.labels]
+                    query_word = query_word[6:]
+                else:
+                    texts = [getattr(wp, field) for field
+                             in models.WordPair.get_fields_to_be_edited()]
+                if not [text for text in texts
+                        if query_word in models.normalize_string(
+                                             unicode(text))]:
+                    break
+            else:
+                result.append(wp)
+        return result
+
+    def assertSearchCorrect(self, query_label, query_text):
+        query_text = unicode(query_text)
+        word_pairs = self.wdict.wordpair_set.filter(deleted=False)
+        self.assertEqual(
+            list(models.search_word_pairs(word_pairs, query_label,
+                                          query_text)),
+            self.scan(query_label, query_text))
+
+    def test_search(self):
+        wps = list(self.wdict.wordpair_set.filter(deleted=False))
+        wps[0].explanation = u'\xc9l\xe8ve 100%'
+        wps[0].labels = 'Hard verb'
+        wps[0].save()
+        wps[1].word_in_lang2 = u'\xe9l\xe9ve'
+        wps[1].labels = 'hard'
+        wps[1].save()
+
+        # Word pairs saved before the index existed are indexed by the
+        # ew_index_word_pairs command
+        models.SearchText.objects.filter(word_pair=wps[2]).delete()
+        call_command('ew_index_word_pairs', stdout=StringIO.StringIO())
+
+        # The search runs one query
+        word_pairs = self.wdict.wordpair_set.filter(deleted=False)
+        with self.assertNumQueries(1):
+            list(models.search_word_pairs(word_pairs, 'hard', u'eleve'))
+
+        for query_label in (None, 'hard', 'Hard', 'har'):
+            for query_text in ('', 'a1', 'ELEVE  b', 'label:har', 'label:',
+                               '100%', '2.5', '-0', '_', 'label:verb a'):
+                self.assertSearchCorrect(query_label, query_text)
+
+        # Editing a word pair updates the index
+        wps[0].explanation = 'changed'
+        wps[0].save()
+        self.assertSearchCorrect(None, 'eleve')
+        self.assertSearchCorrect(None, 'changed')
+
+
+class LabelTest(WordPairsTestCase):
+
+    def test_labels(self):
+        wps = list(self.wdict.wordpair_set.filter(deleted=False))
+        wps[0].add_labels('verb hard')
+        wps[0].save()
+        wps[1].set_labels('hard noun')
+        wps[1].save()
+        wps[2].set_labels('old')
+        wps[2].deleted = True
+        wps[2].save()
+        self.assertEqual(models.get_label_counts(self.user),
+                         [('hard', 2), ('noun', 1), ('verb', 1)])
+
+        wps[1].remove_labels('hard')
+        wps[1].save()
+        self.assertEqual(models.get_label_counts(self.user, 'h'),
+                         [('hard', 1)])
+
+        # Labels saved before the label index existed are indexed by the
+        # ew_index_word_pairs command
+        models.WordPairLabel.objects.filter(word_pair=wps[0]).delete()
+        call_command('ew_index_word_pairs', stdout=StringIO.StringIO())
+        self.assertEqual(models.get_labels(self.user),
+                         set(['hard', 'noun', 'verb']))
+
+        self.client.login(username='user', password='pw')
+        response = self.client.get(reverse('label_list'), {'term': 'n'})
+        self.assertEqual(json.loads(response.content), [['noun', 1]])
+
+
+class ExportTest(WordPairsTestCase):
+
+    def test_download(self):
+        wp = self.wdict.wordpair_set.filter(deleted=False)[0]
+        wp.explanation = 'line 1\n\n  line 2'
+        wp.save()
+        self.client.login(username='user', password='pw')
+        response = self.client.get(
+            reverse('export_word_pairs_to_text', args=[self.wdict.id]),
+            {'download': '1'})
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=exponwords-%s.txt' %
+                         self.wdict.id)
+        self.assertEqual(response.content.decode('utf-8'),
+                         models.export_textfile(self.wdict))
+        self.assertEqual(
+            list(models.iter_export_textfile(
+                     self.wdict.wordpair_set.filter(deleted=False),
+                     chunk_size=20)),
+            [models.export_textfile(word_pairs=word_pairs) for word_pairs
+             in models.split_to_chunks(
+                    list(self.wdict.wordpair_set.filter(deleted=False)),
+                    20)])
+
+
+class ImportTest(WordPairsTestCase):
+
+    def test_import(self):
+        models.get_due_counts(self.user, [self.wdict])
+        text = (u'x1 -- y1 <2 2013-01-31><0 2013-02-01>\n'
+                u'    note 1\n'
+                u'\n'
+                u'    note 2\n'
+                u'x\xe9 -- y2\n')
+        imported = (models.import_textfile(text, self.wdict, 'new b a') +
+                    models.import_tsv(u'x3\ty3\tnote\n\nx4\ty4\n',
+                                      self.wdict, 'new'))
+
+        wps = list(self.wdict.wordpair_set.filter(word_in_lang1__in=
+                                                  ['x1', u'x\xe9', 'x3',
+                                                   'x4']).order_by('id'))
+        self.assertEqual([wp.id for wp in imported], [wp.id for wp in wps])
+        self.assertEqual([(wp.word_in_lang2, wp.explanation, wp.labels)
+                          for wp in wps],
+                         [('y1', 'note 1\n\nnote 2', 'a b new'),
+                          ('y2', '', 'a b new'),
+                          ('y3', 'note', 'new'),
+                          ('y4', '', 'new')])
+        self.assertEqual((wps[0].strength1, wps[0].date1),
+                         (2, datetime.date(2013, 1, 31)))
+
+        # The due count is recalculated and the new word pairs are indexed
+        self.assertEqual(models.get_due_counts(self.user,
+                                               [self.wdict])[self.wdict.id],
+                         len(self.wdict.get_words_to_practice_today()))
+        self.assertEqual(models.get_label_counts(self.user),
+                         [('a', 2), ('b', 2), ('new', 4)])
+        self.assertEqual(
+            list(models.search_word_pairs(self.wdict.wordpair_set.all(),
+                                          'new', u'xe')),
+            wps[1:2])
+
+
+class ImportFileTest(WordPairsTestCase):
+
+    def import_file(self, content, file_format):
+        f = StringIO.StringIO(content)
+        f.name = 'words.txt'
+        self.client.login(username='user', password='pw')
+        response = self.client.post(
+            reverse('import_word_pairs_from_file', args=[self.wdict.id]),
+            {'file': f, 'file_format': file_format, 'labels': 'imported'},
+            follow=True)
+        return [unicode(message)
+                for message in response.context['messages']]
+
+    def get_imported(self):
+        return [(wp.word_in_lang1, wp.word_in_lang2, wp.explanation,
+                 wp.labels)
+                for wp in self.wdict.wordpair_set.filter(
+                              labels__contains='imported').order_by('id')]
+
+    def test_formats(self):
+        files = [
+            ('text', '\xef\xbb\xbfx1 -- y1\n    note\nx2 -- y2\r\n'),
+            ('tsv', 'x1\ty1\tnote\n\nx2\ty2\n'),
+            ('csv', 'x1,y1,note\n\n"x2",y2\n'),
+            ('json_lines',
+             '{"word_in_lang1": "x1", "word_in_lang2": "y1", '
+             '"explanation": "note"}\n'
+             '{"word_in_lang1": "x2", "word_in_lang2": "y2"}\n')]
+        for file_format, content in files:
+            self.assertEqual(self.import_file(content, file_format),
+                             ['2 word pairs added.'])
+            self.assertEqual(self.get_imported(),
+                             [('x1', 'y1', 'note', 'imported'),
+                              ('x2', 'y2', '', 'imported')])
+            self.wdict.wordpair_set.filter(
+                labels__contains='imported').delete()
+
+    def test_errors(self):
+        self.assertEqual(
+            self.import_file('x1,y1\n\nx2\n', 'csv'),
+            ['Error: Not enough fields in line 3: x2'])
+        self.assertEqual(self.get_imported(), [])
+
+        self.assertEqual(
+            self.import_file('x\xe9 -- y\n', 'text'),
+            ['Error: Line 1 is not valid UTF-8 text.'])
+
+        old_batch_size = models.IMPORT_BATCH_SIZE
+        models.IMPORT_BATCH_SIZE = 2
+        try:
+            self.assertEqual(
+                self.import_file('{"word_in_lang1": "x1", '
+                                 '"word_in_lang2": "y1", "labels": "a"}\n'
+                                 '{"word_in_lang1": "x2", '
+                                 '"word_in_lang2": "y2"}\n'
+                                 '{"word_in_lang1": "x3"}\n',
+                                 'json_lines'),
+                ['Error: Line 3 is incorrect: {"word_in_lang1": "x3"} '
+                 '(2 word pairs were added before this line.)'])
+        finally:
+            models.IMPORT_BATCH_SIZE = old_batch_size
+        self.assertEqual(self.get_imported(),
+                         [('x1', 'y1', '', 'a imported'),
+                          ('x2', 'y2', '', 'imported')])
+
+
+class SearchViewTest(WordPairsTestCase):
+
+    def test_pagination(self):
+        self.client.login(username='user', password='pw')
+        hits = list(models.search_word_pairs(
+                        self.wdict.wordpair_set.filter(deleted=False),
+                        None, u'a'))
+        response = self.client.get(reverse('search'),
+                                   {'q': 'a', 'dict': 'all', 'label': 'all',
+                                    'hits_per_page': '10', 'page': '2',
+                                    'show_hits': 'on'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['hits_count'], len(hits))
+        self.assertEqual(
+            [wp for wp, _, _, _ in response.context['word_pairs_and_exps']],
+            hits[10:20])
+
+
+class UserContextTest(WordPairsTestCase):
+
+    def test_ewuser_is_read_once(self):
+        context = models.UserContext(self.user)
+
+        def use_context():
+            words = self.wdict.get_words_to_practice_today('early', context)
+            self.wdict.sort_words(words, word_list_type='early',
+                                  context=context)
+            self.wdict.sort_words(words, order='zero_first', context=context)
+            self.assertEqual(context.today, models.get_today(self.user))
+
+        # One query for the EWUser, one for the word pairs, one for the
+        # EWUser in get_today above
+        self.assertNumQueries(3, use_context)
+
+
+class RenderedHtmlCacheTest(WordPairsTestCase):
+
+    def assertCacheCorrect(self, word_pairs):
+        html_cache = models.RenderedHtmlCache(word_pairs)
+        for wp in word_pairs:
+            for field in models.WordPair.get_simple_fields():
+                self.assertEqual(html_cache.get_html(wp, field),
+                                 wp.get_html(field))
+        html_cache.save()
+
+    def test_cache(self):
+        word_pairs = list(self.wdict.wordpair_set.all())
+        self.assertCacheCorrect(word_pairs)
+        self.assertEqual(models.RenderedHtml.objects.count(),
+                         3 * len(word_pairs))
+
+        # Everything is read from the database
+        html_cache = models.RenderedHtmlCache(word_pairs)
+        for wp in word_pairs:
+            html_cache.get_html(wp, 'word_in_lang1')
+        self.assertEqual(html_cache.new_rows, {})
+        self.assertEqual(html_cache.changed_rows, {})
+
+        # Modifying a word pair
+        wp = word_pairs[0]
+        wp.explanation = '<b>x</b>\n  y'
+        wp.save()
+        self.assertCacheCorrect(word_pairs)
+
+        # Modifying the text format
+        self.wdict.text_format = 'html_ws'
+        self.wdict.save()
+        word_pairs = list(self.wdict.wordpair_set.all())
+        self.assertCacheCorrect(word_pairs)
+        self.assertCacheCorrect(word_pairs)
+
+
+class ForecastTest(WordPairsTestCase):
+
+    def calc_future_by_scan(self, user, days_count, start_date):
+        """Calculates the forecast by strengthening each word pair day by
+        day."""
+
+        ewuser = models.get_ewuser(user)
+        dates = [start_date + datetime.timedelta(i)
+                 for i in range(days_count)]
+        wdicts = models.WDict.objects.filter(user=user, deleted=False)
+        result = {}
+        for wdict in wdicts:
+            method = wdict.get_strengthener_method(ewuser)
+            due = []
+            for wp in wdict.wordpair_set.filter(deleted=False):
+                due.append([wp.strength1, wp.date1])
+                due.append([wp.strength2, wp.date2])
+            for date in dates:
+                question_count = 0
+                for item in due:
+                    strength, due_date = item
+                    if max(due_date, start_date) == date:
+                        question_count += 1
+                        item[:] = models.calc_strengthen(strength, due_date,
+                                                         date, method)
+                result[(wdict, date)] = question_count
+        return result
+
+    def test_calc_future(self):
+        wdict2 = models.WDict.objects.create(user=self.user, name='dict2',
+                                             lang1='en', lang2='de',
+                                             strengthener_method='double_due')
+        for wp in list(self.wdict.wordpair_set.all()[:20]):
+            wp.id = None
+            wp.wdict = wdict2
+            wp.strength1 += 0.3
+            wp.save()
+
+        today = models.get_today(self.user)
+        dates, wdicts, date_to_question_count = \
+            models.calc_future(self.user, 100, today)
+        self.assertEqual(len(dates), 100)
+        self.assertEqual(set(wdicts), set([self.wdict, wdict2]))
+        self.assertEqual(date_to_question_count,
+                         self.calc_future_by_scan(self.user, 100, today))
+
+        # The forecasts of other days are not stored
+        start_date = today + datetime.timedelta(3)
+        self.assertEqual(models.calc_future(self.user, 100, start_date)[2],
+                         self.calc_future_by_scan(self.user, 100, start_date))
+
+    def test_cache(self):
+        today = models.get_today(self.user)
+        models.calc_future(self.user, 30, today)
+        self.assertEqual(models.Forecast.objects.count(), 1)
+
+        # The answers move questions between the buckets of the stored
+        # forecast
+        wps = list(self.wdict.wordpair_set.filter(deleted=False)[:3])
+        request = RequestFactory().post('/', {
+            'answer': 'true',
+            'word_index': str(wps[0].id),
+            'direction': '1',
+            'old_date': json.dumps(wps[0].date1.isoformat()),
+            'old_strength': json.dumps(wps[0].strength1)})
+        request.user = self.user
+        views.update_word(request)
+        updates = [{'type': 'answer', 'word_index': wp.id, 'direction': 2,
+                    'answer': answer, 'old_date': wp.date2.isoformat(),
+                    'old_strength': wp.strength2}
+                   for wp, answer in zip(wps, (False, True, True))]
+        request = RequestFactory().post('/',
+                                        {'updates': json.dumps(updates)})
+        request.user = self.user
+        views.update_words(request)
+
+        ewuser = models.get_ewuser(self.user)
+        forecast = models.Forecast.objects.get(wdict=self.wdict)
+        self.assertEqual(forecast.get_question_counts(),
+                         models.calc_forecasts([self.wdict], today,
+                                               models.FORECAST_DAYS,
+                                               ewuser)[self.wdict.id])
+        self.assertEqual(models.calc_future(self.user, 30, today)[2],
+                         self.calc_future_by_scan(self.user, 30, today))
+
+        # Each patch increments the version of the row
+        version = forecast.version
+        wp = models.WordPair.objects.get(id=wps[1].id)
+        old_buckets = wp.get_forecast_buckets()
+        wp.strength1 += 1
+        wp.date1 = today
+        wp.save(update_due_count=False)
+        models.adjust_forecast(self.wdict.id, today, old_buckets,
+                               wp.get_forecast_buckets())
+        forecast = models.Forecast.objects.get(wdict=self.wdict)
+        self.assertEqual(forecast.version, version + 1)
+        self.assertEqual(models.calc_future(self.user, 30, today)[2],
+                         self.calc_future_by_scan(self.user, 30, today))
+
+        # The forecast is recalculated if the strengthener method changes
+        self.wdict.strengthener_method = 'double_due'
+        self.wdict.save()
+        self.assertEqual(models.calc_future(self.user, 30, today)[2],
+                         self.calc_future_by_scan(self.user, 30, today))
+
+        # Other modifications delete the stored forecast
+        wps[0].deleted = True
+        wps[0].save()
+        self.assertEqual(models.Forecast.objects.count(), 0)
+        self.assertEqual(models.calc_future(self.user, 30, today)[2],
+                         self.calc_future_by_scan(self.user, 30, today))
+
+
+class LogTest(TestCase):
+
+    def test_log(self):
+        user = User.objects.create_user('user', 'user@example.com', 'pw')
+        request = RequestFactory().get('/', REMOTE_ADDR='127.0.0.1')
+        request.user = user
+        models.log(request, 'index', 'text')
+        logentry = models.EWLogEntry.objects.get()
+        self.assertEqual((logentry.action, logentry.user, logentry.username,
+                          logentry.text, logentry.ipaddress),
+                         ('index', user, 'user', 'text', '127.0.0.1, '))
+
+        models.write_log_entries([models.EWLogEntry(
+                                      datetime=datetime.datetime.now(),
+                                      action='help')
+                                  for i in range(3)])
+        self.assertEqual(models.EWLogEntry.objects.count(), 4)
+
+    def test_log_writer(self):
+
+        class TestLogWriter(models.LogWriter):
+            def write(self, logentries):
+                batches.append(logentries)
+
+        batches = []
+        log_writer = TestLogWriter(batch_size=3, flush_interval=60)
+        for i in range(7):
+            log_writer.add(i)
+        log_writer.stop()
+        self.assertEqual(batches, [[0, 1, 2], [3, 4, 5], [6]])
+
+        batches = []
+        log_writer = TestLogWriter(batch_size=3, flush_interval=0.01)
+        log_writer.add(0)
+        time.sleep(0.5)
+        log_writer.add(1)
+        log_writer.stop()
+        self.assertEqual(batches, [[0], [1]])
+
+    def test_archive_log_entries(self):
+        user = User.objects.create_user('user', 'user@example.com', 'pw')
+        start = datetime.datetime(2013, 1, 30, 12, 0)
+        for days, action, logged_user in ((0, 'index', user),
+                                          (0, 'index', user),
+                                          (0, 'help', None),
+                                          (2, 'index', user),
+                                          (2, 'index', None),
+                                          (3, 'index', user)):
+            models.EWLogEntry(datetime=start + datetime.timedelta(days),
+                              action=action, user=logged_user,
+                              username=logged_user.username
+                                       if logged_user else '').save()
+
+        archive_dir = tempfile.mkdtemp()
+        try:
+            # A run that is interrupted after writing the archive of a day
+            # does not delete the entries of the day
+            def save(self, *args, **kw):
+                raise KeyboardInterrupt
+            old_save = models.EWLogDailyCount.save
+            models.EWLogDailyCount.save = save
+            try:
+                self.assertRaises(KeyboardInterrupt,
+                                  models.archive_log_entries,
+                                  datetime.date(2013, 2, 2), archive_dir)
+            finally:
+                models.EWLogDailyCount.save = old_save
+            self.assertEqual(models.EWLogEntry.objects.count(), 6)
+            self.assertEqual(os.listdir(archive_dir),
+                             ['ewlog-2013-01-30.json.gz'])
+
+            # Running it again archives each entry once
+            archived_count = models.archive_log_entries(
+                                 datetime.date(2013, 2, 2), archive_dir)
+            self.assertEqual(archived_count, 5)
+            self.assertEqual(sorted(os.listdir(archive_dir)),
+                             ['ewlog-2013-01-30.json.gz',
+                              'ewlog-2013-02-01.json.gz'])
+            f = gzip.open(os.path.join(archive_dir,
+                                       'ewlog-2013-01-30.json.gz'))
+            self.assertEqual(len(f.readlines()), 3)
+            f.close()
+            f = gzip.open(os.path.join(archive_dir,
+                                       'ewlog-2013-02-01.json.gz'))
+            rows = [json.loads(line) for line in f]
+            f.close()
+        finally:
+            shutil.rmtree(archive_dir)
+
+        self.assertEqual([(row['datetime'], row['action'], row['user'])
+                          for row in rows],
+                         [('2013-02-01T12:00:00', 'index', user.id),
+                          ('2013-02-01T12:00:00', 'index', None)])
+        self.assertEqual([logentry.datetime
+                          for logentry in models.EWLogEntry.objects.all()],
+                         [start + datetime.timedelta(3)])
+        self.assertEqual(
+            sorted((c.day.isoformat(), c.action, c.user_id, c.count)
+                   for c in models.EWLogDailyCount.objects.all()),
+            [('2013-01-30', 'help', None, 1),
+             ('2013-01-30', 'index', user.id, 2),
+             ('2013-02-01', 'index', None, 1),
+             ('2013-02-01', 'index', user.id, 1)])
+
+
+class OperationTest(WordPairsTestCase):
+
+    def operation(self, word_pairs, operation, **params):
+        params['operation'] = operation
+        for wp in word_pairs:
+            params[str(wp.id)] = 'on'
+        request = RequestFactory().post('/', params)
+        request.user = self.user
+        request.session = {}
+        views.operation_on_word_pairs(request)
+        return request
+
+    def get_word_pairs(self):
+        return list(models.WordPair.objects.filter(deleted=False).
+                                            order_by('id'))
+
+    def test_selection(self):
+        wps = self.get_word_pairs()
+        deleted_wp = models.WordPair.objects.filter(deleted=True)[0]
+        other_user = User.objects.create_user('other', 'other@example.com',
+                                              'pw')
+        other_wdict = models.WDict.objects.create(user=other_user, name='d',
+                                                  lang1='en', lang2='hu')
+        other_wp = models.WordPair(wdict=other_wdict, word_in_lang1='x',
+                                   word_in_lang2='y', date_added=wps[0].date1,
+                                   date1=wps[0].date1, date2=wps[0].date1)
+        other_wp.save()
+
+        # The selected word pairs are checked with one query
+        params = {'operation': 'delete'}
+        for wp in (wps[3], wps[1], deleted_wp, other_wp):
+            params[str(wp.id)] = 'on'
+        # Non-ASCII digits are not word pair ids
+        params[u'\xb2'] = 'on'
+        params[u'\u0663'] = 'on'
+        request = RequestFactory().post('/', params)
+        request.user = self.user
+        with self.assertNumQueries(1):
+            word_pair_ids = views.get_word_pair_ids_to_use(request)
+        self.assertEqual(word_pair_ids, [wps[1].id, wps[3].id])
+
+        # Without show_hits, the search is run again
+        request = RequestFactory().post('/', {
+            'source_url': '/search/?q=a1&dict=all&label=all'})
+        request.user = self.user
+        self.assertEqual(views.get_word_pair_ids_to_use(request),
+                         [wp.id for wp in wps if 'a1' in wp.word_in_lang1])
+
+    def test_dates_and_strengths(self):
+        wps = self.get_word_pairs()
+        wps[0].date1 = datetime.date.max - datetime.timedelta(days=2)
+        wps[0].save()
+
+        self.operation(wps[:2], 'shift_days', days='3')
+        wps2 = self.get_word_pairs()
+        self.assertEqual((wps2[0].date1, wps2[0].date2),
+                         (wps[0].date1, wps[0].date2 + datetime.timedelta(3)))
+        self.assertEqual((wps2[1].date1, wps2[1].date2),
+                         (wps[1].date1 + datetime.timedelta(3),
+                          wps[1].date2 + datetime.timedelta(3)))
+        self.assertEqual([wp.date1 for wp in wps2[2:]],
+                         [wp.date1 for wp in wps[2:]])
+
+        models.get_due_counts(self.user, [self.wdict])
+        self.operation(wps[:2], 'set_dates_strengths', date1='2013-01-31',
+                       strength2='3')
+        for wp in self.get_word_pairs()[:2]:
+            self.assertEqual((wp.date1, wp.strength2),
+                             (datetime.date(2013, 1, 31), 3))
+        self.assertEqual(models.DueCount.objects.count(), 0)
+
+    def test_delete_and_move(self):
+        wdict2 = models.WDict.objects.create(user=self.user, name='dict2',
+                                             lang1='en', lang2='de')
+        models.get_due_counts(self.user, [self.wdict, wdict2])
+        wps = self.get_word_pairs()
+        self.operation(wps[:3], 'move', move_word_pairs_wdict=str(wdict2.id))
+        self.assertEqual(models.DueCount.objects.count(), 0)
+        self.assertEqual(
+            set(wdict2.wordpair_set.values_list('id', flat=True)),
+            set(wp.id for wp in wps[:3]))
+
+        self.operation(wps[:2], 'delete')
+        self.assertEqual(self.get_word_pairs(), wps[2:])
+
+    def test_labels(self):
+        wps = self.get_word_pairs()
+        word_pairs = models.WordPair.objects.filter(deleted=False)
+        self.operation(wps[:3], 'add_labels', **{'add_labels-labels': 'x y'})
+        self.operation(wps[1:2], 'remove_labels',
+                       **{'remove_labels-labels': 'x'})
+        self.operation(wps[2:3], 'set_labels', **{'set_labels-labels': 'z'})
+        self.assertEqual([wp.labels for wp in self.get_word_pairs()[:4]],
+                         ['x y', 'y', 'z', ''])
+        self.assertEqual(models.get_label_counts(self.user),
+                         [('x', 1), ('y', 2), ('z', 1)])
+        self.assertEqual(list(models.search_word_pairs(word_pairs, None,
+                                                       u'label:y')),
+                         wps[:2])
+        self.assertEqual(
+            models.SearchText.objects.get(word_pair=wps[2].id).text,
+            models.SearchText.calc_text(self.get_word_pairs()[2]))
+
+
+    def test_practice(self):
+        items = [(1, 1), (1, 2), (2 ** 31 + 5, 2), (7, 1)]
+        packed = models.pack_words_to_practice(items)
+
+        # The format does not depend on the platform
+        self.assertEqual(len(packed), 32)
+        self.assertEqual(packed[:8], '\x02' + '\x00' * 7)
+
+        self.assertEqual(models.get_packed_word_count(packed), 4)
+        self.assertEqual(models.unpack_words_to_practice(packed), items)
+        self.assertEqual(models.unpack_words_to_practice(packed, 1, 3),
+                         items[1:3])
+        self.assertEqual(models.unpack_words_to_practice(packed, 3, 10),
+                         items[3:])
+        self.assertEqual(models.unpack_words_to_practice(packed, 10), [])
+
+        wps = self.get_word_pairs()
+        session = self.operation(wps[:3], 'practice',
+                                 practice_scope='all').session
+        packed = session['ew_words_to_practice']
+        self.assertTrue(isinstance(packed, str))
+        self.assertEqual(
+            sorted(models.unpack_words_to_practice(packed)),
+            [(wp.id, direction) for wp in wps[:3] for direction in (1, 2)])
+
+        # The words are served in batches
+        old_batch_size = views.PRACTICE_BATCH_SIZE
+        views.PRACTICE_BATCH_SIZE = 4
+        try:
+            request = RequestFactory().get('/')
+            request.user = self.user
+            request.session = session
+            batch = views.get_selected_words_batch(request, 0)
+            self.assertEqual((batch['all_words_to_practice'],
+                              len(batch['word_list']), batch['cursor']),
+                             (6, 4, 4))
+            batch = views.get_selected_words_batch(request, 4)
+            self.assertEqual((len(batch['word_list']), batch['cursor']),
+                             (2, None))
+
+            # The format of earlier versions is converted
+            request.session = {'ew_words_to_practice':
+                                   [(wps[0], 2), (wps[1], 1)]}
+            batch = views.get_selected_words_batch(request, 0)
+            self.assertEqual([(word[3], word[2])
+                              for word in batch['word_list']],
+                             [(wps[0].id, 2), (wps[1].id, 1)])
+            self.assertTrue(
+                isinstance(request.session['ew_words_to_practice'], str))
+        finally:
+            views.PRACTICE_BATCH_SIZE = old_batch_size
+
+
+class RejectingEmailBackend(locmem.EmailBackend):
+    """Email backend that rejects the emails sent to user2@example.com."""
+
+    def send_messages(self, messages):
+        for message in messages:
+            if 'user2@example.com' in message.to:
+                raise smtplib.SMTPRecipientsRefused(
+                          {'user2@example.com': (550, 'No such user')})
+        return locmem.EmailBackend.send_messages(self, messages)
+
+
+class AnnouncementTest(TestCase):
+
+    def setUp(self):
+        self.staff_user = User.objects.create_user('staff', '', 'pw')
+        for i in range(5):
+            user = User.objects.create_user('user%s' % i,
+                                            'user%s@example.com' % i, 'pw')
+            ewuser = models.get_ewuser(user)
+            ewuser.lang = 'hu' if i % 2 else 'en'
+            ewuser.save()
+        models.Announcement(lang='en', text='Release\nNew features').save()
+        models.Announcement(lang='hu', text='Kiadas\nUj funkciok').save()
+
+    def test_receivers(self):
+        User.objects.create_user('no_ewuser', 'no_ewuser@example.com', 'pw')
+        user = User.objects.create_user('no_emails', 'no_emails@example.com',
+                                        'pw')
+        ewuser = models.get_ewuser(user)
+        ewuser.release_emails = False
+        ewuser.save()
+
+        def get_ids(*usernames):
+            return [(user.id, user.username, user.email)
+                    for user in User.objects.filter(username__in=usernames).
+                                             order_by('id')]
+
+        with self.assertNumQueries(1):
+            receivers = views.get_announcement_receivers()
+        self.assertEqual(
+            receivers,
+            {'en': get_ids('user0', 'user2', 'user4', 'no_ewuser'),
+             'hu': get_ids('user1', 'user3')})
+
+    def test_announcement(self):
+        job = models.create_announcement_job(
+                  self.staff_user, views.get_announcement_receivers())
+        self.assertEqual(job.get_progress(), (0, 5))
+
+        # The emails of an interrupted job are not sent again
+        recipients = job.announcementrecipient_set.order_by('id')
+        recipients.filter(id=recipients[0].id).update(
+            sent=datetime.datetime.now())
+
+        old_batch_size = models.ANNOUNCEMENT_BATCH_SIZE
+        old_worker_count = models.ANNOUNCEMENT_WORKER_COUNT
+        models.ANNOUNCEMENT_BATCH_SIZE = 1
+        models.ANNOUNCEMENT_WORKER_COUNT = 3
+        try:
+            errors = models.run_announcement_job(job)
+        finally:
+            models.ANNOUNCEMENT_BATCH_SIZE = old_batch_size
+            models.ANNOUNCEMENT_WORKER_COUNT = old_worker_count
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            sorted((message.to[0], message.subject, message.body)
+                   for message in mail.outbox),
+            [('user1@example.com', 'Kiadas', 'Uj funkciok'),
+             ('user2@example.com', 'Release', 'New features'),
+             ('user3@example.com', 'Kiadas', 'Uj funkciok'),
+             ('user4@example.com', 'Release', 'New features')])
+        self.assertEqual(job.get_progress(), (5, 5))
+        self.assertTrue(job.finished is not None)
+        self.assertEqual(
+            models.EWLogEntry.objects.filter(action='announcement_sent').
+                                      count(),
+            4)
+
+    def test_failures(self):
+        job = models.create_announcement_job(
+                  self.staff_user, views.get_announcement_receivers())
+        old_email_backend = settings.EMAIL_BACKEND
+        settings.EMAIL_BACKEND = 'ew.tests.RejectingEmailBackend'
+        try:
+            # No email is sent after the time limit
+            self.assertEqual(models.run_announcement_job(job, time_limit=-1),
+                             [])
+            self.assertEqual(len(mail.outbox), 0)
+
+            # A rejected email does not stop the others
+            errors = models.run_announcement_job(job)
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(len(mail.outbox), 4)
+            self.assertEqual(job.get_progress(), (4, 5))
+            recipient = job.announcementrecipient_set.get(sent=None)
+            self.assertEqual(recipient.email, 'user2@example.com')
+            self.assertEqual(recipient.attempts, 1)
+            self.assertTrue('No such user' in recipient.error)
+            self.assertTrue(job.finished is None)
+
+            # The recipient is skipped after ANNOUNCEMENT_MAX_ATTEMPTS
+            # failures
+            for i in range(models.ANNOUNCEMENT_MAX_ATTEMPTS - 1):
+                models.run_announcement_job(job)
+            self.assertEqual(models.run_announcement_job(job), [])
+        finally:
+            settings.EMAIL_BACKEND = old_email_backend
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(job.get_failed_count(), 1)
+        self.assertTrue(job.finished is not None)
+
+    def test_view(self):
+        self.staff_user.is_staff = True
+        self.staff_user.save()
+        self.client.login(username='staff', password='pw')
+        url = reverse('ew.views.announce_release')
+        response = self.client.post(url, {'text_en': 'Release\nNew',
+                                          'text_hu': 'Kiadas\nUj',
+                                          'announce-button': 'x'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(models.AnnouncementJob.objects.get().get_progress(),
+                         (5, 5))
+        response = self.client.get(url)
+        self.assertEqual(response.context['unfinished_jobs'], [])
+
+        # An unfinished job can be continued
+        job = models.create_announcement_job(
+                  self.staff_user, views.get_announcement_receivers())
+        self.assertContains(self.client.get(url), '0 of 5 emails sent')
+        self.client.post(url, {'job': job.id, 'continue-button': 'x'})
+        self.assertEqual(len(mail.outbox), 10)
+        self.assertEqual(
+            models.AnnouncementJob.objects.filter(finished=None).count(), 0)
+
+
+class ViewStatsTest(WordPairsTestCase):
+
+    def test_write_view_stats(self):
+        day = datetime.date(2013, 1, 31)
+        models.write_view_stats({(day, 'a', 2): [2, 0.06, 0.02, 10, 2000],
+                                 (day, 'a', 5): [1, 0.3, 0.1, 5, 1000]})
+        models.write_view_stats({(day, 'a', 2): [1, 0.04, 0.01, 3, 500],
+                                 (day, 'b', 0): [1, 0.001, 0, 0, 10]})
+        stats = models.get_view_stats(day, day)
+        self.assertEqual([view['view_name'] for view in stats], ['a', 'b'])
+        self.assertEqual((stats[0]['count'], stats[0]['query_count'],
+                          stats[0]['response_size'], stats[0]['histogram']),
+                         (4, 18, 3500, [0, 0, 3, 0, 0, 1] + [0] * 5))
+        self.assertAlmostEqual(stats[0]['wall_time'], 0.4)
+        self.assertEqual(
+            models.get_histogram_percentile(stats[0]['histogram'], 50), 2)
+        self.assertEqual(
+            models.get_histogram_percentile(stats[0]['histogram'], 95), 5)
+
+    def test_middleware(self):
+        self.user.is_staff = True
+        self.user.save()
+        models.view_stats_collector.flush()
+        old_middleware_classes = settings.MIDDLEWARE_CLASSES
+        settings.MIDDLEWARE_CLASSES += \
+            ('ExponWords.ew.middleware.ViewStatsMiddleware',)
+        try:
+            client = self.client_class()
+            client.login(username='user', password='pw')
+            url = reverse('ew.views.get_words_to_practice_today',
+                          args=[self.wdict.id])
+            for i in range(2):
+                client.get(url, {'word_list_type': 'normal'})
+            models.view_stats_collector.flush()
+        finally:
+            settings.MIDDLEWARE_CLASSES = old_middleware_classes
+
+        today = datetime.date.today()
+        stats = dict((view['view_name'], view)
+                     for view in models.get_view_stats(today, today))
+        view = stats['get_words_to_practice_today']
+        self.assertEqual(view['count'], 2)
+        self.assertTrue(view['query_count'] > 0)
+        self.assertTrue(view['response_size'] > 0)
+
+        self.client.login(username='user', password='pw')
+        response = self.client.get(reverse('ew.views.view_stats'))
+        self.assertContains(response, 'get_words_to_practice_today')
+        response = self.client.get(reverse('ew.views.view_stats'),
+                                   {'days': '2'})
+        self.assertEqual(response.status_code, 404)
+
+
+class BenchmarkTest(TestCase):
+
+    # The benchmarks themselves are run by the ew_benchmark command
+    def test_measure(self):
+        seconds, query_count = benchmarks.measure(
+            lambda: list(User.objects.all()), repeat=2)
+        self.assertTrue(seconds >= 0)
+        self.assertEqual(query_count, 1)
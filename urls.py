@@ -52,6 +52,9 @@ urlpatterns = patterns('ew.views',
     url(r'^dict/(?P<wdict_id>\d+)/import-word-pairs-from-tsv/$',
         view='import_word_pairs_from_tsv',
         name='import_word_pairs_from_tsv'),
+    url(r'^dict/(?P<wdict_id>\d+)/import-word-pairs-from-file/$',
+        view='import_word_pairs_from_file',
+        name='import_word_pairs_from_file'),
     url(r'^dict/(?P<wdict_id>\d+)/modify/$',
         view='modify_wdict',
         name='modify_wdict'),
@@ -81,6 +84,9 @@ urlpatterns = patterns('ew.views',
     url(r'^practice/$',
         view='practice',
         name='practice'),
+    url(r'^practice/words/$',
+        view='get_selected_words_to_practice',
+        name='get_selected_words_to_practice'),
     url(r'^dict/(?P<wdict_id>\d+)/words-to-practice-today/$',
         view='get_words_to_practice_today',
         name='get_words_to_practice_today'),
@@ -95,9 +101,15 @@ urlpatterns = patterns('ew.views',
     url(r'^dict/update-word/$',
         view='update_word',
         name='update_word'),
+    url(r'^dict/update-words/$',
+        view='update_words',
+        name='update_words'),
     url(r'^dict/add-label/$',
         view='add_label',
         name='add_label'),
+    url(r'^labels/$',
+        view='label_list',
+        name='label_list'),
     url(r'^operation-on-word-pairs/$',
         view='operation_on_word_pairs',
         name='operation_on_word_pairs'),
@@ -106,6 +118,9 @@ urlpatterns = patterns('ew.views',
     url(r'^announce_release/$',
         view='announce_release',
         name='announce_release'),
+    url(r'^view_stats/$',
+        view='view_stats',
+        name='view_stats'),
 )
 
 urlpatterns += patterns('django.contrib.auth.views',
@@ -20,7 +20,6 @@ import random
 import re
 import sys
 import traceback
-import unicodedata
 import urllib
 import urlparse
 
@@ -36,6 +35,7 @@ from django.contrib.sites.models import get_current_site
 from django.core.mail import send_mail
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.http import Http404, HttpResponseServerError, \
                         HttpResponseBadRequest
 from django.http import HttpResponse, HttpResponseRedirect
@@ -60,23 +60,55 @@ PRACTICE_WORD_ORDER_CHOICES = \
 STRENGTHENER_METHOD_CHOICES = \
     [('double_actual', _('Double last actual time interval')),
      ('double_due', _('Double last due time interval'))]
-PRACTICE_WORD_COUNT_LIMIT = 200
+PRACTICE_BATCH_SIZE = 50
+ANNOUNCEMENT_TIME_LIMIT = 20 # seconds
+VIEW_STATS_PERIODS = (1, 7, 30) # days
+VISUALIZE_PERIODS = (30, 90, 365) # days
 TEXT_FORMAT_CHOICES = \
     [('text', _('Plain text')),
      ('html_ws', _('HTML (keep line breaks)')),
      ('html', _('HTML (unmodified)'))]
+IMPORT_FILE_FORMAT_CHOICES = \
+    [('text', _('Text')),
+     ('tsv', _('Tab-separated values')),
+     ('csv', _('Comma-separated values (CSV)')),
+     ('json_lines', _('JSON lines'))]
+IMPORT_FILE_PARSERS = \
+    {'text': models.parse_textfile,
+     'tsv': models.parse_tsv,
+     'csv': models.parse_csv,
+     'json_lines': models.parse_json_lines}
 
 
 ##### General helper functions #####
 
 
+def get_user_context(request):
+    """Returns the UserContext of the logged in user.
+
+    The context is created at the first call and stored in the request, so
+    the EWUser object is read only once per request.
+    """
+
+    context = getattr(request, 'ew_user_context', None)
+    if context is None:
+        context = models.UserContext(request.user)
+        request.ew_user_context = context
+    return context
+
 def set_lang_fun(request):
-    lang = models.get_ewuser(request.user).lang
+    lang = get_user_context(request).ewuser.lang
     request.session['django_language'] = lang
     django.utils.translation.activate(lang)
 
-def has_hidden_feature(user, feature):
-    return feature in models.get_ewuser(user).extras
+def text_file_response(content, filename):
+    """Returns a response that sends the given text as a file attachment.
+
+    `content` may be an iterator, in which case the text is streamed.
+    """
+    response = HttpResponse(content, mimetype='text/plain; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
 
 #### Helper functions > URLs and queries #####
 
@@ -98,12 +130,6 @@ def remove_query_param(url, param_name):
     return new_url
 
 
-def normalize_string(s):
-    # Code copied from: http://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-in-a-python-unicode-string/518232#518232
-    return ''.join((c for c in unicodedata.normalize('NFD', s.lower())
-                    if unicodedata.category(c) != 'Mn'))
-
-
 ##### Forms #####
 
 class LenientChoiceField(forms.ChoiceField):
@@ -200,6 +226,18 @@ def CreateImportWordPairsForm(wdict):
     return ImportForm
 
 
+def CreateImportWordPairsFromFileForm(wdict):
+
+    class ImportForm(forms.Form):
+         file = forms.FileField(label=_("File") + ':')
+         file_format = forms.ChoiceField(choices=IMPORT_FILE_FORMAT_CHOICES,
+                                         label=_("Format") + ':')
+         labels = forms.CharField(label=_("Labels") + ':',
+                                 required=False)
+
+    return ImportForm
+
+
 def CreateDeleteWDictForm(wdict):
     label = \
         (_('Are you sure that you want to delete dictionary "%(wdict)s"?') %
@@ -288,13 +326,19 @@ def index(request):
         set_lang_fun(request)
         username = user.username
         wdicts = WDict.objects.filter(user=user, deleted=False)
-        wdicts_augm = sorted([(normalize_string(wdict.name),
+        context = get_user_context(request)
+        due_counts = models.get_due_counts(user, wdicts, context.today)
+        wdicts_augm = sorted([(models.normalize_string(wdict.name),
                               wdict,
-                              len(wdict.get_words_to_practice_today()))
+                              due_counts[wdict.id])
                               for wdict in wdicts])
+        forecast_summary = models.get_forecast_summary(user, wdicts,
+                                                       context.today,
+                                                       context)
     else:
         username = None
         wdicts_augm = None
+        forecast_summary = None
 
     elevator_speech = get_elevator_speech(request)
     footnote = get_footnote(request)
@@ -304,6 +348,7 @@ def index(request):
                request,
                'ew/index.html',
                {'wdicts_augm': wdicts_augm,
+                'forecast_summary': forecast_summary,
                 'username': username,
                 'elevator_speech': elevator_speech,
                 'footnote': footnote})
@@ -462,7 +507,9 @@ def docs(request, lang, page):
 @set_lang
 def wdict(request, wdict):
     words_count = len(wdict.wordpair_set.filter(deleted=False))
-    todays_words_count = len(wdict.get_words_to_practice_today())
+    due_counts = models.get_due_counts(request.user, [wdict],
+                                       get_user_context(request).today)
+    todays_words_count = due_counts[wdict.id]
     return render(request,
                   'ew/wdict.html',
                   {'wdict': wdict,
@@ -470,10 +517,10 @@ def wdict(request, wdict):
                    'todays_words_count': todays_words_count})
 
 
-def get_default_wp_data(user):
-    return {'date_added': models.get_today(user),
-            'date1': models.get_today(user),
-            'date2': models.get_today(user),
+def get_default_wp_data(today):
+    return {'date_added': today,
+            'date1': today,
+            'date2': today,
             'strength1': 0,
             'strength2': 0}
 
@@ -482,14 +529,14 @@ def copy_cleaned_fields(form, wp, fields):
     for key in fields:
         setattr(wp, key, form.cleaned_data[key])
 
-def set_word_pair_from_form(wp, form, user, display_mode):
+def set_word_pair_from_form(wp, form, today, display_mode):
 
     copy_cleaned_fields(form, wp, WordPair.get_simple_fields())
 
     if display_mode == 'advanced':
         copy_cleaned_fields(form, wp, WordPair.get_advanced_fields())
     else:
-        for key, value in get_default_wp_data(user).items():
+        for key, value in get_default_wp_data(today).items():
             setattr(wp, key, value)
 
 def get_styles(display_mode):
@@ -538,7 +585,8 @@ def add_word_pair(request, wdict):
 
             # creating the new word pair
             wp = WordPair()
-            set_word_pair_from_form(wp, form, request.user, display_mode)
+            set_word_pair_from_form(wp, form, get_user_context(request).today,
+                                    display_mode)
             wdict.wordpair_set.add(wp)
             wp.save()
             wdict.save()
@@ -577,7 +625,7 @@ def add_word_pair(request, wdict):
 
             message = ''.join(message)
 
-        data = get_default_wp_data(request.user)
+        data = get_default_wp_data(get_user_context(request).today)
 
         # Load the saved fields if they were saved not longer than 1 hour ago
         ew_add_wp_fields = request.session.get('ew_add_wp_fields')
@@ -619,11 +667,8 @@ def import_word_pairs(request, wdict, import_fun, page_title, help_text,
         form = ImportForm(request.POST)
         if form.is_valid():
             try:
-                word_pairs = import_fun(form.cleaned_data['text'], wdict)
-                labels = form.cleaned_data['labels']
-                for wp in word_pairs:
-                    wp.add_labels(labels)
-                    wp.save()
+                import_fun(form.cleaned_data['text'], wdict,
+                           form.cleaned_data['labels'])
                 messages.success(request, _('Word pairs added.'))
             except Exception, e:
                 messages.error(request, _('Error: ') + unicode(e))
@@ -659,10 +704,57 @@ def import_word_pairs_from_text(request, wdict):
                              'import_word_pairs_from_text')
 
 
+@wdict_access_required
+@set_lang
+def import_word_pairs_from_file(request, wdict):
+
+    ImportForm = CreateImportWordPairsFromFileForm(wdict)
+    if request.method == 'POST':
+        models.log(request, 'import_word_pairs', 'import_word_pairs_from_file')
+        form = ImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            # The file is parsed while it is read, and the word pairs are
+            # inserted in batches
+            parse_fun = IMPORT_FILE_PARSERS[form.cleaned_data['file_format']]
+            lines = models.decode_lines(form.cleaned_data['file'])
+            try:
+                count = models.import_lines(lines, wdict, parse_fun,
+                                            form.cleaned_data['labels'])
+            except Exception, e:
+                messages.error(request, _('Error: ') + unicode(e))
+            else:
+                messages.success(request,
+                                 _('%(count)s word pairs added.') %
+                                 {'count': count})
+                import_url = reverse('ew.views.import_word_pairs_from_file',
+                                     args=[wdict.id])
+                return HttpResponseRedirect(import_url)
+        else:
+            messages.error(request, _('Some fields are invalid.'))
+
+    elif request.method == 'GET':
+        form = ImportForm()
+
+    else:
+        assert(False)
+
+    return render(
+               request,
+               'ew/import_word_pairs.html',
+               {'form':  form,
+                'help_text': 'import-from-file',
+                'wdict': wdict,
+                'page_title': _('Import word pairs from a file')})
+
+
 @wdict_access_required
 @set_lang
 def export_word_pairs_to_text(request, wdict):
     models.log(request, 'export_word_pairs_to_text')
+    if request.GET.get('download'):
+        word_pairs = wdict.wordpair_set.filter(deleted=False).iterator()
+        return text_file_response(models.iter_export_textfile(word_pairs),
+                                  'exponwords-%s.txt' % wdict.id)
     text = models.export_textfile(wdict)
     return render(
                request,
@@ -695,6 +787,8 @@ def modify_wdict(request, wdict):
                           'strengthener_method', 'text_format', 'css'):
                 setattr(wdict, field, form.cleaned_data[field])
             wdict.save()
+            # The order of the words to be practiced may have changed
+            models.invalidate_practice_queues([wdict.id])
             messages.success(request, _('Dictionary modified.'))
             wdict_url = reverse('ew.views.modify_wdict', args=[wdict.id])
             return HttpResponseRedirect(wdict_url)
@@ -804,8 +898,16 @@ def visualize(request):
             self.name = name
             self.question_counts = question_counts
 
+    try:
+        days = int(request.GET.get('days', VISUALIZE_PERIODS[0]))
+    except ValueError:
+        raise Http404
+    if days not in VISUALIZE_PERIODS:
+        raise Http404
+
+    context = get_user_context(request)
     dates, wdicts, date_to_question_count = \
-        models.calc_future(request.user, 30, models.get_today(request.user))
+        models.calc_future(request.user, days, context.today, context)
 
     sum_data = WDictData(_('Sum'), [0 for date in dates])
     wdicts_data = [sum_data]
@@ -820,7 +922,9 @@ def visualize(request):
     return render(
                request,
                'ew/visualize.html',
-               {'wdicts_data': wdicts_data,
+               {'days': days,
+                'periods': VISUALIZE_PERIODS,
+                'wdicts_data': wdicts_data,
                 'dates': [date.isoformat() for date in dates]})
 
 
@@ -892,7 +996,9 @@ def ew_settings(request):
             lang_code = c['lang']
             if (lang_code and
                 (django.utils.translation.check_for_language(lang_code))):
-                ewuser = models.get_ewuser(request.user)
+                # The context's EWUser is modified, so set_lang_fun below
+                # will use the new language
+                ewuser = get_user_context(request).ewuser
                 ewuser.lang = lang_code
                 ewuser.timezone = c['timezone']
                 ewuser.set_turning_point_str(c['turning_point'])
@@ -910,6 +1016,10 @@ def ew_settings(request):
                 ewuser.release_emails = c['release_emails']
                 request.user.save()
                 ewuser.save()
+                # The order of the words to be practiced may have changed
+                models.invalidate_practice_queues(
+                    WDict.objects.filter(user=request.user).
+                                  values_list('id', flat=True))
                 set_lang_fun(request)
                 settings_url = reverse('ew.views.ew_settings', args=[])
 
@@ -931,7 +1041,7 @@ def ew_settings(request):
             messages.error(request, _('Some fields are invalid.'))
 
     elif request.method == 'GET':
-        ewuser = models.get_ewuser(request.user)
+        ewuser = get_user_context(request).ewuser
         form = SettingsForm({
                    'lang': ewuser.lang,
                    'timezone': ewuser.timezone,
@@ -966,7 +1076,7 @@ def ew_settings(request):
 @login_required
 @set_lang
 def ew_settings_x(request):
-    ewuser = models.get_ewuser(request.user)
+    ewuser = get_user_context(request).ewuser
     if 'x' not in ewuser.extras:
         ewuser.extras += 'x'
         ewuser.save()
@@ -978,12 +1088,35 @@ def ew_settings_x(request):
 
 
 def words_to_practice_to_json(request, words_to_practice, limit):
-    word_list = []
-
     if limit:
         words_to_practice_now = words_to_practice[:limit]
     else:
         words_to_practice_now = words_to_practice
+    word_list = words_to_practice_to_list(request, words_to_practice_now)
+    return json.dumps({'all_words_to_practice': len(words_to_practice),
+                       'word_list': word_list})
+
+
+def words_to_practice_to_list(request, words_to_practice_now):
+    """Converts (word pair, direction) pairs into the list format used by
+    practice.js."""
+
+    word_list = []
+
+    # The user settings and the dictionaries are looked up once for the whole
+    # batch instead of once per word
+    context = get_user_context(request)
+    ewuser = context.ewuser
+    show_hidden_notes = context.has_extra('p')
+    word_pairs = [wp for wp, direction in words_to_practice_now]
+    wdicts = models.attach_wdicts(request.user, word_pairs)
+    html_cache = models.RenderedHtmlCache(word_pairs)
+    if show_hidden_notes:
+        today = context.today
+        tomorrow = today + datetime.timedelta(days=1)
+        strengthener_methods = \
+            dict((wdict_id, wdict.get_strengthener_method(ewuser))
+                 for wdict_id, wdict in wdicts.items())
 
     for wp, direction in words_to_practice_now:
 
@@ -993,20 +1126,17 @@ def words_to_practice_to_json(request, words_to_practice, limit):
         extra_notes_list = []
 
         if wp.explanation:
-            all_notes_html_list.append(wp.get_html('explanation'))
+            all_notes_html_list.append(html_cache.get_html(wp, 'explanation'))
 
         if wp.labels:
             extra_notes_list.append('[%s]' % wp.labels)
 
-        wdict = wp.wdict
-        user = wdict.user
-
-        if has_hidden_feature(request.user, 'p'):
-            today = models.get_today(user)
-            tomorrow = today + datetime.timedelta(days=1)
+        if show_hidden_notes:
             last_query_date, due_date, due_interval_len = \
                 wp.get_date_info(direction)
-            strength2, date2 = wp.strengthen(direction, dry_run=True)
+            strength2, date2 = \
+                wp.strengthen(direction, dry_run=True, day=today,
+                              method=strengthener_methods[wp.wdict_id])
 
             hidden_notes = \
                 ('Dimness today: ' +
@@ -1031,24 +1161,21 @@ def words_to_practice_to_json(request, words_to_practice, limit):
 
         extra_notes = '\n\n'.join(extra_notes_list)
 
-        extra_notes_html = models.escape_html(extra_notes)
-        extra_notes_html = models.indent_html(extra_notes_html,
-                                              add_space_count=4)
-        extra_notes_html = models.newline_to_br(extra_notes_html, keepend=False)
+        extra_notes_html = models.text_to_html(extra_notes, add_space_count=4)
 
         all_notes_html_list.append(extra_notes_html)
         all_notes_html = '<br/><br/>\n'.join(all_notes_html_list)
 
-        word_list.append([wp.get_html('word_in_lang1'),
-                          wp.get_html('word_in_lang2'),
+        word_list.append([html_cache.get_html(wp, 'word_in_lang1'),
+                          html_cache.get_html(wp, 'word_in_lang2'),
                           direction,
                           wp.id,
                           wp.get_date(direction).isoformat(),
                           wp.get_strength(direction),
                           all_notes_html])
 
-    return json.dumps({'all_words_to_practice': len(words_to_practice),
-                       'word_list': word_list})
+    html_cache.save()
+    return word_list
 
 
 @wdict_access_required
@@ -1056,7 +1183,7 @@ def words_to_practice_to_json(request, words_to_practice, limit):
 def practice_wdict(request, wdict):
     text = 'dict: "%s"' % wdict.name
     models.log(request, 'practice_wdict', text)
-    ewuser = models.get_ewuser(request.user)
+    ewuser = get_user_context(request).ewuser
     return render(request,
                   'ew/practice_wdict.html',
                   {'wdict': wdict,
@@ -1072,7 +1199,7 @@ def practice_wdict(request, wdict):
 def practice_wdict_early(request, wdict):
     text = 'dict: "%s"' % wdict.name
     models.log(request, 'practice_wdict_early', text)
-    ewuser = models.get_ewuser(request.user)
+    ewuser = get_user_context(request).ewuser
     return render(request,
                   'ew/practice_wdict.html',
                   {'wdict': wdict,
@@ -1083,14 +1210,40 @@ def practice_wdict_early(request, wdict):
                    'css': wdict.get_css()})
 
 
+def get_selected_words_batch(request, cursor):
+    """Returns a batch of the words selected by the "practice" operation from
+    the `cursor` position, in the format of get_words_to_practice_today.
+
+    Only the word pairs of the batch are read from the database.
+    """
+
+    packed = request.session.get('ew_words_to_practice', '')
+    if not isinstance(packed, str):
+        # Sessions saved by earlier versions contain a list of
+        # (WordPair, direction) pairs
+        packed = models.pack_words_to_practice(
+                     [(wp.id, direction) for wp, direction in packed])
+        request.session['ew_words_to_practice'] = packed
+    word_count = models.get_packed_word_count(packed)
+    next_cursor = cursor + PRACTICE_BATCH_SIZE
+    items = models.unpack_words_to_practice(packed, cursor, next_cursor)
+    word_pairs = (WordPair.objects.
+                  filter(wdict__user=request.user, deleted=False).
+                  in_bulk([item[0] for item in items]))
+    words = [(word_pairs[word_pair_id], direction)
+             for word_pair_id, direction in items
+             if word_pair_id in word_pairs]
+    return {'all_words_to_practice': word_count,
+            'word_list': words_to_practice_to_list(request, words),
+            'cursor': next_cursor if next_cursor < word_count else None}
+
+
 @login_required
 @set_lang
 def practice(request):
     models.log(request, 'practice')
-    words_to_practice = request.session['ew_words_to_practice']
-    json_str = words_to_practice_to_json(request, words_to_practice,
-                                         limit=False)
-    ewuser = models.get_ewuser(request.user)
+    json_str = json.dumps(get_selected_words_batch(request, 0))
+    ewuser = get_user_context(request).ewuser
     return render(request,
                   'ew/practice_wdict.html',
                   {'wdict': None,
@@ -1099,25 +1252,47 @@ def practice(request):
                    'quick_labels': ewuser.get_quick_labels()})
 
 
+def get_cursor(request):
+    """Returns the "cursor" GET parameter of the views that return batches
+    of words to practice."""
+    try:
+        cursor = int(request.GET.get('cursor', 0))
+    except ValueError:
+        raise Http404
+    if cursor < 0:
+        raise Http404
+    return cursor
+
+
 @wdict_access_required
 def get_words_to_practice_today(request, wdict):
+    """Returns a batch of the words to be practiced today from the practice
+    queue of the dictionary.
 
+    The "cursor" GET parameter is the position in the queue from which the
+    batch is collected (0 by default). The response contains the cursor of
+    the next batch, which is null if there are no more words.
+    """
+
+    cursor = get_cursor(request)
     try:
 
         if request.method != 'GET':
             raise Http404
         word_list_type = request.GET['word_list_type']
+        if word_list_type not in ('normal', 'early'):
+            raise Http404
 
-        words_to_practice = \
-            wdict.get_words_to_practice_today(word_list_type=word_list_type)
-        wdict.sort_words(words_to_practice, word_list_type=word_list_type)
-
-        if has_hidden_feature(request.user, 'l'):
-            limit = 1000
-        else:
-            limit = PRACTICE_WORD_COUNT_LIMIT
-        json_str = words_to_practice_to_json(request, words_to_practice,
-                                             limit=limit)
+        context = get_user_context(request)
+        queue = models.get_practice_queue(wdict, word_list_type, context)
+        words, next_cursor = models.get_practice_batch(
+                                 queue, cursor, PRACTICE_BATCH_SIZE, context)
+        word_list = words_to_practice_to_list(request, words)
+        json_str = json.dumps(
+                       {'all_words_to_practice':
+                            queue.get_remaining_count(context),
+                        'word_list': word_list,
+                        'cursor': next_cursor})
 
         return HttpResponse(json_str,
                             mimetype='application/json')
@@ -1128,6 +1303,59 @@ def get_words_to_practice_today(request, wdict):
         raise exc_info[0], exc_info[1], exc_info[2]
 
 
+@login_required
+def get_selected_words_to_practice(request):
+    """Returns a batch of the words selected by the "practice" operation.
+
+    The "cursor" GET parameter works as in get_words_to_practice_today.
+    """
+
+    if request.method != 'GET':
+        raise Http404
+    cursor = get_cursor(request)
+    json_str = json.dumps(get_selected_words_batch(request, cursor))
+    return HttpResponse(json_str,
+                        mimetype='application/json')
+
+
+def apply_answer(wp, direction, answer, old_date, old_strength, context):
+    """Applies the answer of the user to a word pair without saving it.
+
+    Returns the change in the due count and in the early count (see
+    PracticeQueue) of the word pair's dictionary, or None if the word pair is
+    not in the state in which the question was asked.
+    """
+
+    if (old_date != wp.get_date(direction).isoformat() or
+        old_strength != wp.get_strength(direction)):
+
+        # This update have already been performed or another process
+        # modified the word's date and/or strength; in either case,
+        # we don't want to modify the word.
+        return None
+
+    assert(isinstance(answer, bool))
+    today = context.today
+    was_due = (wp.get_date(direction) <= today)
+    was_early = wp.wdict.is_word_to_practice_early(wp, direction, today)
+    if answer:
+        # The user knew the answer
+        method = wp.wdict.get_strengthener_method(context.ewuser)
+        wp.strengthen(direction, day=today, method=method)
+    else:
+        # The user did not know the answer
+        wp.weaken(direction, day=today)
+
+    # Only the date of this question has changed, so the due count and the
+    # early count of the dictionary can be adjusted instead of being
+    # recalculated
+    if wp.deleted:
+        return 0, 0
+    is_due = (wp.get_date(direction) <= today)
+    is_early = wp.wdict.is_word_to_practice_early(wp, direction, today)
+    return int(is_due) - int(was_due), int(is_early) - int(was_early)
+
+
 @login_required
 def update_word(request):
     try:
@@ -1138,27 +1366,22 @@ def update_word(request):
         old_date = json.loads(request.POST['old_date'])
         old_strength = json.loads(request.POST['old_strength'])
 
-        wp = get_object_or_404(WordPair,
+        wp = get_object_or_404(WordPair.objects.select_related('wdict'),
                                pk=word_pair_id,
                                wdict__user=request.user)
 
-        if (old_date != wp.get_date(direction).isoformat() or
-            old_strength != wp.get_strength(direction)):
-
-            # This update have already been performed or another process
-            # modified the word's date and/or strength; in either case,
-            # we don't want to modify the word.
-            return HttpResponse(json.dumps('ok'),
-                                mimetype='application/json')
-
-        assert(isinstance(answer, bool))
-        if answer:
-            # The user knew the answer
-            wp.strengthen(direction)
-        else:
-            # The user did not know the answer
-            wp.weaken(direction)
-        wp.save()
+        context = get_user_context(request)
+        old_buckets = wp.get_forecast_buckets()
+        deltas = apply_answer(wp, direction, answer, old_date, old_strength,
+                              context)
+        if deltas is not None:
+            wp.save(update_due_count=False)
+            due_delta, early_delta = deltas
+            models.adjust_due_count(wp.wdict_id, context.today, due_delta)
+            models.adjust_early_count(wp.wdict_id, context.today,
+                                      early_delta)
+            models.adjust_forecast(wp.wdict_id, context.today, old_buckets,
+                                   wp.get_forecast_buckets())
 
         return HttpResponse(json.dumps('ok'),
                              mimetype='application/json')
@@ -1169,6 +1392,113 @@ def update_word(request):
         raise exc_info[0], exc_info[1], exc_info[2]
 
 
+def apply_update(wp, update, context):
+    """Applies an item of a batch sent to `update_words` to a word pair.
+
+    Returns the status of the item and the changes in the due count and the
+    early count.
+    """
+
+    if update.get('type') == 'answer':
+        direction = update.get('direction')
+        answer = update.get('answer')
+        if direction not in (1, 2) or not isinstance(answer, bool):
+            return 'invalid', (0, 0)
+        deltas = apply_answer(wp, direction, answer, update.get('old_date'),
+                              update.get('old_strength'), context)
+        if deltas is None:
+            return 'conflict', (0, 0)
+        return 'ok', deltas
+    elif update.get('type') == 'label':
+        label = update.get('label')
+        if not isinstance(label, basestring):
+            return 'invalid', (0, 0)
+        wp.add_labels(label)
+        return 'ok', (0, 0)
+    else:
+        return 'invalid', (0, 0)
+
+
+@login_required
+def update_words(request):
+    """Applies a batch of answers and label additions.
+
+    The "updates" POST parameter is a JSON list whose items look like this:
+
+        {"type": "answer", "word_index": 12, "direction": 1, "answer": true,
+         "old_date": "2013-01-31", "old_strength": 2}
+        {"type": "label", "word_index": 12, "label": "hard"}
+
+    The response contains the status of each item: "ok", "conflict" (the
+    answer has already been applied or the word pair was modified since the
+    question was asked), "not_found" or "invalid".
+    """
+
+    try:
+
+        updates = json.loads(request.POST['updates'])
+        assert(isinstance(updates, list))
+        updates = [update if isinstance(update, dict) else {}
+                   for update in updates]
+
+        word_pair_ids = set(update.get('word_index') for update in updates
+                            if isinstance(update.get('word_index'),
+                                          (int, long)))
+
+        context = get_user_context(request)
+        results = []
+        changed_word_pairs = {}
+        old_buckets = {} # {word_pair_id: [(strength, due_date)]}
+        deltas = {} # {wdict_id: [due_delta, early_delta]}
+        with transaction.commit_on_success():
+
+            word_pairs = (WordPair.objects.select_related('wdict').
+                          filter(wdict__user=request.user).
+                          in_bulk(list(word_pair_ids)))
+
+            for update in updates:
+                word_pair_id = update.get('word_index')
+                if isinstance(word_pair_id, (int, long)):
+                    wp = word_pairs.get(word_pair_id)
+                else:
+                    wp = None
+                if wp is None:
+                    results.append('not_found')
+                    continue
+                if wp.id not in old_buckets:
+                    old_buckets[wp.id] = wp.get_forecast_buckets()
+                status, (due_delta, early_delta) = \
+                    apply_update(wp, update, context)
+                results.append(status)
+                if status == 'ok':
+                    changed_word_pairs[wp.id] = wp
+                    wdict_deltas = deltas.setdefault(wp.wdict_id, [0, 0])
+                    wdict_deltas[0] += due_delta
+                    wdict_deltas[1] += early_delta
+
+            # {wdict_id: ([(strength, due_date)], [(strength, due_date)])}
+            bucket_changes = {}
+            for wp in changed_word_pairs.itervalues():
+                wp.save(update_due_count=False)
+                old, new = bucket_changes.setdefault(wp.wdict_id, ([], []))
+                old.extend(old_buckets[wp.id])
+                new.extend(wp.get_forecast_buckets())
+            for wdict_id, (due_delta, early_delta) in deltas.iteritems():
+                models.adjust_due_count(wdict_id, context.today, due_delta)
+                models.adjust_early_count(wdict_id, context.today,
+                                          early_delta)
+            for wdict_id, (old, new) in bucket_changes.iteritems():
+                models.adjust_forecast(wdict_id, context.today, old, new)
+
+        return HttpResponse(json.dumps({'status': 'ok', 'results': results}),
+                            mimetype='application/json')
+    except Exception, e:
+        traceback.print_stack()
+        exc_info = sys.exc_info()
+        traceback.print_exception(exc_info[0], exc_info[1], exc_info[2])
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
 @login_required
 def add_label(request):
     try:
@@ -1192,6 +1522,16 @@ def add_label(request):
         raise exc_info[0], exc_info[1], exc_info[2]
 
 
+@login_required
+def label_list(request):
+    """Returns the labels of the user that start with the "term" GET
+    parameter, together with the number of word pairs that have them."""
+    label_counts = models.get_label_counts(request.user,
+                                           request.GET.get('term', ''))
+    return HttpResponse(json.dumps(label_counts),
+                        mimetype='application/json')
+
+
 ##### Search and operations #####
 
 
@@ -1203,6 +1543,7 @@ def parse_query_label(query_label_raw):
 
 
 def search_in_db(user, query_wdict, query_label, query_text):
+    """Returns a queryset of the word pairs that match the query."""
     if query_wdict in ('', 'all'):
         all_word_pairs = WordPair.objects.filter(wdict__user=user,
                                                  wdict__deleted=False,
@@ -1212,40 +1553,7 @@ def search_in_db(user, query_wdict, query_label, query_text):
         wdict = get_object_or_404(WDict, pk=wdict_id, user=user)
         all_word_pairs = WordPair.objects.filter(wdict=wdict,
                                                  deleted=False)
-    word_pairs = []
-    query_words = [normalize_string(query_word)
-                   for query_word in query_text.split()]
-    query_items = []
-    for query_word in query_words:
-        if query_word.startswith('label:'):
-            query_items.append(('label', query_word[6:]))
-        else:
-            query_items.append(('text', query_word))
-
-    for wp in all_word_pairs:
-        wp_matches_all = True
-        if ((query_label is not None) and
-            (query_label not in wp.get_label_set())):
-            # We require a certain label but wp does not have it
-            continue
-
-        for query_item_type, query_item_value in query_items:
-            query_item_matches = False
-            if query_item_type == 'label':
-                labels = normalize_string(unicode(wp.labels))
-                query_item_matches = (labels.find(query_item_value) != -1)
-            else: # query_item_type == 'text'
-                for field in models.WordPair.get_fields_to_be_edited():
-                    field_text = normalize_string(unicode(getattr(wp, field)))
-                    if (field_text.find(query_item_value) != -1):
-                        query_item_matches = True
-                        break
-            if not query_item_matches:
-                wp_matches_all = False
-                break
-        if wp_matches_all:
-            word_pairs.append(wp)
-    return word_pairs
+    return models.search_word_pairs(all_word_pairs, query_label, query_text)
 
 
 @login_required
@@ -1327,6 +1635,8 @@ def search(request):
         word_pairs = \
             search_in_db(request.user, query_wdict, query_label, query_text)
 
+        # The paginator counts the hits and reads only the word pairs of the
+        # current page from the database
         paginator = Paginator(word_pairs, hits_per_page)
         page = request.GET.get('page', 1)
 
@@ -1347,12 +1657,16 @@ def search(request):
         custom_css_list = []
 
         if show_hits:
+            pagination_info.object_list = list(pagination_info.object_list)
+            models.attach_wdicts(request.user, pagination_info.object_list)
+            html_cache = models.RenderedHtmlCache(pagination_info.object_list)
             word_pairs_and_exps = \
                 [(wp,
-                  wp.get_html('word_in_lang1'),
-                  wp.get_html('word_in_lang2'),
-                  wp.get_html('explanation'))
+                  html_cache.get_html(wp, 'word_in_lang1'),
+                  html_cache.get_html(wp, 'word_in_lang2'),
+                  html_cache.get_html(wp, 'explanation'))
                  for wp in pagination_info.object_list]
+            html_cache.save()
             custom_css_list = \
                 [(wp_wdict.name, wp_wdict.get_css())
                  for wp_wdict in
@@ -1367,7 +1681,7 @@ def search(request):
                    'source_url': source_url,
                    'wdict_choices': wdict_choices,
                    'show_hits': show_hits,
-                   'hits_count': len(word_pairs),
+                   'hits_count': paginator.count,
                    'result_exists': True,
                    'pagination_url': pagination_url,
                    'pagination_info': pagination_info,
@@ -1455,7 +1769,10 @@ def edit_word_pair(request, wp, wdict):
                response_dict)
 
 
-def get_word_pairs_to_use(request):
+def get_word_pair_ids_to_use(request):
+    """Returns the ids of the word pairs selected for an operation on the
+    search page, in increasing order.
+    """
 
     # Deciding whether:
     # - to use an explicit list of word pair ids (if show_hits is true); or
@@ -1473,14 +1790,19 @@ def get_word_pairs_to_use(request):
     # Calculating the list of word pairs
 
     if show_hits:
+        # The checkboxes of the selected word pairs are named after their
+        # ids; only the user's own word pairs can be selected. (isdigit is
+        # not used because it accepts non-ASCII digits, which int rejects.)
+        selected_ids = sorted(int(key) for key in request.POST
+                              if re.match(r'[0-9]+$', key))
         word_pairs = WordPair.objects.filter(wdict__user=request.user,
                                              wdict__deleted=False,
                                              deleted=False)
-        word_pairs_to_use = []
-        for wp in word_pairs:
-            if unicode(wp.id) in request.POST:
-                word_pairs_to_use.append(wp)
-        return word_pairs_to_use
+        word_pair_ids = []
+        for chunk in models.split_to_chunks(selected_ids):
+            word_pair_ids.extend(word_pairs.filter(id__in=chunk).
+                                            values_list('id', flat=True))
+        return sorted(word_pair_ids)
 
     else:
         query_text = query_dict['q']
@@ -1489,7 +1811,7 @@ def get_word_pairs_to_use(request):
 
         word_pairs = \
             search_in_db(request.user, query_wdict, query_label, query_text)
-        return word_pairs
+        return list(word_pairs.values_list('id', flat=True))
 
 
 @login_required
@@ -1498,7 +1820,7 @@ def operation_on_word_pairs(request):
     models.log(request, 'operation_on_word_pairs')
 
     # Select the word pairs to use (i.e. to do the operation with)
-    word_pairs_to_use = get_word_pairs_to_use(request)
+    word_pair_ids = get_word_pair_ids_to_use(request)
 
     # Perform the operation
 
@@ -1554,7 +1876,13 @@ def operation_on_word_pairs(request):
         practice_scope = request.POST.get('practice_scope')
         do_operation = False
     elif operation == 'export':
-        text = models.export_textfile(word_pairs=word_pairs_to_use)
+        if request.POST.get('export_format') == 'text_file':
+            return text_file_response(
+                       models.iter_export_textfile(
+                           models.iter_word_pairs_by_ids(word_pair_ids)),
+                       'exponwords-export.txt')
+        text = models.export_textfile(
+                   word_pairs=models.iter_word_pairs_by_ids(word_pair_ids))
         return render(
                    request,
                    'ew/export_word_pairs_as_text.html',
@@ -1563,51 +1891,46 @@ def operation_on_word_pairs(request):
         error_msg = _('Operation not recognized') + ': ' + str(operation)
 
     if do_operation:
-        for wp in word_pairs_to_use:
-            if operation == 'delete':
-                wp.deleted = True
-            elif operation == 'move':
-                wp.wdict = target_wdict
-            elif operation == 'add_labels':
-                wp.add_labels(labels)
-            elif operation == 'remove_labels':
-                wp.remove_labels(labels)
-            elif operation == 'set_labels':
-                wp.set_labels(labels)
-            elif operation == 'set_dates_strengths':
-                for field in fields:
-                    if values[field] is not None:
-                        setattr(wp, field, values[field])
-            elif operation == 'shift_days':
-                if datetime.date.max - wp.date1 > days:
-                    wp.date1 += days
-                if datetime.date.max - wp.date2 > days:
-                    wp.date2 += days
-            wp.save()
+        if operation == 'delete':
+            models.update_word_pairs(word_pair_ids, {'deleted': True})
+        elif operation == 'move':
+            models.update_word_pairs(word_pair_ids, {'wdict': target_wdict})
+        elif operation in ('add_labels', 'remove_labels', 'set_labels'):
+            models.update_word_pair_labels_in_bulk(word_pair_ids, operation,
+                                                   labels)
+        elif operation == 'set_dates_strengths':
+            models.update_word_pairs(
+                word_pair_ids,
+                dict((field, values[field]) for field in fields
+                     if values[field] is not None))
+        elif operation == 'shift_days':
+            models.shift_word_pair_dates(word_pair_ids, days)
 
     # Redirect the user to the search page where which he issue the operation
 
     source_url = request.POST.get('source_url')
 
     if operation == 'practice':
-        today = models.get_today(request.user)
         words_to_practice = []
-        user_time = models.get_user_time(request.user)
-        for wp in word_pairs_to_use:
+        user_time = get_user_context(request).user_time
+        for wp in models.iter_word_pairs_by_ids(word_pair_ids):
             if (practice_scope == 'all' or
                 models.is_word_due(wp.date1, user_time)):
-                words_to_practice.append((wp, 1))
+                words_to_practice.append((wp.id, 1))
             if (practice_scope == 'all' or
                 models.is_word_due(wp.date2, user_time)):
-                words_to_practice.append((wp, 2))
+                words_to_practice.append((wp.id, 2))
         random.shuffle(words_to_practice)
 
-        request.session['ew_words_to_practice'] = words_to_practice
+        # Only the ids are stored, because the session is saved on every
+        # request
+        request.session['ew_words_to_practice'] = \
+            models.pack_words_to_practice(words_to_practice)
         redirect_url = reverse('ew.views.practice', args=[])
 
     elif source_url:
         if error_msg is None:
-            word_count = len(word_pairs_to_use)
+            word_count = len(word_pair_ids)
             if word_count == 0:
                 message = _('No word pair modified.')
             elif word_count == 1:
@@ -1634,39 +1957,43 @@ def get_announcement_receivers():
     """Returns the users (with their email addresses) who should receive
     notifications about new releases.
 
-    Returns: {lang: [(username, email)]}
+    Returns: {lang: [(user_id, username, email)]}
     """
 
     lang_users = {}
-    for user in models.EWUser.get_email_receiver_users():
-        lang = models.get_ewuser(user).lang
-        lang_users.setdefault(lang, []).append((user.username, user.email))
+    for lang, user_id, username, email in \
+            models.EWUser.iter_email_receivers():
+        lang_users.setdefault(lang, []).append((user_id, username, email))
     return lang_users
 
 
-def send_announcement(request):
-    """Sends release announcements in email."""
-
-    for lang, users in get_announcement_receivers().items():
-
-        # The first line of the stored announcement text will be the subject;
-        # the rest will be the body.
-        ann = models.Announcement.objects.get(lang=lang)
-        lines = ann.text.splitlines()
-        subject = lines[0]
-        body = '\n'.join(lines[1:])
-
-        for username, email in users:
-            models.log(request,
-                       'announcement_sending',
-                       'to %s in language %s' % (email, lang))
-            send_mail(subject, body, settings.DEFAULT_FROM_EMAIL,
-                      [email], fail_silently=False)
-            models.log(request,
-                       'announcement_sent',
-                       'to %s in language %s' % (email, lang))
-
-    messages.success(request, _('Announcement emails sent.'))
+def run_announcement_job(request, job):
+    """Sends the announcement emails of the job for at most
+    ANNOUNCEMENT_TIME_LIMIT seconds, and reports the progress."""
+
+    errors = models.run_announcement_job(job,
+                                         time_limit=ANNOUNCEMENT_TIME_LIMIT)
+    if errors:
+        messages.error(request,
+                       _('Some announcement emails could not be sent: '
+                         '%(error)s') % {'error': errors[0]})
+    if job.finished is not None:
+        failed_count = job.get_failed_count()
+        if failed_count:
+            messages.success(request,
+                             _('Announcement emails sent, except for '
+                               '%(failed)s recipients whose emails failed '
+                               '%(attempts)s times.') %
+                             {'failed': failed_count,
+                              'attempts': models.ANNOUNCEMENT_MAX_ATTEMPTS})
+        else:
+            messages.success(request, _('Announcement emails sent.'))
+    else:
+        sent_count, recipient_count = job.get_progress()
+        messages.info(request,
+                      _('%(sent)s of %(all)s announcement emails sent. '
+                        'Press "Continue sending" to send the others.') %
+                      {'sent': sent_count, 'all': recipient_count})
 
 
 @staff_member_required
@@ -1692,7 +2019,16 @@ def announce_release(request):
         type('AnnounceReleaseForm', (forms.Form,), fields)
 
     message = ''
-    if request.method == 'POST':
+    url = reverse('ew.views.announce_release', args=[])
+    if request.method == 'POST' and request.POST.get('continue-button'):
+        models.log(request, 'announce_release', 'continue')
+        job = get_object_or_404(models.AnnouncementJob,
+                                pk=request.POST.get('job'),
+                                finished=None)
+        run_announcement_job(request, job)
+        return HttpResponseRedirect(url)
+
+    elif request.method == 'POST':
         models.log(request, 'announce_release')
 
         action = None
@@ -1719,9 +2055,10 @@ def announce_release(request):
 
             # Sending the announcement emails if needed
             if action == 'announce':
-                send_announcement(request)
+                job = models.create_announcement_job(
+                          request.user, get_announcement_receivers())
+                run_announcement_job(request, job)
 
-            url = reverse('ew.views.announce_release', args=[])
             return HttpResponseRedirect(url)
         else:
             messages.error(request, _('Some fields are invalid.'))
@@ -1749,4 +2086,62 @@ def announce_release(request):
                'ew/announce_release.html',
                {'form':  form,
                 'message': message,
-                'lang_users': get_announcement_receivers()})
+                'lang_users': get_announcement_receivers(),
+                'unfinished_jobs':
+                    [(job, job.get_progress()) for job in
+                     models.AnnouncementJob.objects.filter(finished=None).
+                                                    order_by('id')]})
+
+
+def get_view_stats_bucket_labels():
+    labels = []
+    for limit in models.VIEW_STATS_BUCKETS:
+        if limit < 1:
+            labels.append('<= %d ms' % round(limit * 1000))
+        else:
+            labels.append('<= %g s' % limit)
+    labels.append('> %g s' % models.VIEW_STATS_BUCKETS[-1])
+    return labels
+
+
+@staff_member_required
+@set_lang
+def view_stats(request):
+    """Shows the statistics collected by the ViewStatsMiddleware."""
+
+    try:
+        days = int(request.GET.get('days', VIEW_STATS_PERIODS[0]))
+    except ValueError:
+        raise Http404
+    if days not in VIEW_STATS_PERIODS:
+        raise Http404
+
+    last_day = datetime.date.today()
+    first_day = last_day - datetime.timedelta(days=days - 1)
+    bucket_labels = get_view_stats_bucket_labels()
+    rows = []
+    for view in models.get_view_stats(first_day, last_day):
+        count = view['count']
+        histogram = view['histogram']
+        rows.append(
+            {'view_name': view['view_name'],
+             'count': count,
+             'wall_time': view['wall_time'],
+             'avg_wall_time': view['wall_time'] * 1000 / count,
+             'avg_db_time': view['db_time'] * 1000 / count,
+             'avg_query_count': float(view['query_count']) / count,
+             'avg_response_size': view['response_size'] / 1024.0 / count,
+             'median': bucket_labels[
+                 models.get_histogram_percentile(histogram, 50)],
+             'percentile_95': bucket_labels[
+                 models.get_histogram_percentile(histogram, 95)],
+             'histogram': histogram})
+
+    return render(request,
+                  'ew/view_stats.html',
+                  {'days': days,
+                   'periods': VIEW_STATS_PERIODS,
+                   'first_day': first_day,
+                   'last_day': last_day,
+                   'bucket_labels': bucket_labels,
+                   'rows': rows})